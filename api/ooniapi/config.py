@@ -21,6 +21,9 @@ REPORT_INDEX_OFFSET = int(os.environ.get("REPORT_INDEX_OFFSET", "635830"))
 
 REQID_HDR = "X-Request-ID"
 
+# Send measurements to the fastpath in batches from a background thread
+FASTPATH_BATCH_SUBMIT = False
+
 metrics = statsd.StatsClient("localhost", 8125, prefix="ooni-api")
 
 
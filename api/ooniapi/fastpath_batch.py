@@ -0,0 +1,124 @@
+"""
+Submit measurements to the fastpath in batches
+
+The fastpath listens on localhost and receives either one measurement per
+POST on /<msmt_uid> or many measurements per POST on /batch
+The latter is used here: submissions from probes are queued and sent by a
+background thread, reducing the HTTP overhead on both sides at peak times.
+Failed submissions are retried with backoff. A batch rejected as invalid is
+split to send the valid records.
+"""
+
+from typing import List, Tuple
+from urllib.error import HTTPError
+from urllib.request import urlopen
+import logging
+import os
+import queue
+import threading
+import time
+
+from ooniapi.config import metrics
+
+FASTPATH_BATCH_URL = "http://127.0.0.1:8472/batch"
+SUBMIT_ATTEMPTS = 5
+# Doubled after each failed attempt
+RETRY_DELAY_S = 0.5
+
+log = logging.getLogger("ooni-api")
+
+
+def encode_record(msmt_uid: str, data: bytes) -> bytes:
+    """Encode a measurement as a "<msmt_uid>\\t<body>\\n" record"""
+    # In valid JSON newlines can only appear as whitespace between tokens
+    return msmt_uid.encode() + b"\t" + data.replace(b"\n", b" ") + b"\n"
+
+
+class BatchSubmitter:
+    """Queues measurements and sends them to the fastpath when max_records
+    measurements are queued or after max_delay_s seconds
+    """
+
+    def __init__(self, max_records=100, max_delay_s=0.2, max_queued=10000):
+        self.max_records = max_records
+        self.max_delay_s = max_delay_s
+        self.max_queued = max_queued
+        self._pid = None
+        self._lock = threading.Lock()
+        self._queue: queue.Queue = queue.Queue(max_queued)
+
+    def submit(self, msmt_uid: str, data: bytes) -> None:
+        """Queue a measurement. Raises queue.Full if the fastpath is not
+        keeping up"""
+        self._start_if_needed()
+        self._queue.put_nowait((msmt_uid, data))
+
+    def _start_if_needed(self) -> None:
+        # Threads do not survive fork(): run one in each API worker process
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(self.max_queued)
+            t = threading.Thread(target=self._run, name="fastpath_batch", daemon=True)
+            t.start()
+            self._pid = os.getpid()
+
+    def _next_batch(self) -> List[Tuple[str, bytes]]:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_delay_s
+        while len(batch) < self.max_records:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            self.send(self._next_batch())
+
+    def send(self, batch: List[Tuple[str, bytes]]) -> None:
+        """Send a batch, retrying on failures. If the fastpath rejects the
+        batch as invalid, send its halves separately"""
+        body = b"".join(encode_record(uid, data) for uid, data in batch)
+        for attempt in range(SUBMIT_ATTEMPTS):
+            if attempt:
+                time.sleep(RETRY_DELAY_S * 2 ** (attempt - 1))
+            try:
+                with metrics.timer("fastpath_batch_submit"):
+                    urlopen(FASTPATH_BATCH_URL, body, 59)
+                metrics.gauge("fastpath_batch_size", len(batch))
+                return
+
+            except HTTPError as e:
+                if e.code == 400:
+                    self._send_halves(batch)
+                    return
+                log.error(f"Failed to submit batch to fastpath: {e}")
+
+            except Exception:
+                log.error("Failed to submit batch to fastpath", exc_info=True)
+
+            metrics.incr("fastpath_batch_submit_error")
+
+        log.error(f"Dropping {len(batch)} measurements")
+        metrics.incr("fastpath_batch_dropped_msmt", len(batch))
+
+    def _send_halves(self, batch: List[Tuple[str, bytes]]) -> None:
+        if len(batch) == 1:
+            log.error(f"Fastpath rejected measurement {batch[0][0]}")
+            metrics.incr("fastpath_batch_dropped_msmt")
+            return
+
+        half = len(batch) // 2
+        self.send(batch[:half])
+        self.send(batch[half:])
+
+
+submitter = BatchSubmitter()
@@ -23,6 +23,7 @@ from ooniapi.config import metrics
 from ooniapi.utils import cachedjson, nocachejson, jerror, req_json
 
 from ooniapi.auth import create_jwt, decode_jwt
+from ooniapi import fastpath_batch
 from ooniapi.prio import generate_test_list
 
 probe_services_blueprint = Blueprint("ps_api", "probe_services")
@@ -916,8 +917,11 @@ def receive_measurement(report_id) -> Response:
 
     compare_probe_msmt_cc_asn(cc, asn)
     try:
-        url = f"http://127.0.0.1:8472/{msmt_uid}"
-        urlopen(url, data, 59)
+        if current_app.config["FASTPATH_BATCH_SUBMIT"]:
+            fastpath_batch.submitter.submit(msmt_uid, data)
+        else:
+            url = f"http://127.0.0.1:8472/{msmt_uid}"
+            urlopen(url, data, 59)
         return nocachejson(measurement_uid=msmt_uid)
 
     except Exception as e:
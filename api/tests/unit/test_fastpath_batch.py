@@ -0,0 +1,71 @@
+from unittest.mock import patch
+from urllib.error import HTTPError, URLError
+
+from ooniapi import fastpath_batch
+
+
+def test_encode_record():
+    r = fastpath_batch.encode_record("20210101T000000Z_a", b'{\n"a": 1}\n')
+    assert r == b'20210101T000000Z_a\t{ "a": 1} \n'
+
+
+def test_batch_submitter():
+    bs = fastpath_batch.BatchSubmitter(max_records=2, max_delay_s=0.01)
+    bs._start_if_needed = lambda: None  # no background thread
+    bs.submit("20210101T000000Z_a", b"{}")
+    bs.submit("20210101T000000Z_b", b"{}")
+    bs.submit("20210101T000000Z_c", b"{}")
+    assert len(bs._next_batch()) == 2
+    with patch("ooniapi.fastpath_batch.urlopen") as m:
+        bs.send(bs._next_batch())
+    url, body, _ = m.call_args[0]
+    assert url == "http://127.0.0.1:8472/batch"
+    assert body == b"20210101T000000Z_c\t{}\n"
+
+
+def _urlopen(sent: list, failures: list):
+    """Mock urlopen: raises the exceptions in failures, then records the
+    uids sent. Records with a "bogus" body are rejected"""
+
+    def urlopen(url, body, timeout):
+        if failures:
+            raise failures.pop(0)
+        if b"bogus" in body:
+            raise HTTPError(url, 400, "Bad Request", {}, None)
+        sent.extend(line.split(b"\t")[0].decode() for line in body.splitlines())
+
+    return urlopen
+
+
+@patch("ooniapi.fastpath_batch.time.sleep")
+@patch("ooniapi.fastpath_batch.metrics")
+def test_batch_submitter_retry(metrics, sleep):
+    bs = fastpath_batch.BatchSubmitter()
+    sent: list = []
+    failures = [URLError("refused"), HTTPError("", 503, "", {}, None)]
+    with patch("ooniapi.fastpath_batch.urlopen", _urlopen(sent, failures)):
+        bs.send([("20210101T000000Z_a", b"{}"), ("20210101T000000Z_b", b"{}")])
+    assert sent == ["20210101T000000Z_a", "20210101T000000Z_b"]
+    assert [c.args[0] for c in sleep.call_args_list] == [0.5, 1.0]
+    assert metrics.incr.call_count == 2
+
+    # Persistent failure: the measurements are counted as dropped
+    failures = [URLError("refused")] * fastpath_batch.SUBMIT_ATTEMPTS
+    with patch("ooniapi.fastpath_batch.urlopen", _urlopen(sent, failures)):
+        bs.send([("20210101T000000Z_c", b"{}"), ("20210101T000000Z_d", b"{}")])
+    assert len(sent) == 2
+    metrics.incr.assert_called_with("fastpath_batch_dropped_msmt", 2)
+
+
+@patch("ooniapi.fastpath_batch.time.sleep")
+@patch("ooniapi.fastpath_batch.metrics")
+def test_batch_submitter_split_invalid(metrics, sleep):
+    bs = fastpath_batch.BatchSubmitter()
+    batch = [(f"20210101T000000Z_{n}", b"{}") for n in range(5)]
+    batch[3] = ("20210101T000000Z_3", b"bogus")
+    sent: list = []
+    with patch("ooniapi.fastpath_batch.urlopen", _urlopen(sent, [])):
+        bs.send(batch)
+    assert sent == [uid for uid, _ in batch if uid != "20210101T000000Z_3"]
+    metrics.incr.assert_called_once_with("fastpath_batch_dropped_msmt")
+    assert not sleep.called
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Fastpath throughput benchmark
+
+Runs process_measurement on a synthetic corpus without S3 or a database and
+reports measurements/s, latency percentiles for each score_* function and
+peak RSS.
+
+The corpus is built by picking measurements from fastpath/tests/data in a
+random order that depends only on the seed.
+
+Usage:
+    PYTHONPATH=. python3 fastpath/benchmark.py --count 20000
+    # Compare two git revisions
+    PYTHONPATH=. python3 fastpath/benchmark.py --compare master HEAD
+"""
+
+from argparse import ArgumentParser, Namespace
+from pathlib import Path
+from typing import Dict, List, Tuple
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import ujson  # debdeps: python3-ujson
+
+DATADIR = Path(__file__).parent / "tests/data"
+
+
+def load_corpus(datadir: Path, count: int, seed: int) -> List[Tuple[bytes, None, str]]:
+    """Build a reproducible list of measurement tuples"""
+    samples = []
+    for fn in sorted(datadir.glob("*.json")):
+        with fn.open() as f:
+            msm = json.load(f)
+        if isinstance(msm, dict) and "test_name" in msm and "report_id" in msm:
+            samples.append(ujson.dumps(msm).encode())
+
+    assert samples, f"No measurements found in {datadir}"
+    rnd = random.Random(seed)
+    corpus = []
+    for n in range(count):
+        msmt_uid = f"20210101000000.{n:06d}_XX_benchmark_{n:016x}"
+        corpus.append((rnd.choice(samples), None, msmt_uid))
+    return corpus
+
+
+def setup_core(datadir: Path):
+    import fastpath.core as core
+
+    core.conf.no_write_to_db = True
+    with (datadir / "fingerprints_dns.json").open() as f:
+        dns_fp = json.load(f)
+    with (datadir / "fingerprints_http.json").open() as f:
+        http_fp = json.load(f)
+    core.fingerprints = core.prepare_fingerprints(dns_fp, http_fp)
+    # Do not reach for the database during the run
+    core.fingerprints_update_time = time.time() + 10**9
+    return core
+
+
+def instrument_scorers(core) -> Dict[str, List[float]]:
+    """Wrap the score_* functions in fastpath.core to record their run time"""
+    timings: Dict[str, List[float]] = {}
+
+    def wrap(name, func):
+        durations = timings.setdefault(name, [])
+
+        def timed(*a, **kw):
+            t0 = time.perf_counter()
+            try:
+                return func(*a, **kw)
+            finally:
+                durations.append(time.perf_counter() - t0)
+
+        return timed
+
+    wrapped = {}
+    for name in dir(core):
+        func = getattr(core, name)
+        if name.startswith("score_") and callable(func):
+            wrapped[func] = wrap(name, func)
+            setattr(core, name, wrapped[func])
+
+    # Scorers are dispatched through the registry, if any
+    scorers = getattr(core, "SCORERS", {})
+    for tn, func in scorers.items():
+        if func in wrapped:
+            scorers[tn] = wrapped[func]
+
+    return timings
+
+
+def percentile(values: List[float], p: float) -> float:
+    values = sorted(values)
+    idx = min(len(values) - 1, int(len(values) * p / 100))
+    return values[idx]
+
+
+def run(conf: Namespace) -> dict:
+    core = setup_core(conf.datadir)
+    corpus = load_corpus(conf.datadir, conf.count, conf.seed)
+    # Warm up caches and lazy initializations before timing
+    for msm_tup in corpus[: conf.warmup]:
+        core.process_measurement(msm_tup)
+
+    timings = instrument_scorers(core)
+    t0 = time.perf_counter()
+    for msm_tup in corpus:
+        core.process_measurement(msm_tup)
+    elapsed = time.perf_counter() - t0
+
+    scorers = {}
+    for name, durations in sorted(timings.items()):
+        if durations:
+            scorers[name] = dict(
+                count=len(durations),
+                p50_us=percentile(durations, 50) * 1e6,
+                p99_us=percentile(durations, 99) * 1e6,
+            )
+
+    # ru_maxrss is in KB on Linux
+    rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return dict(
+        count=len(corpus),
+        elapsed_s=elapsed,
+        msmt_per_s=len(corpus) / elapsed,
+        peak_rss_mb=rss_mb,
+        scorers=scorers,
+    )
+
+
+def print_report(res: dict) -> None:
+    print(f"Measurements: {res['count']}  elapsed: {res['elapsed_s']:.2f}s")
+    print(f"Throughput: {res['msmt_per_s']:.0f} msmt/s")
+    print(f"Peak RSS: {res['peak_rss_mb']:.0f} MB")
+    print(f"{'scorer':<45} {'count':>7} {'p50 us':>9} {'p99 us':>9}")
+    for name, s in res["scorers"].items():
+        print(f"{name:<45} {s['count']:>7} {s['p50_us']:>9.1f} {s['p99_us']:>9.1f}")
+
+
+def run_revision(rev: str, conf: Namespace) -> dict:
+    """Run the benchmark on a git revision exported in a temporary directory"""
+    top = subprocess.check_output(["git", "rev-parse", "--show-toplevel"], text=True)
+    top = top.strip()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        archive = subprocess.check_output(["git", "archive", rev, "fastpath"], cwd=top)
+        subprocess.run(["tar", "-x", "-C", tmpdir], input=archive, check=True)
+        pkgdir = Path(tmpdir) / "fastpath"
+        # Older revisions might not have this script
+        script = Path(tmpdir) / "benchmark.py"
+        script.write_text(Path(__file__).read_text())
+        cmd = [
+            sys.executable,
+            str(script),
+            "--json",
+            "--count",
+            str(conf.count),
+            "--warmup",
+            str(conf.warmup),
+            "--seed",
+            str(conf.seed),
+            "--datadir",
+            str(conf.datadir.resolve()),
+        ]
+        env = dict(os.environ, PYTHONPATH=str(pkgdir))
+        out = subprocess.check_output(cmd, cwd=tmpdir, env=env)
+        return json.loads(out)
+
+
+def print_comparison(rev1: str, res1: dict, rev2: str, res2: dict) -> None:
+    def delta(a: float, b: float) -> str:
+        return f"{(b - a) / a * 100:+.1f}%" if a else ""
+
+    print(f"{'':<45} {rev1[:12]:>12} {rev2[:12]:>12} {'change':>8}")
+    for k in ("msmt_per_s", "peak_rss_mb"):
+        a, b = res1[k], res2[k]
+        print(f"{k:<45} {a:>12.1f} {b:>12.1f} {delta(a, b):>8}")
+    for name in sorted(set(res1["scorers"]) | set(res2["scorers"])):
+        for k in ("p50_us", "p99_us"):
+            a = res1["scorers"].get(name, {}).get(k, 0.0)
+            b = res2["scorers"].get(name, {}).get(k, 0.0)
+            print(f"{name + ' ' + k:<45} {a:>12.1f} {b:>12.1f} {delta(a, b):>8}")
+
+
+def parse_args(args=None) -> Namespace:
+    ap = ArgumentParser(__doc__)
+    ap.add_argument("--count", type=int, default=10000, help="Corpus size")
+    ap.add_argument("--warmup", type=int, default=200)
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--datadir", type=Path, default=DATADIR)
+    ap.add_argument("--json", action="store_true", help="Output JSON")
+    ap.add_argument("--compare", nargs=2, metavar="REV", help="Compare revisions")
+    return ap.parse_args(args)
+
+
+def main() -> None:
+    conf = parse_args()
+    if conf.compare:
+        rev1, rev2 = conf.compare
+        res1 = run_revision(rev1, conf)
+        res2 = run_revision(rev2, conf)
+        print_comparison(rev1, res1, rev2, res2)
+        return
+
+    res = run(conf)
+    if conf.json:
+        print(json.dumps(res))
+    else:
+        print_report(res)
+
+
+if __name__ == "__main__":
+    main()
@@ -14,13 +14,18 @@ See README.adoc
 from argparse import ArgumentParser, Namespace
 from base64 import b64decode
 from configparser import ConfigParser
-from datetime import datetime
+from datetime import date, datetime, timedelta, timezone
 from pathlib import Path
-from typing import Any, Dict, List, TypedDict
+from queue import Empty
+from typing import Any, Callable, Dict, List, NamedTuple, Tuple, TypedDict
 import binascii
+import hashlib
 import logging
 import multiprocessing as mp
+from multiprocessing.util import Finalize
 import os
+import pickle
+import signal
 import sys
 import time
 import yaml
@@ -36,6 +41,13 @@ except ImportError:
     # this will be the case on macOS for example
     no_journal_handler = True
 
+try:
+    import simdjson  # debdeps: python3-simdjson
+
+    no_simdjson = False
+except ImportError:
+    no_simdjson = True
+
 # Feeds measurements from S3
 import fastpath.s3feeder as s3feeder
 
@@ -45,6 +57,8 @@ from fastpath.localhttpfeeder import start_http_api
 # Push measurements into Postgres
 import fastpath.db as db
 
+from fastpath.matchers import BodyMatcher, HeaderMatcher
+from fastpath.ringbuffer import RingBuffer
 from fastpath.metrics import setup_metrics
 
 from fastpath.utils import dget_or as g_or
@@ -53,13 +67,25 @@ LOCALITY_VALS = ("general", "global", "country", "isp", "local")
 
 NUM_WORKERS = 12
 
-queue = mp.Queue(NUM_WORKERS * 5)
-
 log = logging.getLogger("fastpath")
 metrics = setup_metrics(name="fastpath")
 
 conf = Namespace()
 fingerprints_update_time = 0
+# Version of the fingerprints snapshot published by the parent process,
+# shared with the workers. 0: nothing published yet
+fingerprints_version = mp.RawValue("Q", 0)
+fingerprints_loaded_version = 0
+backfill_source = None  # Can source used by each backfill worker
+backfill_stop = None  # Event set when --stop-after is reached
+worker_stopping = False  # Set by SIGTERM in real-time workers
+# Cans processed since the last checkpoint: (s3fname, measurement count).
+# Their rows might still be in the write buffers
+unflushed_cans: List[Tuple[str, int]] = []
+last_checkpoint_t = 0.0
+# Buffered rows are written and processed cans are recorded in the
+# checkpoint file at most this often
+CHECKPOINT_INTERVAL_S = 10
 
 FINGERPRINT_SCOPE_TO_LOCALITY = {
     "inst": "local",
@@ -69,6 +95,17 @@ FINGERPRINT_SCOPE_TO_LOCALITY = {
 }
 
 
+class Lane(NamedTuple):
+    name: str
+    test_names: List[str]  # ["*"] for all the test names not in other lanes
+    workers: int
+
+
+lanes: List[Lane] = []
+lane_by_test_name: Dict[str, int] = {}
+default_lane = 0
+
+
 class Fingerprint(TypedDict):
     name: str
     scope: str
@@ -80,23 +117,62 @@ class Fingerprint(TypedDict):
     expected_countries: list
 
 
-fingerprints: Dict[str, list[Fingerprint]] = dict(dns=[], http=[])
+class Fingerprints(dict):
+    """Fingerprints by location: "dns" and "http"
+    Also holds the matchers compiled from them as attributes. They are not
+    dict items and do not affect comparisons.
+    """
+
+    def __init__(self, dns: List[Fingerprint], http: List[Fingerprint]) -> None:
+        super().__init__(dns=dns, http=http)
+        # pattern -> [fingerprint, ... ]
+        self.dns_by_pattern: Dict[str, List[Fingerprint]] = {}
+        for fp in dns:
+            self.dns_by_pattern.setdefault(fp["pattern"], []).append(fp)
+        self.http_body = [fp for fp in http if fp["location_found"] == "body"]
+        self.http_body_matcher = BodyMatcher(
+            [fp["pattern"] for fp in self.http_body],
+            pattern_types=[fp["pattern_type"] for fp in self.http_body],
+        )
+        self.http_header = [
+            fp for fp in http if fp["location_found"].startswith("header.")
+        ]
+        self.http_header_matcher = HeaderMatcher(
+            [
+                (fp["location_found"][7:], fp["pattern_type"], fp["pattern"])
+                for fp in self.http_header
+            ]
+        )
+
+
+fingerprints = Fingerprints(dns=[], http=[])
 
 
 def parse_date(d: str):
     return datetime.strptime(d, "%Y-%m-%d").date()
 
 
+def parse_shard(s: str) -> Tuple[int, int]:
+    """Parse "i/N" into (i, N)"""
+    i, n = (int(x) for x in s.split("/"))
+    if not 0 <= i < n:
+        raise ValueError(f"Invalid shard {s}")
+    return i, n
+
+
 def setup_dirs(conf, root) -> None:
     """Setup directories creating them if needed"""
     conf.vardir = root / "var/lib/fastpath"
     conf.cachedir = conf.vardir / "cache"
     conf.s3cachedir = conf.cachedir / "s3"
+    conf.s3listingdir = conf.cachedir / "s3listing"
+    conf.checkpoint_file = conf.vardir / "backfill_checkpoint.jsonl"
     # conf.outdir = conf.vardir / "output"
     for p in (
         conf.vardir,
         conf.cachedir,
         conf.s3cachedir,
+        conf.s3listingdir,
     ):
         p.mkdir(parents=True, exist_ok=True)
 
@@ -125,6 +201,42 @@ def setup() -> None:
     ap.add_argument("--ccs", help="Filter comma-separated CCs when feeding from S3")
     h = "Filter comma-separated test names when feeding from S3 (without underscores)"
     ap.add_argument("--testnames", help=h)
+    h = "Download up to N cans from S3 ahead of the one being processed"
+    ap.add_argument("--prefetch-cans", type=int, default=2, help=h)
+    h = "Max size in MB of cans downloaded ahead and not yet processed"
+    ap.add_argument("--prefetch-budget-mb", type=int, default=2048, help=h)
+    h = "Read cans from a local directory with the same layout as the S3 buckets"
+    ap.add_argument("--cans-dir", type=Path, help=h)
+    h = "Download cans missing from --cans-dir from S3 and keep them there"
+    ap.add_argument("--mirror-cans", action="store_true", help=h)
+    h = "Max size in MB of the local cache of cans from S3"
+    ap.add_argument("--s3-cache-budget-mb", type=int, default=10240, help=h)
+    h = "Process only shard i of N of the cans from S3, e.g. 0/4"
+    ap.add_argument("--shard", type=parse_shard, help=h)
+    h = "Skip cans completed by a previous run of the S3 backfill"
+    ap.add_argument("--resume", action="store_true", help=h)
+    h = "Decompress and parse cans from S3 in N processes, ahead of scoring. "
+    h += "Not used with --backfill-workers"
+    ap.add_argument("--decode-workers", type=int, default=2, help=h)
+    h = "Parse legacy YAML reports from S3 in N processes. Opt-in, only used "
+    h += "with --decode-workers 0: decoder processes parse YAML themselves"
+    ap.add_argument("--yaml-workers", type=int, default=0, help=h)
+    h = "Process cans from S3 using N worker processes"
+    ap.add_argument("--backfill-workers", type=int, default=1, help=h)
+    h = "Real-time mode: write to database every N rows in each worker"
+    ap.add_argument("--write-buffer-rows", type=int, default=1000, help=h)
+    h = "Real-time mode: write buffered rows older than N milliseconds"
+    ap.add_argument("--write-buffer-ms", type=int, default=2000, help=h)
+    h = "Real-time mode: worker lanes as <name>=<test_name>,...:<workers> "
+    h += "separated by spaces. Use * for the other test names"
+    ap.add_argument("--lanes", default=f"default=*:{NUM_WORKERS}", help=h)
+    h = "Real-time mode: number of slots for measurements waiting for a worker"
+    ap.add_argument("--ring-slots", type=int, default=NUM_WORKERS * 80, help=h)
+    h = "Real-time mode: slot size in KB. Larger measurements use multiple slots"
+    ap.add_argument("--ring-slot-kb", type=int, default=64, help=h)
+    h = "Real-time mode: check the fingerprints tables every N seconds. The"
+    h += " parent process runs one small query per check, for all workers"
+    ap.add_argument("--fingerprints-refresh-s", type=int, default=5, help=h)
 
     conf = ap.parse_args()
 
@@ -170,18 +282,7 @@ def per_s(name, item_count, t0) -> None:
 @metrics.timer("clean_caches")
 def clean_caches() -> None:
     """Cleanup local caches."""
-    # Access times are updated on file load.
-    # FIXME: use cache locations correctly
-    now = time.time()
-    threshold = 3600 * 24 * 3
-    for f in conf.s3cachedir.iterdir():
-        if not f.is_file():
-            continue
-        age_s = now - f.stat().st_atime
-        if age_s > threshold:
-            log.debug("Deleting %s", f)
-            metrics.gauge("deleted_cache_file_age", age_s)
-            # TODO: delete
+    s3feeder.clean_s3_cache(conf.s3cachedir, conf.s3_cache_budget_mb * 1024 * 1024)
 
 
 # Currently unused: we could warn on missing / unexpected cols
@@ -287,11 +388,21 @@ def prepare_for_json_normalize(report) -> None:
 
 def process_measurements_from_s3() -> None:
     """Pull measurements from S3 and process them"""
+    if conf.backfill_workers > 1:
+        process_measurements_from_s3_in_parallel()
+        return
+
     db.setup_clickhouse(conf)
     update_fingerprints_if_needed()
+    global last_checkpoint_t
+    done_cans = load_backfill_checkpoint()
+    last_checkpoint_t = time.monotonic()
 
     msmt_cnt = 0
-    for measurement_tup in s3feeder.stream_cans(conf, conf.start_day, conf.end_day):
+    stream = s3feeder.stream_cans(
+        conf, conf.start_day, conf.end_day, done_cans, can_processed
+    )
+    for measurement_tup in stream:
         assert measurement_tup is not None
         assert len(measurement_tup) == 3
         msm_jstr, msm, msm_uid = measurement_tup
@@ -303,7 +414,115 @@ def process_measurements_from_s3() -> None:
             if msmt_cnt >= conf.stop_after:
                 break
 
-    db.flush_fastpath_buffer()
+    checkpoint()
+
+
+def load_backfill_checkpoint() -> set:
+    """Returns the cans to skip when resuming. Otherwise starts a new
+    checkpoint file"""
+    if conf.resume:
+        done_cans = s3feeder.load_checkpoint(conf.checkpoint_file)
+        log.info(f"Resuming: {len(done_cans)} cans already processed")
+        return done_cans
+
+    conf.checkpoint_file.write_text("")
+    return set()
+
+
+def checkpoint() -> None:
+    """Write the buffered rows, then record the processed cans as completed"""
+    global last_checkpoint_t
+    db.flush_buffers()
+    for s3fname, msmt_cnt in unflushed_cans:
+        s3feeder.mark_can_done(conf.checkpoint_file, s3fname, msmt_cnt)
+    unflushed_cans.clear()
+    last_checkpoint_t = time.monotonic()
+
+
+def can_processed(s3fname: str, msmt_cnt: int) -> None:
+    """Record a processed can. Rows are written by size in the write buffers
+    and at checkpoints: not after each can"""
+    unflushed_cans.append((s3fname, msmt_cnt))
+    if time.monotonic() - last_checkpoint_t >= CHECKPOINT_INTERVAL_S:
+        checkpoint()
+
+
+def backfill_worker_init(stop_event=None) -> None:
+    """Initialize a backfill worker process"""
+    global backfill_source, backfill_stop, last_checkpoint_t
+    # Each worker process has its own clickhouse connection and write buffers
+    db.setup_clickhouse(conf)
+    update_fingerprints_if_needed()
+    backfill_source = s3feeder.create_can_source(conf)
+    backfill_stop = stop_event
+    last_checkpoint_t = time.monotonic()
+    # Write the buffered rows when the worker exits after pool.close()
+    Finalize(None, checkpoint, exitpriority=10)
+
+
+def backfill_can(can: Tuple[str, int]) -> int:
+    """Process a can in a backfill worker. Returns the measurement count"""
+    s3fname, size = can
+    if backfill_stop is not None and backfill_stop.is_set():
+        return 0  # --stop-after reached: the can is not recorded as completed
+
+    msmt_cnt = 0
+    try:
+        for msm_tup in s3feeder.load_can(backfill_source, conf, s3fname, size):
+            process_measurement(msm_tup, buffer_writes=True)
+            msmt_cnt += 1
+        can_processed(s3fname, msmt_cnt)
+    except Exception as e:
+        log.error(str(e), exc_info=True)
+
+    update_fingerprints_if_needed()
+    return msmt_cnt
+
+
+def process_measurements_from_s3_in_parallel() -> None:
+    """Pull cans from S3 and process them using a pool of worker processes"""
+    start_day = conf.start_day
+    if not start_day or start_day >= date.today():
+        return
+
+    log.info(f"Processing cans with {conf.backfill_workers} workers")
+    t0 = time.time()
+    source = s3feeder.create_can_source(conf)
+    stop_day = s3feeder.get_stop_day(conf.end_day)
+    done_cans = load_backfill_checkpoint()
+    day = start_day
+    msmt_cnt = 0
+    # Workers skip the remaining cans once set. Cans being processed are
+    # completed: --stop-after is approximate
+    stop = mp.Event()
+    init = backfill_worker_init
+    pool = mp.Pool(conf.backfill_workers, initializer=init, initargs=(stop,))
+    try:
+        while day < stop_day and not stop.is_set():
+            log.info("Processing day %s", day)
+            cans_fns = s3feeder.list_cans(source, conf, day)
+            cans_fns = [c for c in cans_fns if c[0] not in done_cans]
+            done = pool.imap_unordered(backfill_can, cans_fns)
+            for cn, cnt in enumerate(done):
+                s3feeder._update_eta(
+                    t0, start_day, day, stop_day, cn, len(cans_fns), conf.shard
+                )
+                msmt_cnt += cnt
+                per_s("backfill_measurements", msmt_cnt, t0)
+                if conf.stop_after and msmt_cnt >= conf.stop_after:
+                    stop.set()
+
+            clean_caches()
+            s3feeder._update_eta(t0, start_day, day, stop_day, 0, 1, conf.shard)
+            day += timedelta(days=1)
+
+        # The workers write their buffered rows when exiting
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+
+    log.info(f"Processed {msmt_cnt} measurements")
 
 
 def minifp(fp: Fingerprint) -> Dict[str, Any]:
@@ -324,7 +543,7 @@ def match_http_body_fingerprints(resp, matches) -> None:
         if "data" in body and body.get("format", "") == "base64":
             log.debug("Decoding base64 body")
             body = b64decode(body["data"])
-            # returns bytes. bm.encode() below is faster that decoding it
+            # returns bytes: the matcher handles them without decoding
         else:
             logbug(2, "incorrect body of type dict", {})
             return
@@ -332,23 +551,17 @@ def match_http_body_fingerprints(resp, matches) -> None:
     if body is None:
         return
 
-    for fp in fingerprints["http"]:
-        if fp["location_found"] != "body":
-            continue
-        tb = time.time()
-        bm = fp["pattern"]
-        if isinstance(body, bytes):
-            idx = body.find(bm.encode())
-        else:
-            idx = body.find(bm)
+    tb = time.time()
+    body_fps = fingerprints.http_body
+    found = fingerprints.http_body_matcher.search(body)
+    for n in sorted(found):
+        fp = body_fps[n]
+        matches.append(minifp(fp))
+        log.debug("matched body fp %s", fp["name"])
+        # Used for statistics
+        metrics.gauge("fingerprint_body_match_location", found[n])
 
-        if idx != -1:
-            matches.append(minifp(fp))
-            log.debug("matched body fp %s", fp["name"])
-            # Used for statistics
-            metrics.gauge("fingerprint_body_match_location", idx)
-
-        per_s("fingerprints_bytes", len(body), tb)
+    per_s("fingerprints_bytes", len(body), tb)
 
 
 def match_http_headers_fingerprints(resp, matches) -> None:
@@ -357,27 +570,11 @@ def match_http_headers_fingerprints(resp, matches) -> None:
     if not headers:
         return
     headers = {h.lower(): v for h, v in headers.items()}
-    for fp in fingerprints["http"]:
-        loc_found = fp["location_found"]
-        if not loc_found.startswith("header."):
-            continue
-        pat_type = fp["pattern_type"]
-        hname = loc_found[8:]
-        if pat_type == "full":
-            if headers.get(hname) == fp["pattern"]:
-                matches.append(minifp(fp))
-                log.debug("matched header full %s", fp["name"])
-
-        elif pat_type == "prefix":
-            prefix = fp["pattern"]
-            v = headers.get(hname)
-            if isinstance(v, dict) and v.get("format") == "base64":
-                log.debug("Decoding base64 header")
-                data = b64decode(v.get("data", ""))
-                v = data.decode("latin1")
-            if isinstance(v, str) and v.startswith(prefix):
-                matches.append(minifp(fp))
-                log.debug("matched header prefix %s", fp["name"])
+    header_fps = fingerprints.http_header
+    for n in fingerprints.http_header_matcher.search(headers):
+        fp = header_fps[n]
+        matches.append(minifp(fp))
+        log.debug("matched header %s %s", fp["pattern_type"], fp["name"])
 
 
 @metrics.timer("match_fingerprints")
@@ -393,18 +590,20 @@ def match_fingerprints(measurement) -> list:
 
     matches = []
     queries = g_or(test_keys, "queries", ())
+    dns_by_pattern = fingerprints.dns_by_pattern
     for q in queries:
         for answer in g_or(q, "answers", ()):
-            for fp in fingerprints["dns"]:
-                addr = ""
-                if "ipv4" in answer:
-                    addr = answer["ipv4"]
-                elif "hostname" in answer:
-                    addr = answer["hostname"]
-                elif "ipv6" in answer:
-                    addr = answer["ipv6"]
-                if addr == fp["pattern"]:
-                    matches.append(fp)
+            addr = ""
+            if "ipv4" in answer:
+                addr = answer["ipv4"]
+            elif "hostname" in answer:
+                addr = answer["hostname"]
+            elif "ipv6" in answer:
+                addr = answer["ipv6"]
+            try:
+                matches.extend(dns_by_pattern.get(addr, ()))
+            except TypeError:
+                pass  # unhashable value: cannot be equal to a pattern
 
     requests = g_or(test_keys, "requests", ())
     for req in requests:
@@ -495,11 +694,36 @@ def _detect_unknown_failure(tk: dict) -> bool:
     return False
 
 
+# test_name -> scoring function
+SCORERS: Dict[str, Callable[[dict], dict]] = {}
+# test_name -> test_keys read by the scorer and by the database writes
+SCORER_TEST_KEYS: Dict[str, Tuple[str, ...]] = {}
+
+
+def register_scorer(test_name: str, replace=False, test_keys=None):
+    """Decorator registering a scoring function for a test_name. Scorers
+    defined outside this module, e.g. experimental ones, can be registered
+    in the same way and are used by score_measurement.
+    When test_keys lists the only keys of msm["test_keys"] used by the scorer
+    the other keys are not decoded, see decode_measurement"""
+
+    def decorator(func):
+        assert replace or test_name not in SCORERS, f"{test_name} already registered"
+        SCORERS[test_name] = func
+        if test_keys is None:
+            SCORER_TEST_KEYS.pop(test_name, None)
+        else:
+            SCORER_TEST_KEYS[test_name] = tuple(test_keys)
+        return func
+
+    return decorator
+
+
 def init_scores() -> dict:
     return {f"blocking_{lv}": 0.0 for lv in LOCALITY_VALS}
 
 
-@metrics.timer("score_measurement_facebook_messenger")
+@register_scorer("facebook_messenger")
 def score_measurement_facebook_messenger(msm: dict) -> dict:
     tk = g_or(msm, "test_keys", {})
     del msm
@@ -581,7 +805,7 @@ def _extract_tcp_connect(tk: dict) -> tuple:
     return accessible_endpoints, unreachable_endpoints
 
 
-@metrics.timer("score_measurement_telegram")
+@register_scorer("telegram")
 def score_measurement_telegram(msm: dict) -> dict:
     """Calculate measurement scoring for Telegram.
     Returns a scores dict
@@ -660,7 +884,7 @@ def score_measurement_telegram(msm: dict) -> dict:
     return scores
 
 
-@metrics.timer("score_measurement_hhfm")
+@register_scorer("http_header_field_manipulation")
 def score_measurement_hhfm(msm: dict) -> dict:
     """Calculate http_header_field_manipulation"""
     tk = g_or(msm, "test_keys", {})
@@ -732,7 +956,7 @@ def score_measurement_hhfm(msm: dict) -> dict:
     return scores
 
 
-@metrics.timer("score_http_invalid_request_line")
+@register_scorer("http_invalid_request_line")
 def score_http_invalid_request_line(msm: dict) -> dict:
     """Calculate measurement scoring for http_invalid_request_line"""
     # https://github.com/ooni/spec/blob/master/nettests/ts-007-http-invalid-request-line.md
@@ -797,7 +1021,7 @@ def get_http_header(resp, header_name, case_sensitive=False):
     return values
 
 
-@metrics.timer("score_measurement_whatsapp")
+@register_scorer("whatsapp")
 def score_measurement_whatsapp(msm: dict) -> dict:
     """Calculate measurement scoring for Whatsapp.
     Returns a scores dict
@@ -908,7 +1132,7 @@ def score_measurement_whatsapp(msm: dict) -> dict:
     return scores
 
 
-@metrics.timer("score_vanilla_tor")
+@register_scorer("vanilla_tor")
 def score_vanilla_tor(msm: dict) -> dict:
     """Calculate measurement scoring for Tor (test_name: vanilla_tor)
     Returns a scores dict
@@ -952,7 +1176,6 @@ def is_confirmed(probe_cc: str, fp: Fingerprint) -> bool:
     return False
 
 
-@metrics.timer("score_web_connectivity")
 def score_web_connectivity(msm: dict, matches: list) -> dict:
     """Calculate measurement scoring for web connectivity
     Returns a scores dict
@@ -1039,6 +1262,7 @@ def score_web_connectivity(msm: dict, matches: list) -> dict:
     return scores
 
 
+@register_scorer("web_connectivity")
 def score_web_connectivity_full(msm: dict) -> dict:
     try:
         matches = match_fingerprints(msm)
@@ -1050,7 +1274,7 @@ def score_web_connectivity_full(msm: dict) -> dict:
     return score_web_connectivity(msm, matches)
 
 
-@metrics.timer("score_ndt")
+@register_scorer("ndt", test_keys=())
 def score_ndt(msm: dict) -> dict:
     """Calculate measurement scoring for NDT
     Returns a scores dict
@@ -1059,7 +1283,7 @@ def score_ndt(msm: dict) -> dict:
     return {}
 
 
-@metrics.timer("score_tcp_connect")
+@register_scorer("tcp_connect", test_keys=("connection",))
 def score_tcp_connect(msm: dict) -> dict:
     """Calculate measurement scoring for tcp connect
     Returns a scores dict
@@ -1096,6 +1320,7 @@ def score_tcp_connect(msm: dict) -> dict:
     return scores
 
 
+@register_scorer("dash", test_keys=("failure",))
 def score_dash(msm: dict) -> dict:
     """Calculate measurement scoring for DASH
     (Dynamic Adaptive Streaming over HTTP)
@@ -1149,6 +1374,7 @@ def score_dash(msm: dict) -> dict:
     return scores
 
 
+@register_scorer("meek_fronted_requests_test")
 def score_meek_fronted_requests_test(msm: dict) -> dict:
     """Calculate measurement scoring for Meek
     Returns a scores dict
@@ -1192,6 +1418,7 @@ def score_meek_fronted_requests_test(msm: dict) -> dict:
     return scores
 
 
+@register_scorer("psiphon", test_keys=("failure", "bootstrap_time"))
 def score_psiphon(msm: dict) -> dict:
     """Calculate measurement scoring for Psiphon
     Returns a scores dict
@@ -1228,6 +1455,7 @@ def score_psiphon(msm: dict) -> dict:
     return scores
 
 
+@register_scorer("tor", test_keys=("targets",))
 def score_tor(msm: dict) -> dict:
     """Calculate measurement scoring for Tor (test_name: tor)
     https://github.com/ooni/spec/blob/master/nettests/ts-023-tor.md
@@ -1282,6 +1510,7 @@ def score_tor(msm: dict) -> dict:
     return scores
 
 
+@register_scorer("http_requests")
 def score_http_requests(msm: dict) -> dict:
     """Calculates measurement scoring for legacy test http_requests
     Returns a scores dict
@@ -1330,6 +1559,7 @@ def score_http_requests(msm: dict) -> dict:
     return scores
 
 
+@register_scorer("dns_consistency", test_keys=())
 def score_dns_consistency(msm: dict) -> dict:
     """Calculates measurement scoring for legacy test dns_consistency
     Returns a scores dict
@@ -1339,6 +1569,7 @@ def score_dns_consistency(msm: dict) -> dict:
     return scores
 
 
+@register_scorer("signal")
 def score_signal(msm: dict) -> dict:
     """Calculates measurement scoring for Signal test
     Returns a scores dict
@@ -1393,6 +1624,7 @@ def score_signal(msm: dict) -> dict:
     return scores
 
 
+@register_scorer("stunreachability", test_keys=("endpoint", "failure"))
 def score_stunreachability(msm: dict) -> dict:
     """Calculate measurement scoring for STUN reachability
     Returns a scores dict
@@ -1409,6 +1641,7 @@ def score_stunreachability(msm: dict) -> dict:
     return scores
 
 
+@register_scorer("torsf", test_keys=("failure", "bootstrap_time"))
 def score_torsf(msm: dict) -> dict:
     """Calculate measurement scoring for Tor Snowflake
     Returns a scores dict
@@ -1434,6 +1667,7 @@ def score_torsf(msm: dict) -> dict:
     return scores
 
 
+@register_scorer("riseupvpn", test_keys=())
 def score_riseupvpn(msm: dict) -> dict:
     """Calculate measurement scoring for RiseUp VPN
     Returns a scores dict
@@ -1443,6 +1677,7 @@ def score_riseupvpn(msm: dict) -> dict:
     return {}
 
 
+@register_scorer("openvpn")
 def score_openvpn(msm: dict) -> dict:
     # Based on discussion with Ain on 2022-11-09. We are going to implement
     # more complex scoring when the test is stable
@@ -1457,6 +1692,7 @@ def score_openvpn(msm: dict) -> dict:
     return scores
 
 
+@register_scorer("browser_web")
 def score_browser_web(msm: dict) -> dict:
     # https://github.com/ooni/spec/blob/master/nettests/ts-036-browser_web.md
     scores = init_scores()
@@ -1483,55 +1719,19 @@ def score_measurement(msm: dict) -> dict:
     # unclassified locality is stored in "blocking_general"
 
     tn = msm["test_name"]
-    try:
-        if tn == "telegram":
-            return score_measurement_telegram(msm)
-        if tn == "facebook_messenger":
-            return score_measurement_facebook_messenger(msm)
-        if tn == "http_header_field_manipulation":
-            return score_measurement_hhfm(msm)
-        if tn == "http_invalid_request_line":
-            return score_http_invalid_request_line(msm)
-        if tn == "whatsapp":
-            return score_measurement_whatsapp(msm)
-        if tn == "vanilla_tor":
-            return score_vanilla_tor(msm)
-        if tn == "web_connectivity":
-            return score_web_connectivity_full(msm)
-        if tn == "ndt":
-            return score_ndt(msm)
-        if tn == "tcp_connect":
-            return score_tcp_connect(msm)
-        if tn == "dash":
-            return score_dash(msm)
-        if tn == "meek_fronted_requests_test":
-            return score_meek_fronted_requests_test(msm)
-        if tn == "psiphon":
-            return score_psiphon(msm)
-        if tn == "tor":
-            return score_tor(msm)
-        if tn == "http_requests":
-            return score_http_requests(msm)
-        if tn == "dns_consistency":
-            return score_dns_consistency(msm)
-        if tn == "signal":
-            return score_signal(msm)
-        if tn == "stunreachability":
-            return score_stunreachability(msm)
-        if tn == "torsf":
-            return score_torsf(msm)
-        if tn == "riseupvpn":
-            return score_riseupvpn(msm)
-        if tn == "openvpn":
-            return score_openvpn(msm)
-        if tn == "browser_web":
-            return score_browser_web(msm)
-
+    scorer = SCORERS.get(tn)
+    if scorer is None:
         log.debug("Unsupported test name %s", tn)
+        metrics.incr("unsupported_test_name")
         scores = init_scores()
         scores["accuracy"] = 0.0
         return scores
 
+    metrics.incr(f"scored.{tn}")
+    t0 = time.perf_counter()
+    try:
+        return scorer(msm)
+
     except AssertionError as e:
         # unknown / new client bugs are often catched by assertions
         if str(e).startswith("pbug "):  # suspected probe bug
@@ -1542,6 +1742,68 @@ def score_measurement(msm: dict) -> dict:
 
         raise
 
+    finally:
+        metrics.timing(f"scorer.{tn}", (time.perf_counter() - t0) * 1000)
+
+
+def _simdjson_to_python(v):
+    if isinstance(v, simdjson.Object):
+        return v.as_dict()
+    if isinstance(v, simdjson.Array):
+        return v.as_list()
+    return v
+
+
+def decode_measurement(msm_jstr) -> dict:
+    """Decodes a JSON measurement, possibly wrapped as sent by the probes:
+    {"format": "json", "content": {...}}. If the scorer for the test_name
+    declares the test_keys it uses, only those are decoded, skipping e.g.
+    large network_events or requests lists. Otherwise decodes it in full.
+    """
+    if no_simdjson:
+        if isinstance(msm_jstr, memoryview):
+            msm_jstr = bytes(msm_jstr)
+        return ujson.loads(msm_jstr)
+
+    # A new parser for each measurement: a parser cannot be reused while
+    # objects from the previous document are referenced
+    doc = simdjson.Parser().parse(msm_jstr)
+    if not isinstance(doc, simdjson.Object):
+        return _simdjson_to_python(doc)
+
+    if sorted(doc.keys()) == ["content", "format"]:
+        content = doc["content"]
+        fmt = doc["format"]
+        if isinstance(content, simdjson.Object) and fmt.lower() == "json":
+            return dict(format=fmt, content=_decode_msmt_object(content))
+
+    return _decode_msmt_object(doc)
+
+
+def _decode_msmt_object(doc) -> dict:
+    """Decodes a measurement from a simdjson Object, partially if possible"""
+    tn = doc.get("test_name")
+    tk_names = SCORER_TEST_KEYS.get(tn) if isinstance(tn, str) else None
+    if tk_names is None:
+        return doc.as_dict()
+
+    tk = doc.get("test_keys")
+    if isinstance(tk, simdjson.Object):
+        partial = {k: _simdjson_to_python(tk[k]) for k in tk_names if k in tk}
+        if tk_names and not partial and len(tk):
+            # Keep the test_keys non-empty to preserve the scorer behavior
+            return doc.as_dict()
+
+    msm = {}
+    for k in doc.keys():
+        if k == "test_keys" and isinstance(tk, simdjson.Object):
+            msm[k] = partial
+        else:
+            msm[k] = _simdjson_to_python(doc[k])
+
+    metrics.incr("partially_decoded_measurement")
+    return msm
+
 
 def unwrap_msmt(post):
     fmt = post["format"].lower()
@@ -1551,20 +1813,114 @@ def unwrap_msmt(post):
         return yaml.safe_load(post["content"])  # TODO: test
 
 
-def msm_processor(queue):
+def setup_lanes(spec: str) -> None:
+    """Parse the --lanes option and set up the lane lookup"""
+    global lanes, lane_by_test_name, default_lane
+    lanes = []
+    lane_by_test_name = {}
+    default_lane = -1
+    for n, item in enumerate(spec.split()):
+        name, _, rest = item.partition("=")
+        test_names, _, workers = rest.rpartition(":")
+        lane = Lane(name, test_names.split(","), int(workers))
+        assert name and lane.workers > 0, f"Invalid lane {item}"
+        for tn in lane.test_names:
+            if tn == "*":
+                default_lane = n
+                continue
+            # Lanes are selected using the test name without underscores
+            tn = tn.replace("_", "")
+            assert tn not in lane_by_test_name, f"{tn} is in multiple lanes"
+            lane_by_test_name[tn] = n
+        lanes.append(lane)
+
+    assert default_lane != -1, "One lane must have test name *"
+
+
+def select_lane(msmt_uid: str) -> int:
+    """Select a lane without parsing the measurement"""
+    # See receive_measurement in the API: <time>_<cc>_<testname>_<hash>
+    # where testname has no underscores
+    parts = msmt_uid.split("_")
+    tn = parts[2] if len(parts) == 4 else ""
+    return lane_by_test_name.get(tn, default_lane)
+
+
+def msmt_uid_to_timestamp(msmt_uid: str) -> float:
+    """Returns when the API received the measurement"""
+    t = datetime.strptime(msmt_uid[:21], "%Y%m%d%H%M%S.%f")
+    return t.replace(tzinfo=timezone.utc).timestamp()
+
+
+def report_lane_latency(columns: Dict[str, list]) -> None:
+    """Emit the time from API receipt to database insert of the rows
+    written in one batch: the mean and the maximum for each lane"""
+    now = time.time()
+    deltas: Dict[str, List[float]] = {}
+    for tn, msmt_uid in zip(columns["test_name"], columns["measurement_uid"]):
+        tn = (tn or "").replace("_", "")
+        lane = lanes[lane_by_test_name.get(tn, default_lane)]
+        try:
+            delta = now - msmt_uid_to_timestamp(msmt_uid)
+        except ValueError:
+            continue  # measurement_uid not generated by the API
+        deltas.setdefault(lane.name, []).append(delta)
+
+    for name, lane_deltas in deltas.items():
+        mean = sum(lane_deltas) / len(lane_deltas)
+        metrics.timing(f"lane.{name}.latency", mean * 1000)
+        metrics.timing(f"lane.{name}.latency_max", max(lane_deltas) * 1000)
+
+
+def _worker_sigterm(signum, frame) -> None:
+    # Stop after the current measurement: the loop flushes the buffers
+    global worker_stopping
+    worker_stopping = True
+
+
+def msm_processor(ringbuf: RingBuffer, lane=0):
     """Measurement processor worker"""
+    # systemd sends SIGTERM to every process in the unit: exit cleanly
+    # without losing the buffered rows
+    signal.signal(signal.SIGTERM, _worker_sigterm)
     # Each spawned worker process has its own clickhouse connection
+    # and write buffers
     db.setup_clickhouse(conf)
-    update_fingerprints_if_needed()
+    max_age_s = conf.write_buffer_ms / 1000
+    db.configure_write_buffers(conf.write_buffer_rows, max_age_s)
+    db.fastpath_buffer.on_flush = report_lane_latency
+    load_fingerprints_snapshot_if_needed()
 
     while True:
-        msm_tup = queue.get()
-        if msm_tup is None:
+        if worker_stopping:
+            db.flush_buffers()
+            log.info("Worker with PID %d terminated", os.getpid())
+            return
+
+        try:
+            item = ringbuf.get(timeout=max_age_s, lane=lane)
+        except Empty:
+            db.flush_buffers_if_needed()
+            continue
+
+        if item is None:
+            db.flush_buffers()
             log.info("Worker with PID %d exiting", os.getpid())
             return
 
-        process_measurement(msm_tup)
-        update_fingerprints_if_needed()
+        data, msmt_uid = item
+        try:
+            measurement = decode_measurement(data)
+        except Exception as e:
+            log.exception(e)
+            metrics.incr("unhandled_exception")
+            continue
+        finally:
+            # The measurement is read in place: release its slots
+            ringbuf.release()
+
+        process_measurement((None, measurement, msmt_uid), buffer_writes=True)
+        load_fingerprints_snapshot_if_needed()
 
 
 def flag_measurements_with_wrong_date(msm: dict, msmt_uid: str, scores: dict) -> None:
@@ -1600,7 +1956,7 @@ def process_measurement(msm_tup, buffer_writes=False) -> None:
         msm_jstr, measurement, msmt_uid = msm_tup
         assert msmt_uid
         if measurement is None:
-            measurement = ujson.loads(msm_jstr)
+            measurement = decode_measurement(msm_jstr)
         if sorted(measurement.keys()) == ["content", "format"]:
             measurement = unwrap_msmt(measurement)
         rid = measurement.get("report_id")
@@ -1694,19 +2050,19 @@ def process_measurement(msm_tup, buffer_writes=False) -> None:
 
         tn = measurement.get("test_name")
         if tn == "openvpn":
-            db.clickhouse_upsert_openvpn_obs(measurement, scores, msmt_uid)
+            db.clickhouse_upsert_openvpn_obs(
+                measurement, scores, msmt_uid, buffer_writes=buffer_writes
+            )
 
     except Exception as e:
         log.exception(e)
         metrics.incr("unhandled_exception")
 
 
-def shut_down(queue):
+def shut_down(ringbuf: RingBuffer):
     log.info("Shutting down workers")
-    [queue.put(None) for n in range(NUM_WORKERS)]
-    # FIXME
-    # queue.close()
-    # queue.join_thread()
+    for n, lane in enumerate(lanes):
+        [ringbuf.put_stop(n) for _ in range(lane.workers)]
 
 
 def core():
@@ -1721,16 +2077,28 @@ def core():
         process_measurements_from_s3()
         return
 
-    # Spawn worker processes
-    # 'queue' is a singleton from the portable_queue module
+    # Fetch fingerprints before forking: workers start with the same snapshot
+    db.setup_clickhouse(conf)
+    publish_fingerprints()
+    load_fingerprints_snapshot_if_needed()
+    publisher = mp.Process(target=fingerprints_publisher, daemon=True)
+    publisher.start()
+
+    # Spawn worker processes for each lane. The ring buffer is shared with
+    # them and with the HTTP API processes
+    setup_lanes(conf.lanes)
+    lane_names = [lane.name for lane in lanes]
+    ringbuf = RingBuffer(conf.ring_slots, conf.ring_slot_kb * 1024, lane_names)
     workers = [
-        mp.Process(target=msm_processor, args=(queue,)) for n in range(NUM_WORKERS)
+        mp.Process(target=msm_processor, args=(ringbuf, n))
+        for n, lane in enumerate(lanes)
+        for _ in range(lane.workers)
     ]
     try:
         [t.start() for t in workers]
         # Start HTTP API
         log.info("Starting HTTP API")
-        start_http_api(queue)
+        start_http_api(ringbuf, select_lane)
 
     except Exception as e:
         log.exception(e)
@@ -1738,7 +2106,7 @@ def core():
     finally:
         log.info("Shutting down workers")
         time.sleep(1)
-        shut_down(queue)
+        shut_down(ringbuf)
         time.sleep(1)
         log.info("Join")
         [w.join() for w in workers]
@@ -1762,7 +2130,7 @@ def prepare_fingerprints(dns_fp, http_fp):
 
     dns = [Fingerprint(**fp) for fp in dns_fp]
     http = [Fingerprint(**fp) for fp in http_fp]
-    return dict(dns=dns, http=http)
+    return Fingerprints(dns=dns, http=http)
 
 
 def update_fingerprints_if_needed() -> None:
@@ -1791,6 +2159,74 @@ def update_fingerprints_if_needed() -> None:
     fingerprints = prepare_fingerprints(dns_fp, http_fp)
 
 
+# Real-time mode: the parent process fetches and compiles the fingerprints
+# then writes them to a file and bumps fingerprints_version. Workers load the
+# file when the version changes.
+# This saves the per-worker DB queries and matcher compilation and updates
+# the workers within seconds. It does not save memory after the first
+# update: until then the workers share the parent's copy-on-write pages,
+# afterwards each worker holds its own unpickled copy.
+
+
+def fingerprints_snapshot_path() -> Path:
+    return conf.vardir / "fingerprints.pickle"
+
+
+_published_digest = b""
+
+
+def publish_fingerprints() -> bool:
+    """Fetches the fingerprints tables and publishes a new snapshot if they
+    changed. Returns True on change."""
+    global _published_digest
+    dns_fp, http_fp = db.fetch_fingerprints()
+    raw = pickle.dumps((dns_fp, http_fp), protocol=pickle.HIGHEST_PROTOCOL)
+    digest = hashlib.sha256(raw).digest()
+    if digest == _published_digest:
+        return False
+
+    fps = prepare_fingerprints(dns_fp, http_fp)
+    path = fingerprints_snapshot_path()
+    tmpf = path.with_suffix(".tmp")
+    with tmpf.open("wb") as f:
+        pickle.dump(fps, f, protocol=pickle.HIGHEST_PROTOCOL)
+    # Workers never see a partially written file
+    tmpf.replace(path)
+    _published_digest = digest
+    fingerprints_version.value += 1
+    log.info("Published fingerprints version %d", fingerprints_version.value)
+    metrics.incr("published_fingerprints")
+    return True
+
+
+def fingerprints_publisher() -> None:
+    """Fingerprints publisher process"""
+    db.setup_clickhouse(conf)
+    while True:
+        time.sleep(conf.fingerprints_refresh_s)
+        try:
+            publish_fingerprints()
+        except Exception as e:
+            log.exception(e)
+            metrics.incr("fingerprints_publisher_error")
+
+
+def load_fingerprints_snapshot_if_needed() -> None:
+    """Loads the latest fingerprints snapshot if a new one was published.
+    Each worker unpickles its own copy: the memory is not shared"""
+    global fingerprints
+    global fingerprints_loaded_version
+
+    version = fingerprints_version.value
+    if version == fingerprints_loaded_version:
+        return
+
+    with fingerprints_snapshot_path().open("rb") as f:
+        fingerprints = pickle.load(f)
+    fingerprints_loaded_version = version
+    log.info("Loaded fingerprints version %d", version)
+
+
 def main():
     setup()
     log.info("Starting")
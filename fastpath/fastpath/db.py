@@ -10,8 +10,9 @@ See ../../oometa/017-fastpath.install.sql for the tables structure
 from datetime import datetime
 from textwrap import dedent
 from urllib.parse import urlparse
-from typing import List, Tuple, Dict, Optional
+from typing import List, Tuple, Dict, Optional, Sequence
 import logging
+import time
 
 try:
     # debdeps: python3-clickhouse-driver
@@ -27,7 +28,8 @@ log = logging.getLogger("fastpath.db")
 metrics = setup_metrics(name="fastpath.db")
 
 click_client: Clickhouse
-fastpath_row_buffer = []
+
+INSERT_ATTEMPTS = 3
 
 
 def extract_input_domain(msm: dict, test_name: str) -> Tuple[str, str]:
@@ -142,51 +144,154 @@ def setup_clickhouse(conf) -> None:
     # FIXME _click_create_table_fastpath()
 
 
-def _write_rows_to_fastpath(rows: List[Dict]):
+# Columns written by clickhouse_upsert_summary, in order
+FASTPATH_COLUMNS = (
+    "measurement_uid",
+    "report_id",
+    "input",
+    "probe_cc",
+    "probe_asn",
+    "test_name",
+    "test_start_time",
+    "measurement_start_time",
+    "scores",
+    "platform",
+    "anomaly",
+    "confirmed",
+    "msm_failure",
+    "blocking_type",
+    "domain",
+    "software_name",
+    "software_version",
+    "test_version",
+    "test_runtime",
+    "architecture",
+    "engine_name",
+    "engine_version",
+    "test_helper_address",
+    "test_helper_type",
+    "ooni_run_link_id",
+)
+
+
+def _write_rows_to_fastpath(columns: Dict[str, list]):
+    """Write rows given as {column name: [value, ... ]}"""
+    cols = ",\n".join(columns)
+    sql_insert = f"INSERT INTO fastpath (\n{cols}\n) VALUES\n"
+    _insert_rows(sql_insert, list(columns.values()), columnar=True)
+
+
+def _insert_rows(sql_insert: str, rows: List, columnar=False) -> None:
+    """Run an INSERT query. Retry with backoff on failures and eventually
+    log an error and drop the rows.
+    With columnar=True rows is a list of columns instead
+    """
     global click_client
-    sql_insert = dedent(
-        """\
-    INSERT INTO fastpath (
-    measurement_uid,
-    report_id,
-    input,
-    probe_cc,
-    probe_asn,
-    test_name,
-    test_start_time,
-    measurement_start_time,
-    scores,
-    platform,
-    anomaly,
-    confirmed,
-    msm_failure,
-    blocking_type,
-    domain,
-    software_name,
-    software_version,
-    test_version,
-    test_runtime,
-    architecture,
-    engine_name,
-    engine_version,
-    test_helper_address,
-    test_helper_type,
-    ooni_run_link_id
-    ) VALUES
-        """
-    )
     settings = {"priority": 5}
-    try:
-        click_client.execute(sql_insert, rows, settings=settings)
-    except Exception:
-        log.error("Failed Clickhouse insert", exc_info=True)
+    for attempt in range(1, INSERT_ATTEMPTS + 1):
+        try:
+            click_client.execute(sql_insert, rows, settings=settings, columnar=columnar)
+            return
+        except Exception:
+            if attempt == INSERT_ATTEMPTS:
+                log.error("Failed Clickhouse insert", exc_info=True)
+                metrics.incr("failed_insert")
+                return
+
+            log.info(f"Clickhouse insert failed, attempt {attempt}", exc_info=True)
+            metrics.incr("retried_insert")
+            time.sleep(0.5 * 2**attempt)
+
+
+class RowBuffer:
+    """Accumulates rows for a table and writes them in one INSERT when
+    max_rows rows are buffered or when the oldest row is older than
+    max_age_s. Used to avoid creating one Clickhouse part per measurement.
+    """
+
+    def __init__(self, name: str, write_func, max_rows: int, max_age_s=None):
+        self.name = name
+        self.write_func = write_func
+        self.max_rows = max_rows
+        self.max_age_s: Optional[float] = max_age_s
+        self.rows = self._new_rows()
+        self.nrows = 0
+        self.t0 = 0.0  # when the oldest row was buffered
+        # Optional function called with the rows after writing them
+        self.on_flush = None
+
+    def _new_rows(self):
+        return []
+
+    def _append_row(self, row) -> None:
+        self.rows.append(row)
+
+    def append(self, row) -> None:
+        if not self.nrows:
+            self.t0 = time.monotonic()
+        self._append_row(row)
+        self.nrows += 1
+        metrics.gauge(f"{self.name}_buffer_depth", self.nrows)
+        self.flush_if_needed()
+
+    def flush_if_needed(self) -> None:
+        if self.nrows >= self.max_rows:
+            self.flush()
+        elif self.nrows and self.max_age_s is not None:
+            if time.monotonic() - self.t0 >= self.max_age_s:
+                self.flush()
+
+    def flush(self) -> None:
+        if not self.nrows:
+            return
+        log.debug(f"Flushing {self.nrows} rows to {self.name}")
+        rows = self.rows
+        self.rows = self._new_rows()
+        self.nrows = 0
+        with metrics.timer(f"{self.name}_flush"):
+            self.write_func(rows)
+        metrics.gauge(f"{self.name}_buffer_depth", 0)
+        if self.on_flush is not None:
+            self.on_flush(rows)
+
+
+class ColumnBuffer(RowBuffer):
+    """Like RowBuffer but rows are tuples of values in the order of columns.
+    The values are appended to one list for each column and passed to
+    write_func as {column name: [value, ... ]}, ready for a columnar INSERT
+    without building a dict for each row.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        write_func,
+        columns: Sequence[str],
+        max_rows: int,
+        max_age_s=None,
+    ):
+        self.columns = tuple(columns)
+        super().__init__(name, write_func, max_rows, max_age_s)
+
+    def _new_rows(self) -> Dict[str, list]:
+        rows: Dict[str, list] = {c: [] for c in self.columns}
+        self._lists = list(rows.values())
+        return rows
+
+    def _append_row(self, row: Sequence) -> None:
+        assert len(row) == len(self._lists)
+        for values, v in zip(self._lists, row):
+            values.append(v)
+
+
+fastpath_buffer = ColumnBuffer(
+    "fastpath", _write_rows_to_fastpath, FASTPATH_COLUMNS, max_rows=10000
+)
 
 
 def flush_fastpath_buffer():
-    global fastpath_row_buffer
     log.info("Flushing fastpath buffer")
-    _write_rows_to_fastpath(fastpath_row_buffer)
-    fastpath_row_buffer = []
+    fastpath_buffer.flush()
 
 
 @metrics.timer("clickhouse_upsert_summary")
@@ -211,8 +316,9 @@ def clickhouse_upsert_summary(
     ooni_run_link_id: Optional[int],
     buffer_writes=False,
 ) -> None:
-    """Insert a row in the fastpath table. Overwrite an existing one."""
-    global fastpath_row_buffer
+    """Insert a row in the fastpath table. Overwrite an existing one.
+    Rows are buffered if buffer_writes is set
+    """
 
     def nn(features: dict, k: str) -> str:
         """Get string value and never return None"""
@@ -231,48 +337,41 @@ def clickhouse_upsert_summary(
         msm["measurement_start_time"], "%Y-%m-%d %H:%M:%S"
     )
     test_start_time = datetime.strptime(msm["test_start_time"], "%Y-%m-%d %H:%M:%S")
-    row = dict(
-        measurement_uid=measurement_uid,
-        report_id=nn(msm, "report_id"),
-        input=input_,
-        probe_cc=nn(msm, "probe_cc"),
-        probe_asn=asn,
-        test_name=test_name,
-        test_start_time=test_start_time,
-        measurement_start_time=measurement_start_time,
-        scores=ujson.dumps(scores),
-        platform=platform,
-        anomaly=tf(anomaly),
-        confirmed=tf(confirmed),
-        msm_failure=tf(msm_failure),
-        blocking_type=blocking_type,
-        domain=domain,
-        software_name=nn(msm, "software_name"),
-        software_version=nn(msm, "software_version"),
-        test_version=test_version,
-        test_runtime=test_runtime,
-        architecture=architecture,
-        engine_name=engine_name,
-        engine_version=engine_version,
-        test_helper_address=test_helper_address,
-        test_helper_type=test_helper_type,
-        ooni_run_link_id=ooni_run_link_id,
+    # Same order as FASTPATH_COLUMNS
+    row = (
+        measurement_uid,
+        nn(msm, "report_id"),
+        input_,
+        nn(msm, "probe_cc"),
+        asn,
+        test_name,
+        test_start_time,
+        measurement_start_time,
+        ujson.dumps(scores),
+        platform,
+        tf(anomaly),
+        tf(confirmed),
+        tf(msm_failure),
+        blocking_type,
+        domain,
+        nn(msm, "software_name"),
+        nn(msm, "software_version"),
+        test_version,
+        test_runtime,
+        architecture,
+        engine_name,
+        engine_version,
+        test_helper_address,
+        test_helper_type,
+        ooni_run_link_id,
     )
 
     if buffer_writes:
-        # Enabled only when multithreading is not in use
-        fastpath_row_buffer.append(row)
-        if len(fastpath_row_buffer) < 10000:
-            return
-        log.info("Writing to fastpath")
-        rows = fastpath_row_buffer
+        # Each worker process has its own buffer
+        fastpath_buffer.append(row)
     else:
-        rows = [row]
-
-    _write_rows_to_fastpath(rows)
-
-    if buffer_writes:
-        fastpath_row_buffer = []
+        columns = {c: [v] for c, v in zip(FASTPATH_COLUMNS, row)}
+        _write_rows_to_fastpath(columns)
 
     # Future feature extraction:
     # def getint(features: dict, k: str, default: int) -> int:
@@ -296,11 +395,7 @@ def clickhouse_upsert_summary(
     #     is_ssl_expected = "2"
 
 
-@metrics.timer("clickhouse_upsert_openvpn_obs")
-def clickhouse_upsert_openvpn_obs(
-    msm: dict, scores: dict, measurement_uid: str
-) -> None:
-    global click_client
+def _write_rows_to_obs_openvpn(rows: List[Dict]) -> None:
     sql_insert = dedent(
         """\
     INSERT INTO obs_openvpn (
@@ -337,6 +432,39 @@ def clickhouse_upsert_openvpn_obs(
     ) VALUES
         """
     )
+    _insert_rows(sql_insert, rows)
+
+
+openvpn_obs_buffer = RowBuffer("obs_openvpn", _write_rows_to_obs_openvpn, 10000)
+
+
+def configure_write_buffers(max_rows: int, max_age_s: Optional[float]) -> None:
+    """Set when buffered rows are written. max_age_s=None disables flushing
+    based on time"""
+    for buf in (fastpath_buffer, openvpn_obs_buffer):
+        buf.max_rows = max_rows
+        buf.max_age_s = max_age_s
+
+
+def flush_buffers_if_needed() -> None:
+    """Write buffered rows that are too old. Call this periodically"""
+    for buf in (fastpath_buffer, openvpn_obs_buffer):
+        buf.flush_if_needed()
+
+
+def flush_buffers() -> None:
+    """Write all buffered rows e.g. on shutdown"""
+    for buf in (fastpath_buffer, openvpn_obs_buffer):
+        buf.flush()
+
+
+@metrics.timer("clickhouse_upsert_openvpn_obs")
+def clickhouse_upsert_openvpn_obs(
+    msm: dict, scores: dict, measurement_uid: str, buffer_writes=False
+) -> None:
+    """Insert a row in the obs_openvpn table.
+    Rows are buffered if buffer_writes is set
+    """
 
     def nn(d: dict, k: str) -> str:
         """Get string value and never return None"""
@@ -404,11 +532,10 @@ def clickhouse_upsert_openvpn_obs(
         transport=nn(tk, "transport"),
     )
 
-    settings = {"priority": 5}
-    try:
-        click_client.execute(sql_insert, [row], settings=settings)
-    except Exception:
-        log.error("Failed Clickhouse insert", exc_info=True)
+    if buffer_writes:
+        openvpn_obs_buffer.append(row)
+    else:
+        _write_rows_to_obs_openvpn([row])
 
 
 def query(query: str, query_params: dict, query_prio=5):
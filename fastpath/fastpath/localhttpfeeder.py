@@ -3,8 +3,13 @@
 
 """
 Receive measurements by listening on localhost
+
+POST /<msmt_uid> with the measurement as body, or
+POST /batch with many "<msmt_uid>\\t<measurement>\\n" records as body
 """
 
+from typing import List, Tuple
+
 from gunicorn.app.base import BaseApplication
 
 API_PORT = 8472
@@ -25,17 +30,47 @@ class MsmtFeeder(BaseApplication):
         return self.application
 
 
-def start_http_api(queue):
+def parse_uid(uid: bytes) -> str:
+    """Decode and validate a msmt_uid. Raises ValueError"""
+    msmt_uid = uid.decode()
+    if not msmt_uid.startswith("2"):
+        raise ValueError(f"Invalid msmt_uid {msmt_uid!r}")
+    return msmt_uid
+
+
+def parse_batch(data: bytes) -> List[Tuple[bytes, None, str]]:
+    """Parse newline-delimited "<msmt_uid>\\t<measurement>" records.
+    The whole batch is validated: raises ValueError on any invalid record
+    """
+    batch = []
+    for line in data.split(b"\n"):
+        if not line:
+            continue
+        uid, tab, msm = line.partition(b"\t")
+        if not tab or not msm:
+            raise ValueError("Invalid batch record")
+        batch.append((msm, None, parse_uid(uid)))
+    return batch
+
+
+def start_http_api(ringbuf, select_lane=lambda msmt_uid: 0):
 
     def handler_app(environ, start_response):
         if environ["REQUEST_METHOD"] == "POST":
-            # TODO:pass msmt_uid
             path = environ["PATH_INFO"]
-            assert path.startswith("/2")
-            msmt_uid = path[1:]
             data = environ["wsgi.input"].read()
-            msm_tup = (data, None, msmt_uid)
-            queue.put(msm_tup, block=True)
+            # Validate the request before enqueueing any measurement
+            try:
+                if path == "/batch":
+                    batch = parse_batch(data)
+                else:
+                    batch = [(data, None, parse_uid(path[1:].encode()))]
+            except ValueError as e:
+                start_response("400 Bad Request", [("Content-Type", "text/plain")])
+                return [str(e).encode()]
+
+            for msm, _, msmt_uid in batch:
+                ringbuf.put(msm, msmt_uid, select_lane(msmt_uid))
 
         start_response("200 OK", [])
         return [b""]
@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compiled matchers used to look up fingerprints in measurements
+
+The matchers are built once when the fingerprints are loaded and then used
+on every measurement.
+"""
+
+from base64 import b64decode
+from typing import Dict, List, Optional, Tuple, Union
+import logging
+import re
+
+try:
+    import ahocorasick  # debdeps: python3-ahocorasick
+
+    no_ahocorasick = False
+except ImportError:
+    no_ahocorasick = True
+
+log = logging.getLogger("fastpath.matchers")
+
+
+# Characters with a special meaning in regexps
+_REGEXP_META = set(".^$*+?{}[]|()\\")
+
+
+def regexp_literal_prefix(regexp: str) -> str:
+    """Returns a string that starts every match of the regexp, possibly
+    empty
+    """
+    if "|" in regexp:
+        return ""  # alternatives might start differently
+
+    out = []
+    i = 0
+    while i < len(regexp):
+        c = regexp[i]
+        if c == "\\":
+            # Escaped punctuation is a literal, \d \s etc. are not
+            if i + 1 == len(regexp) or regexp[i + 1].isalnum():
+                break
+            c = regexp[i + 1]
+            i += 2
+        elif c in _REGEXP_META:
+            break
+        else:
+            i += 1
+
+        quantifier = regexp[i : i + 1]
+        if quantifier and quantifier in "*?{":
+            break  # the character is optional
+        out.append(c)
+        if quantifier == "+":
+            break
+
+    return "".join(out)
+
+
+class BodyMatcher:
+    """Find which of many patterns occur in an HTTP body.
+    Bodies can be str or bytes. Pattern types are "contains" (the default),
+    "full", "prefix" and "regexp". Patterns of other types are ignored.
+
+    When pyahocorasick is available each body is scanned only once for all
+    the "contains" patterns, otherwise each pattern is searched in turn.
+    The same scan looks for the literal prefix of each regexp, e.g.
+    "Set-Cookie:" for "Set-Cookie:.*domain=": a regexp is only run from
+    where its prefix is found.
+    Regexps are compiled for str bodies. They are compiled for bytes bodies,
+    on the UTF-8 encoding of the pattern, only when a bytes body is searched.
+    """
+
+    def __init__(
+        self,
+        patterns: List[str],
+        use_automaton=True,
+        pattern_types: Optional[List[str]] = None,
+    ) -> None:
+        self.patterns = patterns
+        if pattern_types is None:
+            pattern_types = ["contains"] * len(patterns)
+        self.pattern_types = pattern_types
+        self.use_automaton = use_automaton and not no_ahocorasick
+        # [(pattern number, pattern), ... ] by pattern type
+        by_type: Dict[str, List[Tuple[int, str]]] = {}
+        for n, (t, p) in enumerate(zip(pattern_types, patterns)):
+            by_type.setdefault(t, []).append((n, p))
+
+        self._contains = by_type.get("contains", [])
+        # bytes bodies are searched for the UTF-8 encoding of the patterns
+        self._bcontains = [(n, p.encode()) for n, p in self._contains]
+        # An empty pattern is found at the beginning of any body
+        self._empty = [n for n, p in self._contains if p == ""]
+        self._full = by_type.get("full", [])
+        self._prefix = by_type.get("prefix", [])
+        self._bfull = [(n, p.encode()) for n, p in self._full]
+        self._bprefix = [(n, p.encode()) for n, p in self._prefix]
+
+        # pattern number -> regexp
+        self._regexps: Dict[int, re.Pattern] = {}
+        # pattern number -> bytes regexp or None if it does not compile
+        self._bregexps: Optional[Dict[int, Optional[re.Pattern]]] = None
+        # [(pattern number, literal prefix), ... ] of the regexps
+        triggers: List[Tuple[int, str]] = []
+        for n, p in by_type.get("regexp", []):
+            try:
+                self._regexps[n] = re.compile(p)
+            except re.error as e:
+                log.error(f"Ignoring invalid regexp pattern {p!r}: {e}")
+                continue
+            if self.use_automaton:
+                triggers.append((n, regexp_literal_prefix(p)))
+
+        # Regexps without a literal prefix are always run
+        self._untriggered = [n for n in self._regexps]
+        if self.use_automaton:
+            self._untriggered = [n for n, lit in triggers if lit == ""]
+            self._str_ac = self._build(self._contains, triggers)
+            # Decoding bytes as latin1 maps each byte to one character: the
+            # match positions do not change
+            latin = [(n, bp.decode("latin1")) for n, bp in self._bcontains]
+            btriggers = [(n, lit.encode().decode("latin1")) for n, lit in triggers]
+            self._bytes_ac = self._build(latin, btriggers)
+
+    @staticmethod
+    def _build(patterns: List[Tuple[int, str]], triggers: List[Tuple[int, str]]):
+        # word -> (indexes of the patterns using it, indexes of the regexps
+        # starting with it)
+        by_word: Dict[str, Tuple[List[int], List[int]]] = {}
+        for n, p in patterns:
+            if p:
+                by_word.setdefault(p, ([], []))[0].append(n)
+        for n, lit in triggers:
+            if lit:
+                by_word.setdefault(lit, ([], []))[1].append(n)
+
+        ac = ahocorasick.Automaton()
+        for w, (nums, regexps) in by_word.items():
+            ac.add_word(w, (len(w), nums, regexps))
+        ac.make_automaton()
+        return ac
+
+    def search(self, body: Union[str, bytes]) -> Dict[int, int]:
+        """Returns {pattern number: index of the first match in body}"""
+        if self.use_automaton:
+            found, triggered = self._search_automaton(body)
+        else:
+            found, triggered = self._search_each(body), {}
+
+        is_bytes = isinstance(body, bytes)
+        for n, p in self._bfull if is_bytes else self._full:
+            if body == p:
+                found[n] = 0
+        for n, p in self._bprefix if is_bytes else self._prefix:
+            if body.startswith(p):
+                found[n] = 0
+
+        for n in self._untriggered:
+            triggered[n] = 0
+        regexps = self._bytes_regexps() if is_bytes else self._regexps
+        for n, start in triggered.items():
+            r = regexps[n]
+            if r is None:
+                continue
+            m = r.search(body, start)
+            if m is not None:
+                found[n] = m.start()
+
+        return found
+
+    def _bytes_regexps(self) -> Dict[int, Optional[re.Pattern]]:
+        if self._bregexps is None:
+            self._bregexps = {}
+            for n, r in self._regexps.items():
+                try:
+                    self._bregexps[n] = re.compile(r.pattern.encode())
+                except re.error as e:
+                    log.error(f"Regexp {r.pattern!r} not usable on bytes: {e}")
+                    self._bregexps[n] = None
+        return self._bregexps
+
+    def _search_automaton(
+        self, body: Union[str, bytes]
+    ) -> Tuple[Dict[int, int], Dict[int, int]]:
+        """Returns {pattern number: index of the first match},
+        {regexp number: index of the first literal prefix}
+        """
+        found = {n: 0 for n in self._empty}
+        triggered: Dict[int, int] = {}
+        if isinstance(body, bytes):
+            ac = self._bytes_ac
+            body = body.decode("latin1")
+        else:
+            ac = self._str_ac
+
+        if len(ac) == 0:
+            return found, triggered
+
+        # Matches are yielded by increasing end position: for a given
+        # pattern the first one is also the leftmost one
+        for end, (plen, nums, regexps) in ac.iter(body):
+            for n in nums:
+                if n in found:
+                    break
+                found[n] = end - plen + 1
+            for n in regexps:
+                if n in triggered:
+                    break
+                triggered[n] = end - plen + 1
+
+        return found, triggered
+
+    def _search_each(self, body: Union[str, bytes]) -> Dict[int, int]:
+        pats = self._bcontains if isinstance(body, bytes) else self._contains
+        found = {}
+        for n, p in pats:
+            idx = body.find(p)
+            if idx != -1:
+                found[n] = idx
+
+        return found
+
+
+class HeaderMatcher:
+    """Index of HTTP header patterns by lowercase header name.
+    "full" patterns are looked up in a dict of exact values and "prefix"
+    patterns in a trie. "contains" and "regexp" patterns are compiled in a
+    BodyMatcher for each header name. Patterns of other types are ignored.
+    The lookup cost depends on the number of headers in a response and the
+    length of their values, not on the number of patterns.
+    """
+
+    _END = None  # trie key holding the pattern numbers ending at a node
+
+    def __init__(self, patterns: List[Tuple[str, str, str]]) -> None:
+        """patterns: [(header name, pattern type, pattern), ... ]"""
+        # header name -> {value: [pattern number, ... ]}
+        self._full: Dict[str, Dict[str, List[int]]] = {}
+        # header name -> trie
+        self._prefix: Dict[str, dict] = {}
+        # header name -> [(pattern number, pattern type, pattern), ... ]
+        others: Dict[str, List[Tuple[int, str, str]]] = {}
+        for n, (hname, pat_type, pat) in enumerate(patterns):
+            hname = hname.lower()
+            if pat_type == "full":
+                self._full.setdefault(hname, {}).setdefault(pat, []).append(n)
+            elif pat_type == "prefix":
+                node = self._prefix.setdefault(hname, {})
+                for c in pat:
+                    node = node.setdefault(c, {})
+                node.setdefault(self._END, []).append(n)
+            elif pat_type in ("contains", "regexp"):
+                others.setdefault(hname, []).append((n, pat_type, pat))
+
+        # header name -> (matcher, [pattern number, ... ])
+        self._matchers: Dict[str, Tuple[BodyMatcher, List[int]]] = {}
+        for hname, items in others.items():
+            nums = [n for n, t, p in items]
+            types = [t for n, t, p in items]
+            m = BodyMatcher([p for n, t, p in items], pattern_types=types)
+            self._matchers[hname] = (m, nums)
+
+    def search(self, headers: dict) -> List[int]:
+        """Takes headers with lowercase names.
+        Returns the sorted numbers of the matching patterns
+        """
+        found: List[int] = []
+        for hname, v in headers.items():
+            values = self._full.get(hname)
+            if values is not None:
+                try:
+                    found.extend(values.get(v, ()))
+                except TypeError:
+                    pass  # unhashable value
+
+            node = self._prefix.get(hname)
+            matcher = self._matchers.get(hname)
+            if node is None and matcher is None:
+                continue
+
+            if isinstance(v, dict) and v.get("format") == "base64":
+                v = b64decode(v.get("data", ""))
+            if not isinstance(v, (str, bytes)):
+                continue
+
+            if matcher is not None:
+                m, nums = matcher
+                found.extend(nums[i] for i in m.search(v))
+
+            if node is None:
+                continue
+
+            if isinstance(v, bytes):
+                v = v.decode("latin1")
+            found.extend(node.get(self._END, ()))
+            for c in v:
+                node = node.get(c)
+                if node is None:
+                    break
+                found.extend(node.get(self._END, ()))
+
+        found.sort()
+        return found
@@ -2,21 +2,40 @@
 # Normalize YAML reports
 #
 
+from collections import Counter
 from datetime import datetime
-from itertools import groupby
+from itertools import groupby, islice
 import functools
 import hashlib
 import logging
+import multiprocessing as mp
 import re
 import string
 import uuid
 
 import yaml
 
+try:
+    import numpy as np  # debdeps: python3-numpy
+
+    no_numpy = False
+except ImportError:
+    no_numpy = True
+
 from fastpath.utils import trivial_id
 
 log = logging.getLogger("normalize")
 
+# LibYAML bindings are not always available
+CSafeLoader = getattr(yaml, "CSafeLoader", None)
+
+# Optional pool of processes parsing YAML entries, see start_yaml_pool.
+# It is opt-in: it is only used when cans are decoded in the main process
+# (--decode-workers 0 --yaml-workers N). Decoder processes parse the YAML
+# of their cans themselves.
+yaml_pool = None
+YAML_POOL_CHUNK = 256
+
 
 class UnsupportedTestError(Exception):
     pass
@@ -138,11 +157,15 @@ regexps = dict(
 simhash_re = re.compile(r"[\w\u4e00-\u9fcc]+")
 
 
-def gen_simhash(s):
+def _simhash_features(s):
     content = s.lower()
     content = "".join(re.findall(simhash_re, content))
     mx = max(len(content) - 4 + 1, 1)
-    features = [content[i : i + 4] for i in range(mx)]
+    return [content[i : i + 4] for i in range(mx)]
+
+
+def gen_simhash_py(s):
+    features = _simhash_features(s)
     features = ((k, sum(1 for _ in g)) for k, g in groupby(sorted(features)))
     v = [0] * 64
     masks = [1 << i for i in range(64)]
@@ -158,6 +181,26 @@ def gen_simhash(s):
     return ans
 
 
+def gen_simhash_np(s):
+    features = Counter(_simhash_features(s))
+    # Only the lower 64 bits of each MD5 hash are used: the last 8 bytes
+    # of the digest, in big endian order
+    digests = b"".join(
+        hashlib.md5(f.encode("utf-8")).digest()[8:] for f in features
+    )
+    rows = np.frombuffer(digests, dtype=np.uint8).reshape(-1, 8)[:, ::-1]
+    # bits[n, i] is bit i of the hash of feature n
+    bits = np.unpackbits(rows, axis=1, bitorder="little")
+    weights = np.fromiter(features.values(), dtype=np.int64, count=len(features))
+    # Sum of +w where the bit is set and -w where it is not
+    v = 2 * (weights @ bits) - weights.sum()
+    ans = np.packbits(v > 0, bitorder="little")
+    return int.from_bytes(ans.tobytes(), "little")
+
+
+gen_simhash = gen_simhash_py if no_numpy else gen_simhash_np
+
+
 ### Normalize entries across format versions ###
 
 
@@ -590,6 +633,65 @@ def generate_report_id(header):
     return report_id
 
 
+def safe_load(raw):
+    """Parses YAML using LibYAML when available. Falls back to the pure
+    Python loader on any error: errors and their handling stay the same
+    """
+    if CSafeLoader is not None:
+        try:
+            return yaml.load(raw, Loader=CSafeLoader)
+        except yaml.YAMLError:
+            pass
+
+    return yaml.safe_load(raw)
+
+
+def _safe_load_entry(raw_entry):
+    # Runs in the pool: parsing errors are handled by the caller
+    try:
+        return True, safe_load(raw_entry)
+    except Exception:
+        return False, None
+
+
+def start_yaml_pool(nprocs: int) -> None:
+    """Parse YAML entries in a pool of processes"""
+    global yaml_pool
+    if nprocs > 0 and yaml_pool is None:
+        yaml_pool = mp.Pool(nprocs)
+
+
+def stop_yaml_pool() -> None:
+    global yaml_pool
+    if yaml_pool is not None:
+        yaml_pool.close()
+        yaml_pool.join()
+        yaml_pool = None
+
+
+def iter_yaml_entries(blobgen):
+    """Yields (off, raw_entry, (entry,) or None) where None means that
+    the entry failed to parse in the pool and has to be parsed again in
+    the caller to handle the error
+    """
+    if yaml_pool is None or mp.current_process().daemon:
+        for off, raw_entry in blobgen:
+            yield off, raw_entry, None
+        return
+
+    # Parse in chunks in the same order to bound memory usage
+    while True:
+        chunk = list(islice(blobgen, YAML_POOL_CHUNK))
+        if not chunk:
+            return
+        parsed = yaml_pool.map(_safe_load_entry, [raw for off, raw in chunk])
+        for (off, raw_entry), (ok, entry) in zip(chunk, parsed):
+            if ok:
+                yield off, raw_entry, (entry,)
+            else:
+                yield off, raw_entry, None
+
+
 ## Entry points
 
 
@@ -604,7 +706,7 @@ def iter_yaml_msmt_normalized(data, bucket_tstamp: str, report_fn: str):
     off, header = next(blobgen)
     headsha = hashlib.sha1(header)
     # XXX: bad header kills whole bucket
-    header = yaml.safe_load(header)
+    header = safe_load(header)
     if isinstance(header.get("probe_city"), bytes):
         header["probe_city"] = header["probe_city"].decode(errors="ignore")
 
@@ -612,12 +714,12 @@ def iter_yaml_msmt_normalized(data, bucket_tstamp: str, report_fn: str):
     if not header.get("report_id"):
         header["report_id"] = generate_report_id(header)
 
-    for off, raw_entry in blobgen:
+    for off, raw_entry, parsed in iter_yaml_entries(blobgen):
         esha = headsha.copy()
         esha.update(raw_entry)
         esha_d = esha.digest()
         try:
-            entry = yaml.safe_load(raw_entry)
+            entry = parsed[0] if parsed else safe_load(raw_entry)
         except yaml.constructor.ConstructorError:
             rid = header["report_id"]
             log.info(f"YAML construction error {rid}")
@@ -20,6 +20,16 @@ PYTHONPATH=. ./fastpath/reprocessor.py ooni-data ooni-data-eu-fra-test --day 201
 
 Note: the bundling of measurements into jsonl gz files has to remain deterministic
 
+Measurements are buffered in chunks of JSONL_CHUNK_SIZE for each open jsonl
+file. Chunks are compressed in a thread pool, as zlib releases the GIL, and
+in order into a single gzip stream for each file: the files have the same
+size as the ones written by earlier runs, as compared by s3_check. Complete
+files are uploaded by a thread pool while the main thread keeps processing
+cans.
+The contents and names of the jsonl files do not depend on the order in
+which the pools complete. The jsonl table rows are inserted in batches
+after the related files are uploaded.
+
 DB update:
 
 BEGIN;
@@ -33,25 +43,36 @@ CREATE INDEX CONCURRENTLY jsonl_measurement_uid ON jsonl (measurement_uid);
 """
 
 from argparse import ArgumentParser
-from dataclasses import dataclass
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta
 from os import getenv
 from pathlib import Path
+from typing import Dict, List, Optional, Tuple
 import gzip
 import hashlib
 import logging
 import os
+import threading
 import time
 
 import json
-import psycopg2  # debdeps: python3-psycopg2
-from psycopg2.extras import execute_values
 import statsd  # debdeps: python3-statsd
 
+try:
+    import psycopg2  # debdeps: python3-psycopg2
+    from psycopg2.extras import execute_values
+
+    no_psycopg2 = False
+except ImportError:
+    no_psycopg2 = True
+
 import fastpath.db as db
 import fastpath.s3feeder as s3f
 from fastpath.db import extract_input_domain
-from fastpath.core import score_measurement, setup_fingerprints, unwrap_msmt
+from fastpath.uidset import UIDSet
+from fastpath.core import score_measurement, update_fingerprints_if_needed, unwrap_msmt
 
 metrics = statsd.StatsClient("127.0.0.1", 8125, prefix="reprocessor")
 log = logging.getLogger("reprocessor")
@@ -61,9 +82,24 @@ for lo in ("urllib3", "botocore", "s3transfer", "boto"):
     logging.getLogger(lo).setLevel(logging.INFO)
 
 import boto3
+from boto3.s3.transfer import TransferConfig
 import botocore.exceptions
 
 stats = dict(files_uploaded=0, files_size_mismatch=0, files_generated=0, t0=0)
+# stats are updated by the upload threads
+stats_lock = threading.Lock()
+
+# Size of uncompressed jsonl files
+JSONL_THRESHOLD = 20 * 1024 * 1024
+# Uncompressed data compressed at once, buffered in memory for each open
+# jsonl file
+JSONL_CHUNK_SIZE = 128 * 1024
+# Rows inserted in the jsonl table at once, from many jsonl files
+JSONL_INSERT_BATCH_ROWS = 50_000
+# Upload in parts streamed from disk instead of reading whole files
+S3_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024, multipart_chunksize=8 * 1024 * 1024
+)
 
 
 def create_s3_client(conf):
@@ -112,8 +148,9 @@ def update_jsonl_clickhouse_table(conn, lookup_list, jsonl_mode):
 def upload_to_s3(s3, bucket_name: str, tarf: Path, s3path: str) -> None:
     obj = s3.Object(bucket_name, s3path)
     log.info(f"Uploading {tarf} to {s3path}")
-    obj.put(Body=tarf.read_bytes())
-    stats["files_uploaded"] += 1
+    obj.upload_file(str(tarf), Config=S3_TRANSFER_CONFIG)
+    with stats_lock:
+        stats["files_uploaded"] += 1
 
 
 def s3_check(s3, bucket_name, local_file, s3path) -> str:
@@ -130,7 +167,8 @@ def s3_check(s3, bucket_name, local_file, s3path) -> str:
     disk_size = local_file.stat().st_size
     if disk_size != size:
         log.info(f"Size difference: {size} {disk_size} {size - disk_size}")
-        stats["files_size_mismatch"] += 1
+        with stats_lock:
+            stats["files_size_mismatch"] += 1
         return "different"
 
     log.info("File found")
@@ -167,7 +205,21 @@ def parse_args():
     )
     ap.add_argument("--db-uri")
     ap.add_argument("--clickhouse-url")
+    h = "Compress jsonl files using N threads"
+    ap.add_argument("--compress-workers", type=int, default=os.cpu_count(), help=h)
+    h = "Upload up to N jsonl files to S3 at the same time"
+    ap.add_argument("--upload-workers", type=int, default=8, help=h)
+    h = "Memory used to detect duplicate measurements in MB"
+    ap.add_argument("--seen-uids-max-mb", type=int, default=1024, help=h)
+    h = "Read cans from a local directory with the same layout as the S3 buckets"
+    ap.add_argument("--cans-dir", type=Path, help=h)
     c = ap.parse_args()
+    # Cans downloaded from S3 are stored under ./canned/ and deleted after
+    # processing
+    c.s3cachedir = Path("canned")
+    c.keep_s3_cache = False
+    c.prefetch_cans = 0
+    c.prefetch_budget_mb = 0
 
     return c
 
@@ -199,20 +251,167 @@ def score_measurement_and_upsert_fastpath(msm, msmt_uid, do_update: bool) -> Non
 
 @dataclass
 class Entity:
-    jsonlf: Path
+    jsonlf: Path  # compressed file
     fd: gzip.GzipFile
+    size: int
     jsonl_s3path_base: str
     lookup_list: list
+    chunk: list = field(default_factory=list)  # lines not compressed yet
+    chunk_size: int = 0
+    compressing: Optional[Future] = None  # last chunk submitted
+
+
+def compress_chunk(fd: gzip.GzipFile, data: bytes, prev: Optional[Future]) -> None:
+    """Runs in the compression pool. Chunks are written to the gzip stream
+    of a file in order: wait for the previous one"""
+    if prev is not None:
+        prev.result()
+    fd.write(data)
+
+
+class JsonlPipeline:
+    """Compresses chunks of jsonl files in a process pool and uploads the
+    complete files from a thread pool. Inserts rows in the jsonl table in
+    batches once the files are uploaded.
+    """
+
+    def __init__(self, db_conn, conf) -> None:
+        self.db_conn = db_conn
+        self.conf = conf
+        self.compress_pool = ThreadPoolExecutor(conf.compress_workers)
+        self.upload_pool = ThreadPoolExecutor(conf.upload_workers)
+        # Limit the chunks waiting in memory to be compressed
+        self.max_chunks = conf.compress_workers * 4
+        self.chunks: deque = deque()  # Futures, in submission order
+        # Limit the complete jsonl files waiting on disk
+        self.max_pending = conf.compress_workers + conf.upload_workers
+        self.pending: List[Tuple[Future, Entity]] = []
+        self.lookup_rows: list = []
+        self.files: Dict[Path, Entity] = {}  # jsonl files not yet uploaded
+        # boto3 resources are not thread safe: one client for each thread
+        self._local = threading.local()
+
+    def open_entity(self, jsonlf: Path, jsonl_s3path_base: str) -> Entity:
+        e = Entity(
+            jsonlf=jsonlf,
+            fd=gzip.open(jsonlf, "wb"),
+            size=0,
+            jsonl_s3path_base=jsonl_s3path_base,
+            lookup_list=[],
+        )
+        self.files[jsonlf] = e
+        return e
+
+    def write(self, e: Entity, line: bytes) -> None:
+        e.chunk.append(line)
+        e.chunk_size += len(line)
+        e.size += len(line)
+        if e.chunk_size >= JSONL_CHUNK_SIZE:
+            self._compress_chunk(e)
+
+    def _compress_chunk(self, e: Entity) -> None:
+        if e.chunk:
+            data = b"".join(e.chunk)
+            args = (compress_chunk, e.fd, data, e.compressing)
+            e.compressing = self.compress_pool.submit(*args)
+            self.chunks.append(e.compressing)
+            e.chunk = []
+            e.chunk_size = 0
+        self._collect_chunks()
+
+    def _collect_chunks(self) -> None:
+        """Drop the compressed chunks. Waits for the oldest chunk when too
+        many are pending"""
+        while self.chunks:
+            fut = self.chunks[0]
+            if not fut.done() and len(self.chunks) <= self.max_chunks:
+                return
+            fut.result()  # raise exceptions from the pool
+            self.chunks.popleft()
+
+    def close_entity(self, e: Entity) -> None:
+        """Compress the last chunks and close the file"""
+        self._compress_chunk(e)
+        if e.compressing is not None:
+            e.compressing.result()
+        e.fd.close()
+
+    def submit(self, e: Entity, jsonl_s3path: str) -> None:
+        fut = self.upload_pool.submit(self._upload, e, jsonl_s3path)
+        self.pending.append((fut, e))
+        self.collect(wait=len(self.pending) > self.max_pending)
+
+    @metrics.timer("upload_jsonl")
+    def _upload(self, e: Entity, jsonl_s3path: str) -> None:
+        conf = self.conf
+        if conf.s3mode == "dryrun":
+            e.jsonlf.unlink()
+            return
+
+        s3sig = getattr(self._local, "s3sig", None)
+        if s3sig is None:
+            s3sig = self._local.s3sig = create_s3_client(conf)
+
+        if conf.s3mode == "create":
+            upload_to_s3(s3sig, conf.dst_bucket, e.jsonlf, jsonl_s3path)
+        elif conf.s3mode == "check":
+            s3_check(s3sig, conf.dst_bucket, e.jsonlf, jsonl_s3path)
+        elif conf.s3mode == "create-if-needed":
+            s3status = s3_check(s3sig, conf.dst_bucket, e.jsonlf, jsonl_s3path)
+            if s3status == "not-found":
+                upload_to_s3(s3sig, conf.dst_bucket, e.jsonlf, jsonl_s3path)
+
+        e.jsonlf.unlink()
+
+    def collect(self, wait=False) -> None:
+        """Collect completed uploads. With wait=True wait for the oldest one"""
+        still_pending = []
+        for n, (fut, e) in enumerate(self.pending):
+            if wait and n == 0:
+                fut.result()
+            if not fut.done():
+                still_pending.append((fut, e))
+                continue
+            fut.result()  # raise exceptions from the pools
+            del self.files[e.jsonlf]
+            self.lookup_rows.extend(e.lookup_list)
+
+        self.pending = still_pending
+        metrics.gauge("pending_jsonl_files", len(self.pending))
+        if len(self.lookup_rows) >= JSONL_INSERT_BATCH_ROWS:
+            self.insert_lookup_rows()
+
+    def insert_lookup_rows(self) -> None:
+        if self.lookup_rows:
+            jsonlmode = self.conf.jsonlmode
+            update_jsonl_clickhouse_table(self.db_conn, self.lookup_rows, jsonlmode)
+            self.lookup_rows = []
+
+    def close(self) -> None:
+        """Wait for all the uploads and insert the remaining rows"""
+        while self.pending:
+            self.collect(wait=True)
+        self.insert_lookup_rows()
+        self.shutdown()
+
+    def shutdown(self) -> None:
+        """Stop the pools and delete the jsonl files not uploaded, if any"""
+        self.upload_pool.shutdown(cancel_futures=True)
+        self.compress_pool.shutdown(cancel_futures=True)
+        for jsonlf, e in self.files.items():
+            e.fd.close()
+            jsonlf.unlink(missing_ok=True)
+        self.files = {}
 
 
 @metrics.timer("finalize_jsonl")
-def finalize_jsonl(s3sig, db_conn, conf, e: Entity) -> None:
-    """For each JSONL file we do one upload to S3 and one
-    INSERT query with many rows
+def finalize_jsonl(pipeline: JsonlPipeline, e: Entity) -> None:
+    """For each JSONL file we do one upload to S3. Rows for the jsonl table
+    are inserted in batches by the pipeline
     """
-    jsize = int(e.fd.offset / 1024)
+    jsize = int(e.size / 1024)
     log.info(f"Closing and preparing {e.jsonlf} Size: {jsize} KB")
-    e.fd.close()
+    pipeline.close_entity(e)
 
     # Calculate unique hash
     # update e.lookup_list
@@ -229,27 +428,15 @@ def finalize_jsonl(s3sig, db_conn, conf, e: Entity) -> None:
         e.lookup_list[n][3] = jsonl_s3path
 
     stats["files_generated"] += 1
-    if conf.s3mode == "create":
-        upload_to_s3(s3sig, conf.dst_bucket, e.jsonlf, jsonl_s3path)
-    elif conf.s3mode == "check":
-        s3_check(s3sig, conf.dst_bucket, e.jsonlf, jsonl_s3path)
-    elif conf.s3mode == "create-if-needed":
-        s3status = s3_check(s3sig, conf.dst_bucket, e.jsonlf, jsonl_s3path)
-        if s3status == "not-found":
-            upload_to_s3(s3sig, conf.dst_bucket, e.jsonlf, jsonl_s3path)
-
-    # update_db_table(db_conn, e.lookup_list, conf.jsonlmode)
-    update_jsonl_clickhouse_table(db_conn, e.lookup_list, conf.jsonlmode)
-    e.jsonlf.unlink()
+    pipeline.submit(e, jsonl_s3path)
 
 
 @metrics.timer("process_measurement")
-def process_measurement(can_fn, msm_tup, buf, seen_uids, conf, s3sig, db_conn):
+def process_measurement(can_fn, msm_tup, buf, seen_uids, conf, pipeline):
     """Process a msmt
     If needed: create a new Entity tracking a jsonl file,
       close and upload jsonl to S3 and upsert db
     """
-    THRESHOLD = 20 * 1024 * 1024
     msm_jstr, msm, msmt_uid = msm_tup
     if msm is None:
         msm = json.loads(msm_jstr)
@@ -305,12 +492,7 @@ def process_measurement(can_fn, msm_tup, buf, seen_uids, conf, s3sig, db_conn):
         jsonlf = Path(f"{ts}_{cc}_{tn}.l.{len(entities)}.jsonl.gz")
         jsonl_s3path_base = f"jsonl/{tn}/{cc}/{ts}/00/{ts}_{cc}_{tn}.x."
         # An Entity is a JSONL file [that will be uploaded] on S3
-        en = Entity(
-            jsonlf=jsonlf,
-            fd=gzip.open(jsonlf, "w"),
-            jsonl_s3path_base=jsonl_s3path_base,
-            lookup_list=[],
-        )
+        en = pipeline.open_entity(jsonlf, jsonl_s3path_base)
         entities.append(en)
 
     en = entities[-1]
@@ -323,8 +505,8 @@ def process_measurement(can_fn, msm_tup, buf, seen_uids, conf, s3sig, db_conn):
         log.error(msm)
         raise
 
-    en.fd.write(jmsm.encode())
-    en.fd.write(b"\n")
+    line = jmsm.encode() + b"\n"
+    pipeline.write(en, line)
 
     rid = msm.get("report_id") or ""  # type: str
     source = can_fn
@@ -339,9 +521,9 @@ def process_measurement(can_fn, msm_tup, buf, seen_uids, conf, s3sig, db_conn):
     i = [rid, input_, msmt_uid, None, len(en.lookup_list), date, source]
     en.lookup_list.append(i)
 
-    if en.fd.offset > THRESHOLD:
+    if en.size > JSONL_THRESHOLD:
         # The jsonlf is big enough
-        finalize_jsonl(s3sig, db_conn, conf, en)
+        finalize_jsonl(pipeline, en)
 
     if conf.fastpathmode in ("insert", "upsert"):
         update = conf.fastpathmode == "upsert"
@@ -359,21 +541,22 @@ def progress(t0, processed_size, tot_size):
 
 
 @metrics.timer("process_can")
-def process_can(db_conn, s3uns, s3sig, can_fn, can_size, conf, buf, seen_uids):
-    Path(can_fn).parent.mkdir(parents=True, exist_ok=True)
+def process_can(source, can_fn, can_size, conf, buf, seen_uids, pipeline):
     log.info(f"Fetching can {can_fn}")
-    s3uns.download_file(conf.src_bucket, can_fn, can_fn)
-    for msm_tup in s3f.load_multiple(can_fn):
-        process_measurement(can_fn, msm_tup, buf, seen_uids, conf, s3sig, db_conn)
-    Path(can_fn).unlink()
+    for can_f in s3f.fetch_cans(source, conf, [(can_fn, can_size)]):
+        for msm_tup in s3f.load_multiple(can_f.as_posix()):
+            process_measurement(can_fn, msm_tup, buf, seen_uids, conf, pipeline)
+        s3f.remove_can(conf, source, can_f)
+    metrics.gauge("seen_uids_bytes", seen_uids.memory_bytes())
+    metrics.gauge("seen_uids_false_positive_rate", seen_uids.false_positive_rate())
 
 
 @metrics.timer("total_run_time")
 def main():
     conf = parse_args()
     log.info(f"From bucket {conf.src_bucket} to {conf.dst_bucket}")
-    s3sig = create_s3_client(conf)  # signed client for writing
     if conf.db_uri:
+        assert not no_psycopg2, "python3-psycopg2 is required with --db-uri"
         log.info(f"Connecting to PG at {conf.db_uri}")
         db_conn = psycopg2.connect(conf.db_uri)
         db.setup(conf)  # setup db conn inside db module
@@ -381,18 +564,25 @@ def main():
         log.info(f"Connecting to CH at {conf.clickhouse_url}")
         db.setup_clickhouse(conf)
         db_conn = db.click_client
-    setup_fingerprints()
+    update_fingerprints_if_needed()
+    # Signed S3 clients for writing are created in the upload threads
+    pipeline = JsonlPipeline(db_conn, conf)
 
     # s3_check(s3sig, "ooni-data-eu-fra", "none", "jsonl/tor/VE/20200827/00/20200827_VE_tor.l.0.jsonl.gz")
     # Fetch msmts for one day
     buf = {}  # "<cc> <testname>" -> jsonlf / fd / jsonl_s3path
-    seen_uids = set()  # Avoid uploading duplicates
+    # Avoid uploading duplicates
+    seen_uids = UIDSet(conf.seen_uids_max_mb * 1024 * 1024)
 
     # raw/20210601/00/SA/webconnectivity/2021060100_SA_webconnectivity.n0.0.jsonl.gz
     # jsonl_s3path = f"raw/{ts}/00/{cc}/{testname}/{jsonlf.name}"
 
-    s3uns = s3f.create_s3_client()  # unsigned client for reading
-    cans_fns = s3f.list_cans_on_s3_for_a_day(s3uns, conf.day)
+    if conf.cans_dir:
+        source = s3f.LocalCanSource(conf.cans_dir)
+    else:
+        s3uns = s3f.create_s3_client()  # unsigned client for reading
+        source = s3f.S3CanSource(s3uns, can_bucket=conf.src_bucket)
+    cans_fns = source.list_cans(conf.day)
     cans_fns = sorted(cans_fns)  # this is not enough to sort by time
     # cans_fns = [ x for x in cans_fns if "meek" in x[0] ] # FIXME
     tot_size = sum(size for _, size in cans_fns)
@@ -403,18 +593,25 @@ def main():
     stats["t0"] = time.time()
     #  TODO make assertions on msmt
     #  TODO add consistency check on trivial id found in fastpath table
-    for can in cans_fns:
-        can_fn, size = can
-        process_can(db_conn, s3uns, s3sig, can_fn, size, conf, buf, seen_uids)
-        processed_size += size
-        progress(stats["t0"], processed_size, tot_size)
-
-    log.info("Finish jsonl files still open")
-    for json_entities in buf.values():
-        for e in json_entities:
-            if e.fd.closed:
-                continue
-            finalize_jsonl(s3sig, db_conn, conf, e)
+    try:
+        for can in cans_fns:
+            can_fn, size = can
+            process_can(source, can_fn, size, conf, buf, seen_uids, pipeline)
+            processed_size += size
+            progress(stats["t0"], processed_size, tot_size)
+
+        log.info("Finish jsonl files still open")
+        for json_entities in buf.values():
+            for e in json_entities:
+                if e.fd.closed:
+                    continue
+                finalize_jsonl(pipeline, e)
+
+        log.info("Waiting for uploads")
+        pipeline.close()
+    finally:
+        # Stop the pools and delete partial files after an error
+        pipeline.shutdown()
 
     log.info("Exiting")
 
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+
+"""
+Shared-memory ring buffer passing measurements from the HTTP feeder to the
+scoring workers
+
+Measurements are copied into fixed-size slots in an anonymous shared memory
+area allocated before forking. Only slot numbers and measurement UIDs go
+through the multiprocessing queues, instead of pickled measurement bodies.
+Measurements larger than a slot use a run of contiguous slots. Workers read
+them in place through a memoryview and release the slots once the
+measurement is decoded.
+
+The number of slots bounds the amount of queued data: when there are no
+free slots the feeder blocks until a worker releases some. Measurements
+larger than the whole buffer are passed through the queue, up to
+MAX_OVERSIZE at a time.
+
+Each held measurement records the PID of its worker. When the feeder waits
+for free slots for longer than ALLOC_TIMEOUT_S it frees the slots held by
+workers that died.
+
+Measurements are queued in lanes. Each worker reads from its own lane and
+takes work from other lanes when its lane is empty.
+"""
+
+from queue import Empty
+from typing import Dict, List, Optional, Sequence, Tuple
+import logging
+import multiprocessing as mp
+import os
+import time
+
+from fastpath.metrics import setup_metrics
+
+log = logging.getLogger("fastpath.ringbuffer")
+metrics = setup_metrics(name="fastpath.ringbuffer")
+
+# How long an idle worker waits on its lane before looking at other lanes
+STEAL_INTERVAL_S = 0.05
+# Measurements larger than the buffer queued at the same time
+MAX_OVERSIZE = 2
+# How long the feeder waits for free slots before looking for slots held by
+# dead workers
+ALLOC_TIMEOUT_S = 10
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class RingBuffer:
+    def __init__(
+        self, nslots: int, slot_size: int, lanes: Sequence[str] = ("default",)
+    ) -> None:
+        self.nslots = nslots
+        self.slot_size = slot_size
+        self._buf = mp.RawArray("B", nslots * slot_size)
+        # For the first slot of each measurement: its length and the number
+        # of slots it uses
+        self._lens = mp.RawArray("Q", nslots)
+        self._spans = mp.RawArray("I", nslots)
+        # PID of the worker holding the measurement, 0 when queued
+        self._owners = mp.RawArray("i", nslots)
+        # 1 for each slot in use. Protected by _cond, notified on release
+        self._map = mp.RawArray("B", nslots)
+        self._nused = mp.RawValue("I", 0)
+        self._cursor = mp.RawValue("I", 0)
+        self._cond = mp.Condition()
+        # Allocations are done one at a time: measurements waiting for a
+        # long run of free slots are not overtaken by smaller ones
+        self._put_lock = mp.Lock()
+        self._oversize = mp.BoundedSemaphore(MAX_OVERSIZE)
+        # One queue for each lane containing: (slot number, msmt_uid) or
+        # (data, msmt_uid) for oversize measurements or None to stop a worker
+        self.lanes = list(lanes)
+        qsize = nslots + MAX_OVERSIZE
+        self._ready: List[mp.Queue] = [mp.Queue(qsize) for _ in self.lanes]
+        self._view = None
+        self._held = None  # (slot, memoryview) returned by get()
+
+    def _get_view(self) -> memoryview:
+        # Create the memoryview lazily in each process
+        if self._view is None:
+            self._view = memoryview(self._buf).cast("B")
+        return self._view
+
+    def _find_free(self, span: int) -> Optional[int]:
+        # First fit from the cursor, then from the beginning
+        m = bytes(self._map)
+        free = bytes(span)
+        slot = m.find(free, self._cursor.value)
+        if slot == -1:
+            slot = m.find(free)
+        return None if slot == -1 else slot
+
+    def _alloc(self, span: int) -> int:
+        with self._put_lock, self._cond:
+            slot = self._find_free(span)
+            if slot is None:
+                metrics.incr("full")
+                while slot is None:
+                    if not self._cond.wait(ALLOC_TIMEOUT_S):
+                        log.warning("No free slots for %ds", ALLOC_TIMEOUT_S)
+                        self._reclaim_dead()
+                    slot = self._find_free(span)
+            self._map[slot : slot + span] = b"\x01" * span
+            self._nused.value += span
+            self._cursor.value = (slot + span) % self.nslots
+            return slot
+
+    def _reclaim_dead(self) -> None:
+        """Free the slots held by dead workers. Called with _cond held"""
+        alive: Dict[int, bool] = {}
+        for slot, pid in enumerate(self._owners):
+            if not pid:
+                continue
+            if pid not in alive:
+                alive[pid] = _pid_alive(pid)
+            if alive[pid]:
+                continue
+            log.error("Freeing slot %d held by dead worker %d", slot, pid)
+            metrics.incr("reclaimed_slot")
+            self._free(slot)
+
+    def _free(self, slot: int) -> None:
+        span = self._spans[slot]
+        self._owners[slot] = 0
+        self._map[slot : slot + span] = bytes(span)
+        self._nused.value -= span
+        self._cond.notify_all()
+
+    def put(self, data: bytes, msmt_uid: str, lane=0) -> None:
+        """Copy a measurement into free slots. Blocks when there are not
+        enough free slots or the lane queue is full"""
+        span = max(1, -(-len(data) // self.slot_size))
+        if span > self.nslots:
+            metrics.incr("oversize_measurement")
+            self._oversize.acquire()
+            self._ready[lane].put((bytes(data), msmt_uid))
+            return
+
+        if span > 1:
+            metrics.incr("multislot_measurement")
+        slot = self._alloc(span)
+        offset = slot * self.slot_size
+        self._get_view()[offset : offset + len(data)] = data
+        self._lens[slot] = len(data)
+        self._spans[slot] = span
+        self._ready[lane].put((slot, msmt_uid))
+        metrics.gauge("used_slots", self.used_slots())
+        metrics.gauge(f"depth.{self.lanes[lane]}", self.depth(lane))
+
+    def put_stop(self, lane=0) -> None:
+        """Tell one worker of a lane to exit"""
+        self._ready[lane].put(None)
+
+    def _steal(self, lane: int):
+        for n, q in enumerate(self._ready):
+            if n == lane:
+                continue
+            try:
+                item = q.get_nowait()
+            except Empty:
+                continue
+            if item is None:
+                # Stop messages are for the workers of that lane
+                q.put(None)
+                continue
+            metrics.incr(f"stolen.{self.lanes[n]}")
+            return item
+
+        raise Empty
+
+    def _get_item(self, timeout: Optional[float], lane: int):
+        if len(self._ready) == 1:
+            return self._ready[lane].get(timeout=timeout)
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = STEAL_INTERVAL_S
+            if deadline is not None:
+                wait = max(0, min(wait, deadline - time.monotonic()))
+            try:
+                return self._ready[lane].get(timeout=wait)
+            except Empty:
+                pass
+            try:
+                return self._steal(lane)
+            except Empty:
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise
+
+    def get(
+        self, timeout: Optional[float] = None, lane=0
+    ) -> Optional[Tuple[memoryview, str]]:
+        """Returns (data, msmt_uid) or None when the worker should exit.
+        Reads from a lane and from the other lanes when it is empty.
+        Raises queue.Empty on timeout.
+        data is a memoryview on the slots holding the measurement. The slots
+        are held until release() or the next get() and the memoryview is
+        not usable after that.
+        """
+        self.release()
+        item = self._get_item(timeout, lane)
+        if item is None:
+            return None
+
+        slot, msmt_uid = item
+        if isinstance(slot, bytes):
+            self._oversize.release()
+            return memoryview(slot), msmt_uid
+
+        self._owners[slot] = os.getpid()
+        offset = slot * self.slot_size
+        view = self._get_view()[offset : offset + self._lens[slot]]
+        self._held = (slot, view)
+        return view, msmt_uid
+
+    def release(self) -> None:
+        """Release the slots of the measurement returned by get()"""
+        if self._held is None:
+            return
+
+        slot, view = self._held
+        self._held = None
+        try:
+            view.release()
+        except BufferError:
+            pass  # still exported: the caller must not use it anymore
+        with self._cond:
+            if not self._map[slot]:
+                raise RuntimeError(f"Slot {slot} released twice")
+            self._free(slot)
+
+    def depth(self, lane: Optional[int] = None) -> int:
+        """Number of measurements waiting for a worker in a lane or in all
+        lanes"""
+        if lane is None:
+            return sum(q.qsize() for q in self._ready)
+        return self._ready[lane].qsize()
+
+    def used_slots(self) -> int:
+        return self._nused.value
@@ -7,13 +7,23 @@ Feeds reports from cans on public S3 bucke or local disk
 Explore bucket from CLI:
 AWS_PROFILE=ooni-data aws s3 ls s3://ooni-data/canned/2019-07-16/
 
+Cans are listed and fetched through a can source: S3CanSource for the S3
+buckets or LocalCanSource for a local directory tree with the same layout:
+  canned/YYYY-MM-DD/<can>
+  raw/YYYYMMDD/HH/CC/<testname>/<minican>.tar.gz
 """
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, timedelta
-from typing import Generator, Set
+from queue import Empty
+from typing import BinaryIO, Generator, Iterable, Iterator, List, Optional, Set, Tuple
 from pathlib import Path
+import hashlib
 import logging
+import multiprocessing as mp
 import os
+import threading
 import time
 import tarfile
 
@@ -29,6 +39,7 @@ from botocore.config import Config as botoConfig
 from fastpath.metrics import setup_metrics
 from fastpath.mytypes import MsmtTup  # msmt bytes, msmt dict, uid
 from fastpath.normalize import iter_yaml_msmt_normalized
+from fastpath.normalize import start_yaml_pool, stop_yaml_pool
 from fastpath.utils import trivial_id
 
 CAN_BUCKET_NAME = "ooni-data"
@@ -41,6 +52,21 @@ metrics = setup_metrics(name="fastpath.s3feeder")
 for x in ("urllib3", "botocore", "s3transfer"):
     logging.getLogger(x).setLevel(logging.INFO)
 
+# Measurements sent at once by the decoder processes
+DECODE_BATCH_SIZE = 500
+# Batches queued by each decoder process
+DECODE_QUEUE_BATCHES = 8
+# Cans queued to each decoder process. The output is bounded by
+# DECODE_QUEUE_BATCHES
+DECODE_CANS_AHEAD = 4
+
+# Listings of days more recent than this are not cached
+LISTING_REFRESH_DAYS = 2
+# Local can cache usage in this process
+cache_stats = dict(hits=0, misses=0, bytes_saved=0)
+# .s3tmp files not modified for this long are left over by failed downloads
+ORPHAN_TMP_AGE_S = 3600
+
 
 def load_multiple(fn: str) -> Generator[MsmtTup, None, None]:
     """Load contents of legacy cans and minicans.
@@ -153,14 +179,130 @@ def load_multiple(fn: str) -> Generator[MsmtTup, None, None]:
         raise RuntimeError(f"Unexpected [mini]can filename '{fn}'")
 
 
+def _decoder_proc(tasks, results, batch_size: int) -> None:
+    """Decoder process: receive (seq, can filename) tasks until None.
+    For each can send (seq, batch of measurements) items, then (seq, None)
+    or (seq, exception)"""
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        seq, fn = task
+        batch = []
+        try:
+            for msm_tup in load_multiple(fn):
+                batch.append(msm_tup)
+                if len(batch) >= batch_size:
+                    results.put((seq, batch))
+                    batch = []
+            if batch:
+                results.put((seq, batch))
+            results.put((seq, None))
+        except Exception as e:
+            results.put((seq, RuntimeError(f"Unable to decode {fn}: {e}")))
+
+
+def _start_decoder(ctx) -> list:
+    """Returns [process, tasks queue, results queue]"""
+    tasks = ctx.Queue()
+    results = ctx.Queue(DECODE_QUEUE_BATCHES)
+    args = (tasks, results, DECODE_BATCH_SIZE)
+    proc = ctx.Process(target=_decoder_proc, args=args, daemon=True)
+    proc.start()
+    return [proc, tasks, results]
+
+
+def _iter_decoded(proc, results, seq: int) -> Generator[MsmtTup, None, None]:
+    while True:
+        try:
+            item_seq, item = results.get(timeout=1)
+        except Empty:
+            if not proc.is_alive():
+                raise RuntimeError("Decoder process died")
+            continue
+
+        if item_seq != seq:
+            # Leftover from a can that was not fully consumed
+            continue
+        if item is None:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield from item
+
+
+def decode_cans(
+    can_files: Iterable[Path], nprocs: int
+) -> Generator[Tuple[Path, Iterator[MsmtTup]], None, None]:
+    """Decompress and parse cans in nprocs long-lived processes, working
+    ahead of the caller. Yields (can file, measurements iterator) in order.
+    Can number n is decoded by process n % nprocs. Each process has up to
+    DECODE_CANS_AHEAD cans queued.
+    """
+    # The caller might have running threads e.g. in fetch_cans: do not fork
+    ctx = mp.get_context("forkserver")
+    can_files = iter(can_files)
+    decoders = [_start_decoder(ctx) for _ in range(nprocs)]
+    pending: deque = deque()  # (seq, can file)
+    next_seq = 0
+
+    def restart(n: int) -> None:
+        """Replace dead decoder n and resubmit the cans queued to it"""
+        log.error("Restarting dead decoder process")
+        decoders[n][0].join()
+        decoders[n] = _start_decoder(ctx)
+        for seq, can_f in pending:
+            if seq % nprocs == n:
+                decoders[n][1].put((seq, can_f.as_posix()))
+
+    def submit_next() -> None:
+        nonlocal next_seq
+        can_f = next(can_files, None)
+        if can_f is None:
+            return
+        n = next_seq % nprocs
+        pending.append((next_seq, can_f))
+        if decoders[n][0].is_alive():
+            decoders[n][1].put((next_seq, can_f.as_posix()))
+        else:
+            restart(n)
+        next_seq += 1
+
+    try:
+        for _ in range(nprocs * DECODE_CANS_AHEAD):
+            submit_next()
+        while pending:
+            seq, can_f = pending[0]
+            n = seq % nprocs
+            if not decoders[n][0].is_alive():
+                restart(n)
+            pending.popleft()
+            # If the decoder dies while decoding this can the iterator raises
+            # RuntimeError: the measurements might be partially consumed
+            proc, _, results = decoders[n]
+            yield can_f, _iter_decoded(proc, results, seq)
+            submit_next()
+
+        for _, tasks, _ in decoders:
+            tasks.put(None)
+        for proc, _, _ in decoders:
+            proc.join(timeout=5)
+
+    finally:
+        for proc, _, _ in decoders:
+            if proc.is_alive():
+                proc.terminate()
+                proc.join()
+
+
 def create_s3_client():
     return boto3.client("s3", config=botoConfig(signature_version=botoSigUNSIGNED))
 
 
-def list_cans_on_s3_for_a_day(s3, day: date):
+def list_cans_on_s3_for_a_day(s3, day: date, bucket_name=CAN_BUCKET_NAME):
     """List legacy cans."""
     prefix = f"{day}/"
-    r = s3.list_objects_v2(Bucket=CAN_BUCKET_NAME, Prefix="canned/" + prefix)
+    r = s3.list_objects_v2(Bucket=bucket_name, Prefix="canned/" + prefix)
 
     if ("Contents" in r) ^ (day <= date(2020, 10, 21)):
         # The last day with cans is 2020-10-21
@@ -171,12 +313,10 @@ def list_cans_on_s3_for_a_day(s3, day: date):
     return files
 
 
-def list_minicans_on_s3_for_a_day(
-    s3, day: date, ccs: Set[str], testnames: Set[str]
+def list_all_minicans_on_s3_for_a_day(
+    s3, day: date, bucket_name=MC_BUCKET_NAME
 ) -> list:
-    """List minicans. Filter them by CCs and testnames
-    Testnames are without underscores.
-    """
+    """List all the minicans of a day"""
     # s3cmd ls s3://ooni-data-eu-fra/raw/20210202
     tstamp = day.strftime("%Y%m%d")
     prefix = f"raw/{tstamp}/"
@@ -185,7 +325,7 @@ def list_minicans_on_s3_for_a_day(
     # list_objects_v2 returns 1000 objects max and needs a token (!= None)
     while True:
         kw = {} if cont_token is None else dict(ContinuationToken=cont_token)
-        r = s3.list_objects_v2(Bucket=MC_BUCKET_NAME, Prefix=prefix, **kw)
+        r = s3.list_objects_v2(Bucket=bucket_name, Prefix=prefix, **kw)
 
         cont_token = r.get("NextContinuationToken", None)
         if ("Contents" in r) ^ (day >= date(2020, 10, 20)):
@@ -199,27 +339,201 @@ def list_minicans_on_s3_for_a_day(
             # Example:
             # raw/20210910/02/CU/signal/2021091002_CU_signal.n0.0.tar.gz
             fname = f["Key"]
-            try:
-                _raw, _date, _hour, cc, testname, _ = fname.split("/")
-            except Exception:
+            if fname.count("/") != 5:
                 log.warn(f"Ignoring unexpected minican filename {fname}")
-
-            if ccs and cc not in ccs:
-                continue
-
-            if testnames and testname not in testnames:
                 continue
 
             if f["Size"] > 0:
                 files.append((fname, f["Size"]))
 
         if cont_token is None:
-            log.info(f"Found {len(files)} minican .tar.gz files")
             return sorted(files)
 
     assert False
 
 
+def filter_minicans(files: list, ccs: Set[str], testnames: Set[str]) -> list:
+    """Filter minicans by CCs and testnames
+    Testnames are without underscores.
+    """
+    out = []
+    for fname, size in files:
+        _raw, _date, _hour, cc, testname, _ = fname.split("/")
+        if ccs and cc not in ccs:
+            continue
+
+        if testnames and testname not in testnames:
+            continue
+
+        out.append((fname, size))
+
+    return out
+
+
+def list_minicans_on_s3_for_a_day(
+    s3, day: date, ccs: Set[str], testnames: Set[str], bucket_name=MC_BUCKET_NAME
+) -> list:
+    """List minicans. Filter them by CCs and testnames
+    Testnames are without underscores.
+    """
+    files = list_all_minicans_on_s3_for_a_day(s3, day, bucket_name)
+    files = filter_minicans(files, ccs, testnames)
+    log.info(f"Found {len(files)} minican .tar.gz files")
+    return files
+
+
+class ListingCache:
+    """Permanent cache of S3 listings, stored as one JSON file for each
+    bucket, prefix and day. Cans are not added to past days: the listings
+    of the last LISTING_REFRESH_DAYS days are always fetched from S3
+    """
+
+    def __init__(self, cachedir: Path) -> None:
+        self.cachedir = cachedir
+
+    def get(self, bucket_name: str, prefix: str, day: date, fetch) -> list:
+        """Returns the cached listing or calls fetch() and caches its
+        output"""
+        if day >= date.today() - timedelta(days=LISTING_REFRESH_DAYS):
+            return fetch()
+
+        f = self.cachedir / bucket_name / prefix / f"{day}.json"
+        try:
+            files = [tuple(i) for i in ujson.loads(f.read_text())]
+            metrics.incr("listing_cache_hit")
+            return files
+        except FileNotFoundError:
+            pass
+        except ValueError:
+            log.warn(f"Ignoring corrupted listing cache file {f}")
+
+        metrics.incr("listing_cache_miss")
+        files = fetch()
+        f.parent.mkdir(parents=True, exist_ok=True)
+        tmpf = f.with_suffix(f".{os.getpid()}.tmp")
+        tmpf.write_text(ujson.dumps(files))
+        tmpf.rename(f)
+        return files
+
+
+class S3CanSource:
+    """Cans and minicans on S3. Downloaded cans are stored in the local
+    cache directory conf.s3cachedir
+    Listings are cached in listing_cachedir, if set
+    """
+
+    keep_files = False
+
+    def __init__(
+        self,
+        s3,
+        can_bucket=CAN_BUCKET_NAME,
+        minican_bucket=MC_BUCKET_NAME,
+        listing_cachedir: Optional[Path] = None,
+    ) -> None:
+        self.s3 = s3
+        self.can_bucket = can_bucket
+        self.minican_bucket = minican_bucket
+        self.listing_cache = None
+        if listing_cachedir is not None:
+            self.listing_cache = ListingCache(listing_cachedir)
+
+    def _list(self, bucket_name: str, prefix: str, day: date, fetch) -> list:
+        if self.listing_cache is None:
+            return fetch()
+        return self.listing_cache.get(bucket_name, prefix, day, fetch)
+
+    def list_cans(self, day: date) -> list:
+        b = self.can_bucket
+        return self._list(
+            b, "canned", day, lambda: list_cans_on_s3_for_a_day(self.s3, day, b)
+        )
+
+    def list_minicans(self, day: date, ccs: Set[str], testnames: Set[str]) -> list:
+        b = self.minican_bucket
+        files = self._list(
+            b, "raw", day, lambda: list_all_minicans_on_s3_for_a_day(self.s3, day, b)
+        )
+        files = filter_minicans(files, ccs, testnames)
+        log.info(f"Found {len(files)} minican .tar.gz files")
+        return files
+
+    def can_path(self, conf, s3fname: str) -> Path:
+        """Where the can is stored on disk"""
+        return conf.s3cachedir / s3fname.split("/", 1)[1]
+
+    def download(self, s3fname: str, f: BinaryIO, cb=None) -> None:
+        bucket_name = self.can_bucket if "canned/" in s3fname else self.minican_bucket
+        self.s3.download_fileobj(bucket_name, s3fname, f, Callback=cb)
+
+
+class LocalCanSource:
+    """Cans and minicans in a local directory with the same layout as the
+    S3 buckets. They are read in place and never deleted.
+    With mirror_of, the listing comes from another source and missing cans
+    are downloaded from it into the directory, to be reused by later runs.
+    """
+
+    keep_files = True
+
+    def __init__(self, root: Path, mirror_of: Optional[S3CanSource] = None) -> None:
+        self.root = Path(root)
+        self.mirror_of = mirror_of
+
+    def _list(self, pattern: str) -> list:
+        return sorted(
+            (f.relative_to(self.root).as_posix(), f.stat().st_size)
+            for f in self.root.glob(pattern)
+            if f.is_file()
+        )
+
+    def list_cans(self, day: date) -> list:
+        if self.mirror_of:
+            return self.mirror_of.list_cans(day)
+        return self._list(f"canned/{day}/*")
+
+    def list_minicans(self, day: date, ccs: Set[str], testnames: Set[str]) -> list:
+        if self.mirror_of:
+            return self.mirror_of.list_minicans(day, ccs, testnames)
+        tstamp = day.strftime("%Y%m%d")
+        files = self._list(f"raw/{tstamp}/*/*/*/*.tar.gz")
+        files = [(fn, size) for fn, size in files if size > 0]
+        return filter_minicans(files, ccs, testnames)
+
+    def can_path(self, conf, s3fname: str) -> Path:
+        return self.root / s3fname
+
+    def download(self, s3fname: str, f: BinaryIO, cb=None) -> None:
+        if self.mirror_of is None:
+            raise FileNotFoundError(self.root / s3fname)
+        self.mirror_of.download(s3fname, f, cb)
+
+
+def create_can_source(conf):
+    """Returns a LocalCanSource if conf.cans_dir is set or a S3CanSource
+    S3 listings are cached in conf.s3listingdir, if set
+    """
+    s3 = S3CanSource(
+        create_s3_client(), listing_cachedir=getattr(conf, "s3listingdir", None)
+    )
+    cans_dir = getattr(conf, "cans_dir", None)
+    if cans_dir is None:
+        return s3
+    if getattr(conf, "mirror_cans", False):
+        return LocalCanSource(cans_dir, mirror_of=s3)
+    return LocalCanSource(cans_dir)
+
+
+def remove_can(conf, source, can_f: Path) -> None:
+    """Delete a processed can from the cache unless it should be kept"""
+    if conf.keep_s3_cache or source.keep_files:
+        return
+    try:
+        can_f.unlink()
+    except FileNotFoundError:
+        pass
+
+
 def log_download(s3fname, size) -> None:
     s = size / 1024 / 1024
     d = "M"
@@ -229,36 +543,57 @@ def log_download(s3fname, size) -> None:
     log.info(f"Downloading can {s3fname} size {s:.1f} {d}B")
 
 
+def _download_can(source, s3fname: str, diskf: Path, size: int, cb) -> None:
+    # TODO: handle missing file
+    log_download(s3fname, size)
+    diskf.parent.mkdir(parents=True, exist_ok=True)
+    tmpf = diskf.with_suffix(".s3tmp")
+    with tmpf.open("wb") as f:
+        source.download(s3fname, f, cb)
+        f.flush()
+        os.fsync(f.fileno())
+    tmpf.rename(diskf)
+    assert size == diskf.stat().st_size
+
+
 @metrics.timer("fetch_cans")
-def fetch_cans(s3, conf, files) -> Generator[Path, None, None]:
+def fetch_cans(source, conf, files) -> Generator[Path, None, None]:
     """
-    Download cans to a local directory
+    Download cans to a local directory if needed
     fnames = [("2013-09-12/20130912T150305Z-MD-AS1547-http_", size), ... ]
-    yield each can file Path
+    yield each can file Path, in order.
+    While a can is being processed by the caller the next conf.prefetch_cans
+    cans are downloaded by a thread pool, as long as the downloaded cans
+    waiting to be processed fit in conf.prefetch_budget_mb
     """
     # fn: can filename without path
-    # diskf: File in the s3cachedir directory
+    # diskf: File in the s3cachedir directory or in a local can source
     cans = []  # (s3fname, filename on disk, size, download required)
     for s3fname, size in files:
-        diskf = conf.s3cachedir / s3fname.split("/", 1)[1]
+        diskf = source.can_path(conf, s3fname)
         if diskf.exists() and size == diskf.stat().st_size:
             metrics.incr("cache_hit")
+            metrics.incr("cache_hit_bytes", size)
+            cache_stats["hits"] += 1
+            cache_stats["bytes_saved"] += size
+            # Update the access time for clean_s3_cache
             diskf.touch(exist_ok=True)
             cans.append((s3fname, diskf, size, False))
         else:
             metrics.incr("cache_miss")
+            cache_stats["misses"] += 1
             cans.append((s3fname, diskf, size, True))
 
+    cb_lock = threading.Lock()
+
     def _cb(bytes_count):
-        if _cb.start_time is None:
-            _cb.start_time = time.time()
-            _cb.count = bytes_count
-            return
-        _cb.count += bytes_count
-        _cb.total_count += bytes_count
-        metrics.gauge("s3_download_percentage", _cb.total_count / _cb.total_size * 100)
+        # Called by the download threads
+        with cb_lock:
+            _cb.total_count += bytes_count
+            total_count = _cb.total_count
+        metrics.gauge("s3_download_percentage", total_count / _cb.total_size * 100)
         try:
-            speed = _cb.count / 131_072 / (time.time() - _cb.start_time)
+            speed = total_count / 131_072 / (time.time() - _cb.start_time)
             metrics.gauge("s3_download_speed_avg_Mbps", speed)
         except ZeroDivisionError:
             pass
@@ -266,31 +601,133 @@ def fetch_cans(s3, conf, files) -> Generator[Path, None, None]:
     cans = sorted(set(cans))
     _cb.total_size = sum(t[2] for t in cans if t[3])
     _cb.total_count = 0
+    _cb.start_time = time.time()
 
-    for s3fname, diskf, size, dload_required in cans:
-        if not dload_required:
-            yield diskf  # already in local cache
-            continue
+    budget = conf.prefetch_budget_mb * 1024 * 1024
+    downloads = {}  # can number -> Future
+    prefetched_bytes = 0  # downloaded or being downloaded, not yet yielded
+    next_cn = 0  # next can to be scheduled for download
+    executor = ThreadPoolExecutor(max_workers=max(1, conf.prefetch_cans))
+    try:
+        for cn, (s3fname, diskf, size, dload_required) in enumerate(cans):
+            # Schedule downloads up to prefetch_cans cans ahead. The current
+            # can is always downloaded even if it exceeds the budget.
+            while next_cn < len(cans) and next_cn <= cn + conf.prefetch_cans:
+                n_s3fname, n_diskf, n_size, n_dload_required = cans[next_cn]
+                if n_dload_required:
+                    if next_cn > cn and prefetched_bytes + n_size > budget:
+                        break
+                    downloads[next_cn] = executor.submit(
+                        _download_can, source, n_s3fname, n_diskf, n_size, _cb
+                    )
+                    prefetched_bytes += n_size
+                next_cn += 1
+
+            metrics.gauge("prefetched_bytes", prefetched_bytes)
+            if not dload_required:
+                yield diskf  # already in local cache
+                continue
 
-        # TODO: handle missing file
-        log_download(s3fname, size)
-        diskf.parent.mkdir(parents=True, exist_ok=True)
-        tmpf = diskf.with_suffix(".s3tmp")
-        metrics.gauge("fetching", 1)
-        _cb.start_time = None
-        with tmpf.open("wb") as f:
-            bucket_name = CAN_BUCKET_NAME if "canned/" in s3fname else MC_BUCKET_NAME
-            s3.download_fileobj(bucket_name, s3fname, f, Callback=_cb)
-            f.flush()
-            os.fsync(f.fileno())
-        metrics.gauge("fetching", 0)
-        tmpf.rename(diskf)
-        assert size == diskf.stat().st_size
-        yield diskf
+            metrics.gauge("fetching", 1)
+            downloads.pop(cn).result()
+            metrics.gauge("fetching", 0)
+            yield diskf
+            prefetched_bytes -= size
+
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
 
     metrics.gauge("s3_download_speed_avg_Mbps", 0)
 
 
+def load_checkpoint(path: Path) -> Set[str]:
+    """Returns the cans completed by previous runs and rewrites the
+    checkpoint file without any line truncated by a crash"""
+    done: Set[str] = set()
+    try:
+        with path.open() as f:
+            for line in f:
+                try:
+                    done.add(ujson.loads(line)["can"])
+                except (ValueError, KeyError, TypeError):
+                    pass
+    except FileNotFoundError:
+        pass
+
+    tmpf = path.with_suffix(".tmp")
+    with tmpf.open("w") as f:
+        for s3fname in sorted(done):
+            f.write(ujson.dumps(dict(can=s3fname)) + "\n")
+    tmpf.rename(path)
+    return done
+
+
+def mark_can_done(path: Path, s3fname: str, msmt_cnt: int) -> None:
+    """Record a can as completed in the checkpoint file. Call this only after
+    its rows are written to the database"""
+    line = ujson.dumps(dict(can=s3fname, msmt_cnt=msmt_cnt, time=int(time.time())))
+    # Small appends are not interleaved when backfill workers run in parallel
+    with path.open("a") as f:
+        f.write(line + "\n")
+
+
+@metrics.timer("clean_s3_cache")
+def clean_s3_cache(cachedir: Path, max_bytes: int) -> None:
+    """Delete the least recently used cans until the cache fits in max_bytes
+    Also delete .s3tmp files left over by failed downloads
+    """
+    now = time.time()
+    cans: List[Tuple[float, int, Path]] = []  # (last use, size, path)
+    for f in cachedir.rglob("*"):
+        try:
+            st = f.stat()
+        except FileNotFoundError:
+            continue  # deleted by a concurrent run
+        if not f.is_file():
+            continue
+        if f.suffix == ".s3tmp":
+            if now - st.st_mtime > ORPHAN_TMP_AGE_S:
+                log.info("Deleting orphaned %s", f)
+                f.unlink(missing_ok=True)
+                metrics.incr("deleted_orphan_tmp_file")
+            continue
+        # atime might not be updated on noatime mounts: touch sets both
+        cans.append((max(st.st_atime, st.st_mtime), st.st_size, f))
+
+    cans.sort()
+    total = sum(size for _, size, _ in cans)
+    for last_use, size, f in cans:
+        if total <= max_bytes:
+            break
+        log.debug("Evicting %s", f)
+        f.unlink(missing_ok=True)
+        total -= size
+        metrics.incr("evicted_cache_file")
+        metrics.gauge("evicted_cache_file_age", now - last_use)
+
+    # Remove empty directories, bottom-up: minicans are stored in nested
+    # YYYYMMDD/HH/CC/test/ directories
+    for dirpath, _, _ in os.walk(cachedir, topdown=False):
+        if dirpath == str(cachedir):
+            continue
+        try:
+            os.rmdir(dirpath)
+        except OSError:
+            pass  # not empty
+
+    metrics.gauge("cache_bytes", total)
+    lookups = cache_stats["hits"] + cache_stats["misses"]
+    if lookups:
+        ratio = cache_stats["hits"] / lookups
+        metrics.gauge("cache_hit_ratio", ratio)
+        log.info(
+            "S3 cache: %d bytes, hit ratio %.2f, %d bytes not downloaded",
+            total,
+            ratio,
+            cache_stats["bytes_saved"],
+        )
+
+
 # TODO: merge with stream_daily_cans, add caching to the latter to be used
 # during functional tests
 # @metrics.timer("fetch_cans_for_a_day_with_cache")
@@ -312,50 +749,113 @@ def _calculate_etr(t0, now, start_day, day, stop_day, can_num, can_tot_count) ->
     return etr
 
 
-def _update_eta(t0, start_day, day, stop_day, can_num, can_tot_count):
-    """Generate metric process_s3_measurements_eta expressed as epoch"""
+def _update_eta(t0, start_day, day, stop_day, can_num, can_tot_count, shard=None):
+    """Generate metric process_s3_measurements_eta expressed as epoch
+    and the progress of the shard, if any"""
     try:
         now = time.time()
         etr = _calculate_etr(t0, now, start_day, day, stop_day, can_num, can_tot_count)
         eta = t0 + etr
         metrics.gauge("process_s3_measurements_eta", eta)
+        if shard:
+            # Read by shard_report
+            tot_days_count = (stop_day - start_day).days
+            days_done = (day - start_day).days + (can_num + 1) / float(can_tot_count)
+            metrics.gauge(f"shard.{shard[0]}.progress", days_done / tot_days_count)
+            metrics.gauge(f"shard.{shard[0]}.eta", eta)
     except:
         pass
 
 
-def stream_cans(conf, start_day: date, end_day: date) -> Generator[MsmtTup, None, None]:
-    """Stream cans from S3"""
+def in_shard(s3fname: str, shard: Optional[Tuple[int, int]]) -> bool:
+    """Deterministically assign cans to one of N shards by hashing their
+    S3 key. shard: (i, N) or None"""
+    if shard is None:
+        return True
+    i, n = shard
+    h = hashlib.sha1(s3fname.encode()).digest()
+    return int.from_bytes(h[:8], "big") % n == i
+
+
+def list_cans(source, conf, day: date) -> list:
+    """List legacy cans and minicans for a day, in the shard if any"""
+    cans_fns = source.list_cans(day)
+    minicans_fns = source.list_minicans(day, conf.ccs, conf.testnames)
+    cans_fns.extend(minicans_fns)
+    return [c for c in cans_fns if in_shard(c[0], conf.shard)]
+
+
+def get_stop_day(end_day: date) -> date:
+    """Returns the first day not to be processed: end_day or today"""
     today = date.today()
-    if not start_day or start_day >= today:
+    return end_day if end_day < today else today
+
+
+def load_can(source, conf, s3fname: str, size: int) -> Generator[MsmtTup, None, None]:
+    """Fetch a can if needed and yield its measurements"""
+    for can_f in fetch_cans(source, conf, [(s3fname, size)]):
+        try:
+            yield from load_multiple(can_f.as_posix())
+        finally:
+            remove_can(conf, source, can_f)
+
+
+def stream_cans(
+    conf, start_day: date, end_day: date, skip_cans=frozenset(), on_can_done=None
+) -> Generator[MsmtTup, None, None]:
+    """Stream cans from S3 or from conf.cans_dir
+    Cans in skip_cans are not processed.
+    on_can_done(s3fname, msmt_cnt) is called after the last measurement of
+    each can has been processed by the caller.
+    """
+    if not start_day or start_day >= date.today():
         return
 
     log.info("Fetching older cans from S3")
     t0 = time.time()
     day = start_day
-    s3 = create_s3_client()
-    # the last day is not included
-    stop_day = end_day if end_day < today else today
-    while day < stop_day:
-        log.info("Processing day %s", day)
-        cans_fns = list_cans_on_s3_for_a_day(s3, day)
-        minicans_fns = list_minicans_on_s3_for_a_day(s3, day, conf.ccs, conf.testnames)
-        cans_fns.extend(minicans_fns)
-        for cn, can_f in enumerate(fetch_cans(s3, conf, cans_fns)):
-            try:
-                _update_eta(t0, start_day, day, stop_day, cn, len(cans_fns))
-                # log.info("can %s ready", can_f.name)
-                for msmt_tup in load_multiple(can_f.as_posix()):
-                    yield msmt_tup
-            except Exception as e:
-                log.error(str(e), exc_info=True)
-
-            if not conf.keep_s3_cache:
+    source = create_can_source(conf)
+    # YAML entries are parsed in a pool only when cans are decoded here
+    if not conf.decode_workers:
+        start_yaml_pool(conf.yaml_workers)
+    try:
+        # the last day is not included
+        stop_day = get_stop_day(end_day)
+        while day < stop_day:
+            log.info("Processing day %s", day)
+            cans_fns = list_cans(source, conf, day)
+            cnt = len(cans_fns)
+            cans_fns = [c for c in cans_fns if c[0] not in skip_cans]
+            if len(cans_fns) < cnt:
+                log.info("Skipping %d completed cans", cnt - len(cans_fns))
+                metrics.incr("skipped_can", cnt - len(cans_fns))
+            s3fnames = {source.can_path(conf, fn): fn for fn, _ in cans_fns}
+            can_files = fetch_cans(source, conf, cans_fns)
+            if conf.decode_workers:
+                decoded = decode_cans(can_files, conf.decode_workers)
+            else:
+                decoded = ((f, load_multiple(f.as_posix())) for f in can_files)
+            for cn, (can_f, msmts) in enumerate(decoded):
                 try:
-                    can_f.unlink()
-                except FileNotFoundError:
-                    pass
-
-        day += timedelta(days=1)
+                    n = len(cans_fns)
+                    _update_eta(t0, start_day, day, stop_day, cn, n, conf.shard)
+                    # log.info("can %s ready", can_f.name)
+                    msmt_cnt = 0
+                    for msmt_tup in msmts:
+                        yield msmt_tup
+                        msmt_cnt += 1
+                    if on_can_done:
+                        on_can_done(s3fnames[can_f], msmt_cnt)
+                except Exception as e:
+                    log.error(str(e), exc_info=True)
+
+                remove_can(conf, source, can_f)
+
+            clean_s3_cache(conf.s3cachedir, conf.s3_cache_budget_mb * 1024 * 1024)
+            _update_eta(t0, start_day, day, stop_day, 0, 1, conf.shard)  # day done
+            day += timedelta(days=1)
+    finally:
+        stop_yaml_pool()
 
     if end_day:
         log.info(f"Reached {end_day}, streaming cans from S3 finished")
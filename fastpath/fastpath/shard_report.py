@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Report the progress of a backfill sharded across hosts with --shard i/N
+
+Each fastpath instance sends the statsd gauges
+fastpath.s3feeder.shard.<i>.progress and fastpath.s3feeder.shard.<i>.eta
+that are exported to Prometheus as fastpath_s3feeder_shard_<i>_progress
+and fastpath_s3feeder_shard_<i>_eta. This script queries them.
+
+Usage:
+    python3 -m fastpath.shard_report --prometheus-url http://localhost:9090
+"""
+
+from argparse import ArgumentParser
+from datetime import datetime, timezone
+from typing import Dict, Tuple
+from urllib.parse import urlencode
+from urllib.request import urlopen
+import json
+import re
+
+QUERY = '{__name__=~"fastpath_s3feeder_shard_[0-9]+_(progress|eta)"}'
+METRIC_RE = re.compile(r"fastpath_s3feeder_shard_(\d+)_(progress|eta)")
+
+
+def fetch_gauges(prometheus_url: str) -> list:
+    url = f"{prometheus_url.rstrip('/')}/api/v1/query?" + urlencode(dict(query=QUERY))
+    with urlopen(url, timeout=30) as resp:
+        return json.load(resp)["data"]["result"]
+
+
+def parse_gauges(results: list) -> Dict[Tuple[int, str], Dict[str, float]]:
+    """Returns {(shard, instance): {"progress": ..., "eta": ...}}"""
+    shards: Dict[Tuple[int, str], Dict[str, float]] = {}
+    for r in results:
+        m = METRIC_RE.fullmatch(r["metric"]["__name__"])
+        if not m:
+            continue
+        key = (int(m.group(1)), r["metric"].get("instance", ""))
+        shards.setdefault(key, {})[m.group(2)] = float(r["value"][1])
+    return shards
+
+
+def format_report(shards: Dict[Tuple[int, str], Dict[str, float]]) -> str:
+    lines = [f"{'shard':>5} {'instance':<30} {'progress':>8}  eta"]
+    for (shard, instance), g in sorted(shards.items()):
+        progress = g.get("progress", 0.0) * 100
+        eta = ""
+        if "eta" in g:
+            eta = datetime.fromtimestamp(g["eta"], timezone.utc).strftime("%Y-%m-%d %H:%M")
+        lines.append(f"{shard:>5} {instance:<30} {progress:>7.1f}%  {eta}")
+    return "\n".join(lines)
+
+
+def main() -> None:
+    ap = ArgumentParser(__doc__)
+    ap.add_argument("--prometheus-url", required=True)
+    conf = ap.parse_args()
+    shards = parse_gauges(fetch_gauges(conf.prometheus_url))
+    print(format_report(shards))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,9 +2,13 @@
 Functional tests with a mocked-out Clickhouse database
 """
 
+from copy import deepcopy
 from unittest.mock import Mock
 import datetime
+import json
+import time
 
+import lz4.frame as lz4frame  # debdeps: python3-lz4
 import pytest  # debdeps: python3-pytest
 
 import fastpath.core as core
@@ -32,6 +36,8 @@ def setup_conf():
     core.conf.no_write_to_db = False
     core.conf.db_uri = None
     core.conf.clickhouse_url = "bogus_clickhouse_uri"
+    core.conf.prefetch_cans = 0
+    core.conf.prefetch_budget_mb = 0
 
 
 @pytest.fixture(autouse=True)
@@ -41,6 +47,15 @@ def mockdb():
     fastpath.db.click_client = None
 
 
+def columnar_rows(call) -> list:
+    """Returns the rows of a columnar INSERT as dicts"""
+    query, columns = call.args
+    assert call.kwargs["columnar"] is True
+    names = query[query.index("(") + 1 : query.index(")")].split(",")
+    names = [n.strip() for n in names]
+    return [dict(zip(names, row)) for row in zip(*columns)]
+
+
 # # fingerprints # #
 
 
@@ -51,6 +66,36 @@ def test_prepare_fingerprints():
     assert core.fingerprints == q
 
 
+def test_publish_fingerprints_snapshot(tmp_path, monkeypatch):
+    monkeypatch.setattr(core.conf, "vardir", tmp_path, raising=False)
+    monkeypatch.setattr(core, "fingerprints", core.fingerprints)
+    monkeypatch.setattr(core, "fingerprints_loaded_version", 0)
+    monkeypatch.setattr(core, "_published_digest", b"")
+    monkeypatch.setattr(core.fingerprints_version, "value", 0)
+    fps = (loadj("fingerprints_dns"), loadj("fingerprints_http"))
+    fetch = Mock(side_effect=lambda: deepcopy(fps))
+    monkeypatch.setattr(fastpath.db, "fetch_fingerprints", fetch)
+
+    assert core.publish_fingerprints()
+    assert core.fingerprints_version.value == 1
+    core.fingerprints = core.Fingerprints(dns=[], http=[])
+    core.load_fingerprints_snapshot_if_needed()
+    assert core.fingerprints == core.prepare_fingerprints(*deepcopy(fps))
+    assert len(core.fingerprints.dns_by_pattern) > 100
+    loaded = core.fingerprints
+
+    # Unchanged tables: no new version
+    assert not core.publish_fingerprints()
+    core.load_fingerprints_snapshot_if_needed()
+    assert core.fingerprints is loaded
+
+    fps[0].pop()
+    assert core.publish_fingerprints()
+    core.load_fingerprints_snapshot_if_needed()
+    assert core.fingerprints_loaded_version == 2
+    assert len(core.fingerprints["dns"]) == len(loaded["dns"]) - 1
+
+
 def test_fetch_fingerprints():
     dns_fp, http_fp = fastpath.db.fetch_fingerprints()
 
@@ -127,7 +172,7 @@ def test_score_web_connectivity_bug_610_2(fprints):
         "engine_version, test_helper_address, test_helper_type, ooni_run_link_id ) VALUES "
     )
     assert query == query_exp
-    assert qparams == [
+    assert columnar_rows(exe.call_args) == [
         {
             "measurement_uid": "bogus_uid",
             "report_id": "20220815T190259Z_webconnectivity_IR_197207_n1_OXEdxGds3hbBb6Qd",
@@ -174,7 +219,7 @@ def test_score_browser_web(fprints):
         "engine_version, test_helper_address, test_helper_type, ooni_run_link_id ) VALUES "
     )
     assert query == query_exp
-    assert qparams == [
+    assert columnar_rows(exe.call_args) == [
         {
             "anomaly": "f",
             "architecture": "",
@@ -225,7 +270,7 @@ def test_score_openvpn():
         "engine_version, test_helper_address, test_helper_type, ooni_run_link_id ) VALUES "
     )
     assert query == query_exp
-    assert qparams == [
+    assert columnar_rows(exe.call_args_list[0]) == [
         {
             "measurement_uid": "bogus_uid",
             "report_id": "",
@@ -294,3 +339,367 @@ def test_score_openvpn():
     cols = ", ".join(qparams[0].keys())
     q = query.replace("\n", " ").replace("  ", " ")
     assert q == f"INSERT INTO obs_openvpn ( {cols} ) VALUES "
+
+
+# # write buffers
+
+
+def test_row_buffer_flush_on_max_rows():
+    written = []
+    buf = fastpath.db.RowBuffer("test", written.append, max_rows=3)
+    for n in range(7):
+        buf.append({"n": n})
+    assert [len(rows) for rows in written] == [3, 3]
+    buf.flush()
+    assert [len(rows) for rows in written] == [3, 3, 1]
+    buf.flush()
+    assert len(written) == 3
+
+
+def test_row_buffer_flush_on_age(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(fastpath.db.time, "monotonic", lambda: now[0])
+    written = []
+    buf = fastpath.db.RowBuffer("test", written.append, max_rows=100, max_age_s=2.0)
+    buf.append({"n": 1})
+    now[0] += 1
+    buf.append({"n": 2})
+    buf.flush_if_needed()
+    assert written == []
+    now[0] += 1
+    buf.flush_if_needed()
+    assert written == [[{"n": 1}, {"n": 2}]]
+
+
+def test_column_buffer():
+    written = []
+    buf = fastpath.db.ColumnBuffer("test", written.append, ("a", "b"), max_rows=2)
+    buf.on_flush = written.append
+    buf.append((1, "x"))
+    assert written == []
+    buf.append((2, "y"))
+    buf.append((3, "z"))
+    assert written == [{"a": [1, 2], "b": ["x", "y"]}] * 2
+    buf.flush()
+    assert written[2] == {"a": [3], "b": ["z"]}
+    with pytest.raises(AssertionError):
+        buf.append((4,))
+
+
+def test_buffered_writes_retry(monkeypatch):
+    monkeypatch.setattr(fastpath.db.time, "sleep", lambda s: None)
+    exe = fastpath.db.click_client.execute
+    exe.side_effect = [Exception("boom"), None, None]
+    msm = loadj("openvpn")
+    core.process_measurement((None, msm, "bogus_uid"), buffer_writes=True)
+    assert exe.call_count == 0
+    fastpath.db.flush_buffers()
+    # fastpath: failure and retry, obs_openvpn: success
+    assert exe.call_count == 3
+    assert exe.call_args_list[0] == exe.call_args_list[1]
+    assert exe.call_args_list[2].args[0].startswith("INSERT INTO obs_openvpn")
+
+
+# # backfill
+
+
+def test_backfill_can(tmp_path, monkeypatch):
+    import fastpath.s3feeder as s3feeder
+
+    monkeypatch.setattr(core.conf, "s3cachedir", tmp_path, raising=False)
+    monkeypatch.setattr(core.conf, "keep_s3_cache", False, raising=False)
+    checkpoint_file = tmp_path / "backfill_checkpoint.jsonl"
+    monkeypatch.setattr(core.conf, "checkpoint_file", checkpoint_file, raising=False)
+    monkeypatch.setattr(core, "fingerprints_update_time", time.time() + 3600)
+    # The can is in the local cache: no S3 client is needed
+    monkeypatch.setattr(core, "backfill_source", s3feeder.S3CanSource(None))
+    monkeypatch.setattr(core, "unflushed_cans", [])
+    monkeypatch.setattr(core, "last_checkpoint_t", time.monotonic())
+    lines = [json.dumps(loadj(fn)) for fn in ("browser_web", "web_connectivity_null2")]
+    s3fnames = []
+    for n in range(2):
+        canf = tmp_path / "2023-03-20" / f"browser_web.0{n}.json.lz4"
+        canf.parent.mkdir(exist_ok=True)
+        with lz4frame.open(canf, "wb") as f:
+            f.write("\n".join(lines).encode())
+
+        s3fname = f"canned/2023-03-20/{canf.name}"
+        s3fnames.append(s3fname)
+        assert core.backfill_can((s3fname, canf.stat().st_size)) == 2
+        assert not canf.exists()
+
+    # Rows are buffered across cans and the cans are not recorded yet
+    exe = fastpath.db.click_client.execute
+    assert exe.call_count == 0
+    assert not checkpoint_file.exists() or checkpoint_file.read_text() == ""
+
+    core.checkpoint()
+    assert exe.call_count == 1
+    rows = columnar_rows(exe.call_args)
+    assert [r["test_name"] for r in rows] == ["browser_web", "web_connectivity"] * 2
+    done = [json.loads(li)["can"] for li in checkpoint_file.read_text().splitlines()]
+    assert done == s3fnames
+
+
+def test_backfill_can_stop(tmp_path, monkeypatch):
+    import multiprocessing as mp
+
+    import fastpath.s3feeder as s3feeder
+
+    checkpoint_file = tmp_path / "backfill_checkpoint.jsonl"
+    monkeypatch.setattr(core.conf, "checkpoint_file", checkpoint_file, raising=False)
+    monkeypatch.setattr(core, "backfill_source", s3feeder.S3CanSource(None))
+    monkeypatch.setattr(core, "unflushed_cans", [])
+    stop = mp.Event()
+    stop.set()
+    monkeypatch.setattr(core, "backfill_stop", stop)
+    assert core.backfill_can(("canned/2023-03-20/browser_web.00.json.lz4", 1)) == 0
+    assert core.unflushed_cans == []
+
+
+def test_decode_cans(tmp_path):
+    import io
+    import tarfile
+
+    import fastpath.s3feeder as s3feeder
+
+    lines = [json.dumps(loadj(fn)) for fn in ("browser_web", "web_connectivity_null2")]
+    jcan = tmp_path / "browser_web.00.json.lz4"
+    with lz4frame.open(jcan, "wb") as f:
+        f.write("\n".join(lines * 600).encode())
+
+    minican = tmp_path / "20210614_JO_signal.n0.0.tar.gz"
+    with tarfile.open(minican, "w:gz") as tf:
+        for n in range(3):
+            post = json.dumps(dict(format="json", content=loadj("signal_022")))
+            ti = tarfile.TarInfo(f"2021061400/{n}0210614004521.999962_JO_signal_0.post")
+            ti.size = len(post)
+            tf.addfile(ti, io.BytesIO(post.encode()))
+
+    bogus = tmp_path / "bogus.txt"
+    bogus.write_text("")
+    cans = [jcan, minican, bogus, jcan]
+    out = []
+    for can_f, msmts in s3feeder.decode_cans(cans, 2):
+        try:
+            out.append((can_f, list(msmts)))
+        except RuntimeError:
+            out.append((can_f, None))
+
+    assert [c for c, _ in out] == cans
+    assert out[0][1] == list(s3feeder.load_multiple(jcan.as_posix()))
+    assert len(out[0][1]) == 1200
+    assert [m[2] for m in out[1][1]] == [
+        f"{n}0210614004521.999962_JO_signal_0" for n in range(3)
+    ]
+    assert out[2][1] is None
+    assert out[3][1] == out[0][1]
+
+
+def test_msm_processor_sigterm(monkeypatch):
+    import os
+    import signal
+
+    monkeypatch.setattr(core.conf, "write_buffer_ms", 100, raising=False)
+    monkeypatch.setattr(core.conf, "write_buffer_rows", 1000, raising=False)
+    monkeypatch.setattr(core.db, "setup_clickhouse", Mock())
+    monkeypatch.setattr(core.db, "flush_buffers", Mock())
+    monkeypatch.setattr(core, "load_fingerprints_snapshot_if_needed", Mock())
+    monkeypatch.setattr(core, "process_measurement", Mock())
+    monkeypatch.setattr(core, "worker_stopping", False)
+    body = json.dumps(loadj("browser_web")).encode()
+
+    def get(timeout, lane):
+        # SIGTERM while a measurement is being read
+        os.kill(os.getpid(), signal.SIGTERM)
+        return memoryview(body), "20210101T000000Z_a"
+
+    ringbuf = Mock(get=Mock(side_effect=get))
+    old_handler = signal.getsignal(signal.SIGTERM)
+    try:
+        core.msm_processor(ringbuf)
+    finally:
+        signal.signal(signal.SIGTERM, old_handler)
+
+    # The measurement is processed, then the buffered rows are written
+    assert ringbuf.get.call_count == 1
+    assert core.process_measurement.call_count == 1
+    assert core.db.flush_buffers.call_count == 1
+
+
+def test_decode_cans_one_worker(tmp_path):
+    import multiprocessing as mp
+
+    import fastpath.s3feeder as s3feeder
+
+    cans = []
+    for n in range(4):
+        lines = [json.dumps(loadj("browser_web"))] * (n + 1) * 400
+        canf = tmp_path / f"browser_web.0{n}.json.lz4"
+        with lz4frame.open(canf, "wb") as f:
+            f.write("\n".join(lines).encode())
+        cans.append(canf)
+
+    children = len(mp.active_children())
+    counts = []
+    for n, (can_f, msmts) in enumerate(s3feeder.decode_cans(cans, 1)):
+        # The same decoder process is used for all the cans
+        assert len(mp.active_children()) == children + 1
+        if n == 1:
+            # Stop early: the rest of the can is skipped
+            next(msmts)
+            counts.append(None)
+            continue
+        counts.append(len(list(msmts)))
+
+    assert counts == [400, None, 1200, 1600]
+    assert len(mp.active_children()) == children
+
+
+def test_decode_cans_restart_dead_decoder(tmp_path):
+    import multiprocessing as mp
+    import os
+    import signal
+
+    import fastpath.s3feeder as s3feeder
+
+    cans = []
+    for n in range(4):
+        lines = [json.dumps(loadj("browser_web"))] * (n + 1) * 2
+        canf = tmp_path / f"browser_web.0{n}.json.lz4"
+        with lz4frame.open(canf, "wb") as f:
+            f.write("\n".join(lines).encode())
+        cans.append(canf)
+
+    children = {p.pid for p in mp.active_children()}
+    counts = []
+    for n, (can_f, msmts) in enumerate(s3feeder.decode_cans(cans, 1)):
+        decoders = [p for p in mp.active_children() if p.pid not in children]
+        assert len(decoders) == 1
+        if n == 1:
+            # Kill the decoder holding the remaining cans
+            os.kill(decoders[0].pid, signal.SIGKILL)
+            decoders[0].join()
+            try:
+                counts.append(len(list(msmts)))
+            except RuntimeError:
+                counts.append(None)  # killed before sending the whole can
+            continue
+        counts.append(len(list(msmts)))
+
+    # The cans queued to the dead decoder are decoded by its replacement
+    assert counts[0] == 2 and counts[1] in (4, None)
+    assert counts[2:] == [6, 8]
+    assert {p.pid for p in mp.active_children()} == children
+
+
+# # reprocessor
+
+
+def _reprocess(rp, conf, pipeline, samples: list, count: int) -> list:
+    """Feed measurements to the reprocessor. Returns their UIDs"""
+    from fastpath.uidset import UIDSet
+
+    buf: dict = {}
+    seen_uids = UIDSet(10**6)
+    can_fn = "canned/2015-01-01/web_connectivity.00.tar.lz4"
+    uids = []
+    for n in range(count):
+        msm = deepcopy(samples[n % len(samples)])
+        msm["report_id"] = f"report_{n}"
+        msmt_uid = f"20150101000000.{n:06d}_IT_webconnectivity_{n:016x}"
+        rp.process_measurement(can_fn, (None, msm, msmt_uid), buf, seen_uids, conf, pipeline)
+        uids.append(msmt_uid)
+    for entities in buf.values():
+        for e in entities:
+            if not e.fd.closed:
+                rp.finalize_jsonl(pipeline, e)
+    return uids
+
+
+@pytest.mark.parametrize("s3mode", ["dryrun", "create"])
+def test_reprocessor_jsonl_pipeline(tmp_path, monkeypatch, s3mode):
+    import gzip
+    import io
+    from argparse import Namespace
+
+    import fastpath.reprocessor as rp
+
+    samples = [loadj("browser_web"), loadj("web_connectivity_null2")]
+    monkeypatch.chdir(tmp_path)
+    # Many chunks for each jsonl file and many jsonl files
+    monkeypatch.setattr(rp, "JSONL_THRESHOLD", 40_000)
+    monkeypatch.setattr(rp, "JSONL_CHUNK_SIZE", 5_000)
+    uploaded = {}
+
+    def upload_to_s3(s3, bucket_name, jsonlf, s3path):
+        data = gzip.decompress(jsonlf.read_bytes())
+        uploaded[s3path] = data.splitlines()
+        # Same size as written by earlier runs, as compared by s3_check
+        ref = io.BytesIO()
+        with gzip.GzipFile(jsonlf.name, "wb", fileobj=ref) as f:
+            f.write(data)
+        assert jsonlf.stat().st_size == len(ref.getvalue())
+
+    monkeypatch.setattr(rp, "create_s3_client", lambda conf: None)
+    monkeypatch.setattr(rp, "upload_to_s3", upload_to_s3)
+    conf = Namespace(
+        day=datetime.date(2015, 1, 1),
+        s3mode=s3mode,
+        jsonlmode="insert",
+        fastpathmode="dryrun",
+        dst_bucket="bucket",
+        compress_workers=2,
+        upload_workers=2,
+    )
+    db_conn = Mock()
+    pipeline = rp.JsonlPipeline(db_conn, conf)
+    uids = _reprocess(rp, conf, pipeline, samples, 60)
+    pipeline.close()
+
+    rows = [r for c in db_conn.execute.call_args_list for r in c.args[1]]
+    assert sorted(r[2] for r in rows) == uids
+    by_path: dict = {}
+    for rid, _, _, s3path, linenum, date, _ in rows:
+        assert s3path.startswith("jsonl/") and "/20150101/00/" in s3path
+        assert date == datetime.date(2015, 1, 1)
+        by_path.setdefault(s3path, {})[linenum] = rid
+    assert len(by_path) > 1
+
+    if s3mode == "create":
+        # The chunks of each file are in order
+        assert uploaded.keys() == by_path.keys()
+        for s3path, lines in uploaded.items():
+            rids = [json.loads(line)["report_id"] for line in lines]
+            assert rids == [by_path[s3path][n] for n in range(len(lines))]
+    else:
+        assert not uploaded
+
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_reprocessor_jsonl_pipeline_shutdown(tmp_path, monkeypatch):
+    from argparse import Namespace
+
+    import fastpath.reprocessor as rp
+    from fastpath.uidset import UIDSet
+
+    msm = loadj("browser_web")
+    monkeypatch.chdir(tmp_path)
+    conf = Namespace(
+        day=datetime.date(2015, 1, 1),
+        s3mode="dryrun",
+        jsonlmode="dryrun",
+        fastpathmode="dryrun",
+        compress_workers=1,
+        upload_workers=1,
+    )
+    pipeline = rp.JsonlPipeline(Mock(), conf)
+    buf: dict = {}
+    can_fn = "canned/2015-01-01/web_connectivity.00.tar.lz4"
+    msm_tup = (None, msm, "20150101000000.000000_IT_webconnectivity_0")
+    rp.process_measurement(can_fn, msm_tup, buf, UIDSet(10**6), conf, pipeline)
+    assert len(list(tmp_path.iterdir())) == 1
+    # After an error the partial jsonl files are deleted
+    pipeline.shutdown()
+    assert list(tmp_path.iterdir()) == []
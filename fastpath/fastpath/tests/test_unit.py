@@ -2,18 +2,31 @@
 # Fastpath - unit tests
 #
 
+from argparse import Namespace
 from pathlib import Path
-from datetime import date
+from datetime import date, datetime, timedelta
+from queue import Empty
+import os
+import time
+import threading
 
 import pytest
 import json
+import yaml
 
 from fastpath.utils import trivial_id
+from fastpath.benchmark import load_corpus
 from fastpath.db import extract_input_domain
+from fastpath.localhttpfeeder import parse_batch
+from fastpath.matchers import BodyMatcher, HeaderMatcher, regexp_literal_prefix
+from fastpath.ringbuffer import MAX_OVERSIZE, RingBuffer
+from fastpath.shard_report import format_report, parse_gauges
+from fastpath.uidset import UIDSet
 import fastpath.core as fp
 import fastpath.core as core
 import fastpath.s3feeder as s3feeder
 from fastpath.normalize import iter_yaml_msmt_normalized
+import fastpath.normalize as normalize
 
 
 scores_failed = {
@@ -151,6 +164,20 @@ def test_match_dns_fingerprints_match_country(fprints):
     ]
 
 
+def test_match_dns_fingerprints_many_answers(fprints):
+    answers = [
+        {"ipv4": "202.3.219.209"},
+        {"ipv6": "::1"},
+        {"hostname": "10.10.34.34"},
+        {"ipv4": None},
+        {"answer_type": "A"},
+    ]
+    msm = {"probe_cc": "ID", "test_keys": {"queries": [{"answers": answers}, {}]}}
+    matches = fp.match_fingerprints(msm)
+    # Fingerprints sharing the same pattern are all matched in table order
+    assert [m["name"] for m in matches] == ["ooni.id_40", "ooni.id_dns_106", "ooni.ir_4"]
+
+
 def test_match_fingerprints_dict_body(fprints):
     # from 20200108T054856Z-web_connectivity-20200109T102441Z_AS42610_613KNyjuQqiuloY1a391dhZccSDz9M1MD30P6EpUIWSByjcq4T-AS42610-RU-probe-0.2.0.json
     msm = {
@@ -173,7 +200,143 @@ def test_match_fingerprints_dict_body(fprints):
 
 def test_match_fingerprints_b64_hdr(fprints):
     msm = loadj("web_connectivity_b64_hdr.json")
-    assert fp.match_fingerprints(msm) == []
+    # The base64 Location header contains /UserCheck/PortalMain?IID=
+    matches = fp.match_fingerprints(msm)
+    assert [m["name"] for m in matches] == ["cl.prod_checkpoint_urlfilter_forward"]
+
+
+def test_match_fingerprints_headers(fprints):
+    resp = {
+        "headers": {
+            "server": "SonicWALL",
+            "Location": "http://www.bluecoat.com/notify-NotifyUser1?x=1",
+        }
+    }
+    msm = {"probe_cc": "AE", "test_keys": {"requests": [{"response": resp}]}}
+    matches = fp.match_fingerprints(msm)
+    assert [m["name"] for m in matches] == ["ooni.ae_1", "ooni.br_1"]
+
+
+def test_header_matcher():
+    m = HeaderMatcher(
+        [
+            ("location", "prefix", "http://a.org/"),
+            ("server", "full", "foo"),
+            ("location", "prefix", "http://a.org/blocked"),
+            ("location", "prefix", "http://b.org/"),
+            ("location", "contains", "a.org"),
+            ("server", "prefix", "fo"),
+            ("server", "full", "foo"),
+        ]
+    )
+    assert m.search({}) == []
+    assert m.search({"server": "foo"}) == [1, 5, 6]
+    hdrs = {"server": "fooo", "location": "http://a.org/blocked.html"}
+    assert m.search(hdrs) == [0, 2, 4, 5]
+    b64 = {"format": "base64", "data": "aHR0cDovL2Iub3JnL3g="}  # http://b.org/x
+    assert m.search({"location": b64, "server": {"bogus": 1}}) == [3]
+    assert m.search({"location": "http://a.org"}) == [4]
+    assert m.search({"location": "http://c.org"}) == []
+
+
+def test_header_matcher_regexp():
+    m = HeaderMatcher(
+        [
+            ("location", "regexp", r"block(ed)?\.php\?"),
+            ("location", "contains", "warning"),
+            ("via", "regexp", r"^1\.1 [a-z]+-proxy"),
+            ("via", "regexp", "[invalid"),
+        ]
+    )
+    assert m.search({"location": "http://x.net/blocked.php?u=1"}) == [0]
+    b64 = {"format": "base64", "data": "aHR0cDovL3gubmV0L3dhcm5pbmcvYmxvY2sucGhwPw=="}
+    assert m.search({"location": b64}) == [0, 1]  # http://x.net/warning/block.php?
+    assert m.search({"via": "1.1 squid-proxy", "location": "/"}) == [2]
+    assert m.search({"via": "HTTP/1.1 squid-proxy"}) == []
+
+
+def _body_with_patterns():
+    # Mixes ASCII and non-ASCII patterns taken from the fingerprints table
+    pats = [f["pattern"] for f in loadj("fingerprints_http") if f["location_found"] == "body"]
+    return pats, "<html>" + "".join(p for p in pats[::37]) + "x" * 100_000 + pats[5]
+
+
+def test_body_matcher_same_as_find():
+    pats, body = _body_with_patterns()
+    pats += ["", pats[3]]  # empty and duplicate patterns
+    m = BodyMatcher(pats)
+    expected = {n: body.find(p) for n, p in enumerate(pats) if body.find(p) != -1}
+    assert len(expected) > 30
+    assert m.search(body) == expected
+    assert BodyMatcher(pats, use_automaton=False).search(body) == expected
+
+    bbody = body.encode()
+    expected = {n: bbody.find(p.encode()) for n, p in enumerate(pats) if p.encode() in bbody}
+    assert m.search(bbody) == expected
+    assert BodyMatcher(pats, use_automaton=False).search(bbody) == expected
+
+
+def test_body_matcher_pattern_types():
+    pats = ["<HTML></HTML>", "<html>", "Sorry, .* is prohibited", "(a|b)\\1x", "foo"]
+    types = ["full", "prefix", "regexp", "regexp", "contains"]
+    for use_automaton in (True, False):
+        m = BodyMatcher(pats, use_automaton=use_automaton, pattern_types=types)
+        assert m.search("<HTML></HTML>") == {0: 0}
+        assert m.search(" <HTML></HTML>") == {}
+        assert m.search("<html>foo bbx") == {1: 0, 3: 10, 4: 6}
+        body = "<html>Sorry, the URL is prohibited foo"
+        assert m.search(body) == {1: 0, 2: 6, 4: 35}
+        assert m.search(body.encode()) == {1: 0, 2: 6, 4: 35}
+        assert m.search("Sorry, \n is prohibited") == {}
+
+
+def test_body_matcher_regexps_overlapping():
+    # All the regexps matching are found, not only the first one
+    pats = ["abc.*xyz", "b.*y", "zz+", "[broken"]
+    m = BodyMatcher(pats, pattern_types=["regexp"] * 4)
+    assert m.search("..abc..xyzz") == {0: 2, 1: 3, 2: 9}
+    assert m.search(b"..abc..xyzz") == {0: 2, 1: 3, 2: 9}
+    assert m.search("abc") == {}
+
+
+def test_body_matcher_regexp_without_prefix():
+    # No literal prefix: the regexps are run on every body. (?u) is only valid
+    # for str regexps
+    pats = [r"\d+ days", r"(?u)\w+ prohibited", "foo"]
+    types = ["regexp", "regexp", "contains"]
+    for use_automaton in (True, False):
+        m = BodyMatcher(pats, use_automaton=use_automaton, pattern_types=types)
+        assert m.search("in 12 days: café prohibited") == {0: 3, 1: 12}
+        assert m._bregexps is None  # not compiled for bytes until needed
+        assert m.search(b"in 12 days: foo prohibited") == {0: 3, 2: 12}
+
+
+def test_regexp_literal_prefix():
+    assert regexp_literal_prefix("Set-Cookie:.*domain=") == "Set-Cookie:"
+    assert regexp_literal_prefix(r"U\.S\..*Command") == "U.S."
+    assert regexp_literal_prefix(r"You don.t") == "You don"
+    assert regexp_literal_prefix("colou?r") == "colo"
+    assert regexp_literal_prefix("ab+c") == "ab"
+    assert regexp_literal_prefix(r"\d+ days") == ""
+    assert regexp_literal_prefix("foo|bar") == ""
+    assert regexp_literal_prefix("(?i)foo") == ""
+
+
+def test_body_matcher_empty():
+    assert BodyMatcher([]).search("foo") == {}
+    assert BodyMatcher(["bar"]).search(b"foo") == {}
+
+
+def benchmark_body_matcher(benchmark):
+    # debdeps: python3-pytest-benchmark
+    pats, body = _body_with_patterns()
+    benchmark(BodyMatcher(pats).search, body)
+
+
+def benchmark_body_matcher_find_each(benchmark):
+    # debdeps: python3-pytest-benchmark
+    pats, body = _body_with_patterns()
+    benchmark(BodyMatcher(pats, use_automaton=False).search, body)
 
 
 def test_score_web_connectivity_dns_ir_fingerprint(fprints):
@@ -234,6 +397,68 @@ def test_yaml_normalization_binary_city():
     json.dumps(msm)  # should not raise
 
 
+YAML_FIXTURES = sorted(Path("fastpath/tests/data").glob("*.yaml"))
+# Bucket day of the YAML fixtures, if known
+YAML_FIXTURE_DAYS = {
+    "dns_n_http_bin_body": "2015-09-03",
+    "binary_city": "2015-11-05",
+    "http_invalid_request_line": "2018-07-27",
+}
+
+
+def _normalize_yaml_samples():
+    out = []
+    for f in YAML_FIXTURES:
+        day = YAML_FIXTURE_DAYS.get(f.stem, "2016-01-01")
+        with f.open("rb") as fd:
+            out.extend(iter_yaml_msmt_normalized(fd, day, f"{day}/bogus_fname.yaml"))
+    return json.dumps(out, sort_keys=True)
+
+
+def test_yaml_normalization_libyaml_identical(monkeypatch):
+    if normalize.CSafeLoader is None:
+        pytest.skip("LibYAML not available")
+    assert YAML_FIXTURES
+    for f in YAML_FIXTURES:
+        data = f.read_bytes()
+        fast = list(yaml.load_all(data, Loader=normalize.CSafeLoader))
+        assert fast == list(yaml.load_all(data, Loader=yaml.SafeLoader)), f
+
+    fast = _normalize_yaml_samples()
+    monkeypatch.setattr(normalize, "CSafeLoader", None)
+    assert _normalize_yaml_samples() == fast
+
+
+def test_yaml_normalization_fallback():
+    # Entries that fail to parse are skipped in the same way
+    raw = b"---\nfoo: [1, 2\n...\n"
+    with pytest.raises(yaml.YAMLError):
+        normalize.safe_load(raw)
+    assert normalize.safe_load(b"---\nfoo: !!binary aGk=\n...\n") == {"foo": b"hi"}
+
+
+def test_yaml_normalization_pool(monkeypatch):
+    inline = _normalize_yaml_samples()
+    monkeypatch.setattr(normalize, "YAML_POOL_CHUNK", 1)
+    normalize.start_yaml_pool(2)
+    try:
+        assert _normalize_yaml_samples() == inline
+    finally:
+        normalize.stop_yaml_pool()
+    assert normalize.yaml_pool is None
+
+
+def test_simhash_numpy():
+    if normalize.no_numpy:
+        pytest.skip("numpy not available")
+    samples = ["", "hello", "".join(str(x) for x in range(1000))]
+    samples.append("Ünïcödé 中文字符 " * 100)
+    with load_yaml("http_invalid_request_line") as f:
+        samples.append(f.read().decode())
+    for s in samples:
+        assert normalize.gen_simhash_np(s) == normalize.gen_simhash_py(s)
+
+
 # Follow the order in score_measurement
 
 # # test_name: telegram
@@ -834,6 +1059,230 @@ def test_s3feeder_eta():
     assert etr / 3600 == 1.0
 
 
+class MockS3:
+    """Writes <size> bytes for each downloaded can and records the download
+    order"""
+
+    def __init__(self):
+        self.downloaded = []
+        self._cond = threading.Condition()
+
+    def download_fileobj(self, bucket_name, s3fname, f, Callback=None):
+        size = int(s3fname.rsplit("_", 1)[1].split(".")[0])
+        f.write(b"x" * size)
+        Callback(size)
+        with self._cond:
+            self.downloaded.append(s3fname)
+            self._cond.notify_all()
+
+    def wait_downloaded(self, n, timeout=10):
+        """Wait until at least <n> cans have been downloaded"""
+        with self._cond:
+            assert self._cond.wait_for(lambda: len(self.downloaded) >= n, timeout)
+
+
+def test_fetch_cans_prefetch(tmp_path):
+    conf = Namespace(s3cachedir=tmp_path, prefetch_cans=2, prefetch_budget_mb=1)
+    sizes = (10, 20, 900_000, 300_000, 5)
+    files = [(f"canned/2020-01-01/can{n}_{size}.json.lz4", size) for n, size in enumerate(sizes)]
+    # can1 is already in the local cache
+    (tmp_path / "2020-01-01").mkdir()
+    (tmp_path / "2020-01-01/can1_20.json.lz4").write_bytes(b"y" * 20)
+    s3 = MockS3()
+    fetched = []
+    for diskf in s3feeder.fetch_cans(s3feeder.S3CanSource(s3), conf, files):
+        fetched.append(diskf.name)
+        assert diskf.stat().st_size == int(diskf.name.split("_")[1].split(".")[0])
+        if diskf.name.startswith("can0"):
+            # can2 is prefetched while can0 is being processed, can3 does
+            # not fit in the budget
+            s3.wait_downloaded(2)
+            assert sorted(s3.downloaded) == [files[0][0], files[2][0]]
+
+    assert fetched == [f[0].split("/")[-1] for f in files]
+    assert len(s3.downloaded) == 4
+    assert not list(tmp_path.glob("**/*.s3tmp"))
+
+
+def test_clean_s3_cache(tmp_path, monkeypatch):
+    now = time.time()
+    day = tmp_path / "2020-01-01"
+    day.mkdir()
+    (tmp_path / "2020-01-02").mkdir()  # empty
+    for n, age in enumerate((300, 100, 200, 400)):
+        f = day / f"can{n}.json.lz4"
+        f.write_bytes(b"x" * 100)
+        os.utime(f, (now - age, now - age))
+    orphan = day / "can9.s3tmp"
+    orphan.write_bytes(b"x")
+    os.utime(orphan, (now - 7200, now - 7200))
+    (day / "can8.s3tmp").write_bytes(b"x")  # being downloaded
+    # Minicans are stored in nested directories
+    minican = tmp_path / "20200101/00/IT/webconnectivity/2020010100_IT_webconnectivity.n0.0.tar.gz"
+    minican.parent.mkdir(parents=True)
+    minican.write_bytes(b"x" * 100)
+    os.utime(minican, (now - 500, now - 500))
+    (tmp_path / "20200101/05/US/dnscheck").mkdir(parents=True)  # empty
+    monkeypatch.setattr(s3feeder, "cache_stats", dict(hits=0, misses=0, bytes_saved=0))
+
+    s3feeder.clean_s3_cache(tmp_path, 250)
+
+    # The least recently used cans are evicted
+    left = sorted(f.name for f in day.iterdir())
+    assert left == ["can1.json.lz4", "can2.json.lz4", "can8.s3tmp"]
+    assert not (tmp_path / "2020-01-02").exists()
+    assert not (tmp_path / "20200101").exists()
+    assert tmp_path.exists()
+
+    # A cache hit updates the last use time
+    conf = Namespace(s3cachedir=tmp_path, prefetch_cans=0, prefetch_budget_mb=0)
+    files = [("canned/2020-01-01/can2.json.lz4", 100)]
+    source = s3feeder.S3CanSource(None)
+    assert list(s3feeder.fetch_cans(source, conf, files)) == [day / "can2.json.lz4"]
+    assert s3feeder.cache_stats == dict(hits=1, misses=0, bytes_saved=100)
+    s3feeder.clean_s3_cache(tmp_path, 150)
+    assert sorted(f.name for f in day.iterdir()) == ["can2.json.lz4", "can8.s3tmp"]
+
+
+def test_local_can_source(tmp_path):
+    mirror = tmp_path / "mirror"
+    for fn in (
+        "canned/2020-01-01/web_connectivity.00.tar.lz4",
+        "canned/2020-01-02/web_connectivity.00.tar.lz4",
+        "raw/20200101/00/IT/webconnectivity/2020010100_IT_webconnectivity.n0.0.tar.gz",
+        "raw/20200101/05/US/webconnectivity/2020010105_US_webconnectivity.n0.0.tar.gz",
+        "raw/20200101/05/US/dnscheck/2020010105_US_dnscheck.n0.0.tar.gz",
+    ):
+        (mirror / fn).parent.mkdir(parents=True, exist_ok=True)
+        (mirror / fn).write_bytes(b"x" * 10)
+
+    source = s3feeder.LocalCanSource(mirror)
+    day = date(2020, 1, 1)
+    assert source.list_cans(day) == [("canned/2020-01-01/web_connectivity.00.tar.lz4", 10)]
+    mc = source.list_minicans(day, {"US"}, {"webconnectivity"})
+    assert mc == [("raw/20200101/05/US/webconnectivity/2020010105_US_webconnectivity.n0.0.tar.gz", 10)]
+    assert len(source.list_minicans(day, set(), set())) == 3
+
+    # Cans are read in place and not deleted after processing
+    conf = Namespace(s3cachedir=tmp_path / "s3", prefetch_cans=2, prefetch_budget_mb=1)
+    conf.keep_s3_cache = False
+    files = s3feeder.list_cans(source, Namespace(ccs=set(), testnames=set(), shard=None), day)
+    fetched = list(s3feeder.fetch_cans(source, conf, files))
+    assert fetched == [mirror / fn for fn, _ in files]
+    for can_f in fetched:
+        s3feeder.remove_can(conf, source, can_f)
+        assert can_f.is_file()
+    assert not conf.s3cachedir.exists()
+
+
+def test_local_can_source_mirror(tmp_path):
+    s3 = MockS3()
+    source = s3feeder.LocalCanSource(tmp_path / "mirror", s3feeder.S3CanSource(s3))
+    conf = Namespace(s3cachedir=tmp_path / "s3", prefetch_cans=2, prefetch_budget_mb=1)
+    files = [("canned/2020-01-01/can0_10.json.lz4", 10)]
+    for _ in range(2):
+        fetched = list(s3feeder.fetch_cans(source, conf, files))
+        assert fetched == [tmp_path / "mirror/canned/2020-01-01/can0_10.json.lz4"]
+
+    # Cans missing from the mirror are downloaded only once
+    assert s3.downloaded == ["canned/2020-01-01/can0_10.json.lz4"]
+
+
+class MockS3Listing:
+    """Lists 1500 minicans for each day in pages of 1000 and records the
+    list_objects_v2 calls"""
+
+    def __init__(self):
+        self.calls = []
+
+    def list_objects_v2(self, Bucket, Prefix, ContinuationToken=None):
+        self.calls.append((Bucket, Prefix, ContinuationToken))
+        if Prefix.startswith("canned/"):
+            return dict(Contents=[dict(Key=f"{Prefix}a.tar.lz4", Size=10)])
+        tstamp = Prefix.split("/")[1]
+        keys = [
+            f"{Prefix}00/{cc}/webconnectivity/{tstamp}00_{cc}_webconnectivity.n{n}.tar.gz"
+            for n in range(750)
+            for cc in ("IT", "US")
+        ]
+        start = int(ContinuationToken or 0)
+        r = dict(Contents=[dict(Key=k, Size=1) for k in keys[start : start + 1000]])
+        if start + 1000 < len(keys):
+            r["NextContinuationToken"] = str(start + 1000)
+        return r
+
+
+def test_s3_listing_cache(tmp_path):
+    s3 = MockS3Listing()
+    source = s3feeder.S3CanSource(s3, listing_cachedir=tmp_path)
+    day = date(2021, 1, 1)
+    for _ in range(2):
+        assert len(source.list_minicans(day, set(), set())) == 1500
+        assert len(source.list_minicans(day, {"IT"}, set())) == 750
+        assert source.list_cans(day) == [("canned/2021-01-01/a.tar.lz4", 10)]
+
+    # Past days are listed only once. Listings are cached before filtering
+    assert len(s3.calls) == 3
+    assert (tmp_path / "ooni-data-eu-fra/raw/2021-01-01.json").is_file()
+
+    # Recent days are listed every time
+    s3.calls = []
+    today = date.today()
+    for _ in range(2):
+        assert len(source.list_minicans(today, set(), set())) == 1500
+    assert len(s3.calls) == 4
+    assert not (tmp_path / f"ooni-data-eu-fra/raw/{today}.json").exists()
+
+
+def test_backfill_checkpoint(tmp_path):
+    cpf = tmp_path / "backfill_checkpoint.jsonl"
+    assert s3feeder.load_checkpoint(cpf) == set()
+    s3feeder.mark_can_done(cpf, "canned/2020-01-01/a.json.lz4", 3)
+    s3feeder.mark_can_done(cpf, "raw/20200101/00/IT/webconnectivity/b.tar.gz", 0)
+    # Line truncated by a crash
+    with cpf.open("a") as f:
+        f.write('{"can": "canned/2020-01-01/c.')
+    done = s3feeder.load_checkpoint(cpf)
+    assert done == {
+        "canned/2020-01-01/a.json.lz4",
+        "raw/20200101/00/IT/webconnectivity/b.tar.gz",
+    }
+    s3feeder.mark_can_done(cpf, "canned/2020-01-01/d.json.lz4", 1)
+    assert len(s3feeder.load_checkpoint(cpf)) == 3
+
+
+def test_shards():
+    assert core.parse_shard("2/4") == (2, 4)
+    with pytest.raises(ValueError):
+        core.parse_shard("4/4")
+    cans = [f"canned/2020-01-01/can{n}.json.lz4" for n in range(200)]
+    assert all(s3feeder.in_shard(c, None) for c in cans)
+    shards = [[c for c in cans if s3feeder.in_shard(c, (i, 3))] for i in range(3)]
+    # Disjoint, complete and reasonably balanced
+    assert sorted(sum(shards, [])) == sorted(cans)
+    assert all(40 < len(s) < 90 for s in shards)
+    assert shards[0] == [c for c in cans if s3feeder.in_shard(c, (0, 3))]
+
+
+def test_shard_report():
+    results = [
+        {
+            "metric": {"__name__": "fastpath_s3feeder_shard_1_progress", "instance": "b"},
+            "value": [0, "0.5"],
+        },
+        {
+            "metric": {"__name__": "fastpath_s3feeder_shard_0_eta", "instance": "a"},
+            "value": [0, "1600000000"],
+        },
+        {"metric": {"__name__": "other"}, "value": [0, "1"]},
+    ]
+    shards = parse_gauges(results)
+    assert shards == {(1, "b"): {"progress": 0.5}, (0, "a"): {"eta": 1600000000.0}}
+    report = format_report(shards).splitlines()
+    assert report[1].split() == ["0", "a", "0.0%", "2020-09-13", "12:26"]
+    assert report[2].split() == ["1", "b", "50.0%"]
+
+
 @pytest.mark.skip(reason="Broken")
 def test_get_http_header():
     h = {
@@ -896,3 +1345,326 @@ def test_prepare_fingerprints():
         ],
         "http": [],
     }
+
+
+def test_parse_batch():
+    data = b'20210101T000000Z_a\t{"a": 1}\n\n20210101T000001Z_b\t{"b":\t2}\n'
+    assert list(parse_batch(data)) == [
+        (b'{"a": 1}', None, "20210101T000000Z_a"),
+        (b'{"b":\t2}', None, "20210101T000001Z_b"),
+    ]
+    for bogus in (b"bogus\t{}\n", b"20210101T000000Z_a\n", b"\xff\t{}\n"):
+        with pytest.raises(ValueError):
+            parse_batch(b'20210101T000000Z_a\t{"a": 1}\n' + bogus)
+
+
+def test_http_api_rejects_invalid_batch(monkeypatch):
+    import io
+
+    import fastpath.localhttpfeeder as localhttpfeeder
+    from unittest.mock import Mock
+
+    apps = []
+    monkeypatch.setattr(localhttpfeeder.MsmtFeeder, "run", lambda self: apps.append(self))
+    ringbuf = Mock()
+    localhttpfeeder.start_http_api(ringbuf)
+    app = apps[0].load()
+
+    def post(path, body):
+        start_response = Mock()
+        env = {"REQUEST_METHOD": "POST", "PATH_INFO": path, "wsgi.input": io.BytesIO(body)}
+        app(env, start_response)
+        return start_response.call_args[0][0]
+
+    assert post("/batch", b'20210101T000000Z_a\t{"a": 1}\nbogus\t{}\n') == "400 Bad Request"
+    assert post("/bogus", b"{}") == "400 Bad Request"
+    assert ringbuf.put.call_count == 0
+    assert post("/batch", b'20210101T000000Z_a\t{"a": 1}\n') == "200 OK"
+    assert post("/20210101T000000Z_b", b"{}") == "200 OK"
+    assert ringbuf.put.call_count == 2
+
+
+def test_benchmark_load_corpus():
+    datadir = Path("fastpath/tests/data")
+    c1 = load_corpus(datadir, 50, 0)
+    assert c1 == load_corpus(datadir, 50, 0)
+    assert c1 != load_corpus(datadir, 50, 1)
+    assert len(set(uid for _, _, uid in c1)) == 50
+    assert all(json.loads(msm)["test_name"] for msm, _, _ in c1)
+
+
+def test_scorer_registry():
+    assert core.SCORERS["web_connectivity"] is core.score_web_connectivity_full
+    assert core.SCORERS["browser_web"] is core.score_browser_web
+    assert len(core.SCORERS) == 21
+    with pytest.raises(AssertionError):
+        core.register_scorer("telegram")(lambda msm: {})
+
+
+def test_register_experimental_scorer(monkeypatch):
+    monkeypatch.setattr(core, "SCORERS", dict(core.SCORERS))
+
+    @core.register_scorer("experimental_test")
+    def score_experimental(msm):
+        return {"foo": msm["input"]}
+
+    msm = dict(test_name="experimental_test", input="bar")
+    assert core.score_measurement(msm) == {"foo": "bar"}
+    msm = dict(test_name="unknown_test")
+    assert core.score_measurement(msm)["accuracy"] == 0.0
+
+
+def test_ringbuffer():
+    rb = RingBuffer(nslots=4, slot_size=10)
+    rb.put(b"0123456789", "uid1")
+    rb.put(b"abc", "uid2")
+    assert rb.used_slots() == 2
+    # Larger than a slot: uses contiguous slots
+    rb.put(b"x" * 11, "uid3")
+    assert rb.used_slots() == 4
+    # Larger than the buffer: sent through the queue
+    rb.put(b"y" * 41, "uid4")
+    rb.put_stop()
+    data, uid = rb.get(timeout=1)
+    assert isinstance(data, memoryview)
+    assert (data, uid) == (b"0123456789", "uid1")
+    assert rb.used_slots() == 4
+    # The next get() releases the previous measurement
+    assert rb.get(timeout=1) == (b"abc", "uid2")
+    assert rb.used_slots() == 3
+    with pytest.raises(ValueError):
+        data[0]
+    assert rb.get(timeout=1) == (b"x" * 11, "uid3")
+    assert rb.used_slots() == 2
+    rb.release()
+    assert rb.used_slots() == 0
+    assert rb.get(timeout=1) == (b"y" * 41, "uid4")
+    assert rb.get(timeout=1) is None
+    assert rb.used_slots() == 0
+    with pytest.raises(Empty):
+        rb.get(timeout=0.01)
+
+
+def test_ringbuffer_backpressure():
+    import threading
+
+    rb = RingBuffer(nslots=4, slot_size=10)
+    for n in range(4):
+        rb.put(b"a", f"uid{n}")
+    # A measurement needing 2 contiguous slots waits for them
+    t = threading.Thread(target=rb.put, args=(b"b" * 20, "uid4"))
+    t.start()
+    rb.get(timeout=1)
+    rb.get(timeout=1)  # releases slot 0
+    t.join(timeout=0.2)
+    assert t.is_alive()
+    rb.get(timeout=1)  # releases slot 1
+    t.join(timeout=5)
+    assert not t.is_alive()
+
+    # Measurements larger than the buffer are bounded too
+    for n in range(MAX_OVERSIZE):
+        rb.put(b"c" * 50, "uid")
+    t = threading.Thread(target=rb.put, args=(b"c" * 50, "uid"))
+    t.start()
+    t.join(timeout=0.2)
+    assert t.is_alive()
+    while rb.get(timeout=1)[0] != b"c" * 50:
+        pass
+    t.join(timeout=5)
+    assert not t.is_alive()
+
+
+def _ringbuffer_consumer(rb, out):
+    while True:
+        item = rb.get()
+        if item is None:
+            return
+        data, uid = item
+        out.put((bytes(data), uid))
+
+
+def test_ringbuffer_between_processes():
+    import multiprocessing as mp
+
+    rb = RingBuffer(nslots=2, slot_size=100)
+    out = mp.Queue()
+    workers = [
+        mp.Process(target=_ringbuffer_consumer, args=(rb, out)) for n in range(2)
+    ]
+    [w.start() for w in workers]
+    # More measurements than slots: put() waits for the consumers
+    sent = [(f"msm {n}".encode(), f"uid{n}") for n in range(20)]
+    for data, uid in sent:
+        rb.put(data, uid)
+    [rb.put_stop() for w in workers]
+    received = [out.get(timeout=5) for n in range(20)]
+    [w.join(timeout=5) for w in workers]
+    assert sorted(received) == sorted(sent)
+
+
+def _ringbuffer_crash(rb):
+    rb.get(timeout=5)
+    os._exit(1)  # dies holding the measurement
+
+
+def test_ringbuffer_reclaim_dead_worker(monkeypatch):
+    import multiprocessing as mp
+
+    import fastpath.ringbuffer
+
+    monkeypatch.setattr(fastpath.ringbuffer, "ALLOC_TIMEOUT_S", 0.1)
+    rb = RingBuffer(nslots=2, slot_size=10)
+    w = mp.Process(target=_ringbuffer_crash, args=(rb,))
+    w.start()
+    rb.put(b"a" * 20, "uid0")
+    w.join(timeout=5)
+    assert w.exitcode == 1
+    assert rb.used_slots() == 2
+    # The slots of the dead worker are freed when the buffer is full
+    rb.put(b"b" * 20, "uid1")
+    assert rb.used_slots() == 2
+    assert bytes(rb.get(timeout=1)[0]) == b"b" * 20
+
+
+def test_ringbuffer_lanes():
+    rb = RingBuffer(nslots=4, slot_size=10, lanes=("heavy", "light"))
+    rb.put(b"a", "uid1", lane=0)
+    rb.put(b"b", "uid2", lane=0)
+    rb.put_stop(lane=0)
+    assert rb.depth() == 3
+    assert rb.depth(1) == 0
+    # An idle lane takes work from the others but not their stop messages
+    assert rb.get(timeout=1, lane=1) == (b"a", "uid1")
+    assert rb.get(timeout=1, lane=1) == (b"b", "uid2")
+    with pytest.raises(Empty):
+        rb.get(timeout=0.1, lane=1)
+    assert rb.get(timeout=1, lane=0) is None
+
+
+def test_lanes(monkeypatch):
+    monkeypatch.setattr(core, "lanes", [])
+    monkeypatch.setattr(core, "lane_by_test_name", {})
+    core.setup_lanes("heavy=web_connectivity:6 light=ndt,dash:2 other=*:4")
+    assert [lane.workers for lane in core.lanes] == [6, 2, 4]
+    uid = "20210101000000.123456_IT_webconnectivity_0123456789abcdef"
+    assert core.select_lane(uid) == 0
+    assert core.select_lane(uid.replace("webconnectivity", "dash")) == 1
+    assert core.select_lane(uid.replace("webconnectivity", "signal")) == 2
+    assert core.select_lane("bogus") == 2
+    with pytest.raises(AssertionError):
+        core.setup_lanes("heavy=web_connectivity:6")
+
+
+def test_report_lane_latency(monkeypatch):
+    monkeypatch.setattr(core, "lanes", [])
+    monkeypatch.setattr(core, "lane_by_test_name", {})
+    core.setup_lanes("heavy=web_connectivity:6 other=*:4")
+    timings = []
+    monkeypatch.setattr(core.metrics, "timing", lambda *a: timings.append(a))
+    t = datetime.utcnow() - timedelta(seconds=2)
+    uid = t.strftime("%Y%m%d%H%M%S.%f") + "_IT_webconnectivity_0123456789abcdef"
+    t -= timedelta(seconds=2)
+    old_uid = t.strftime("%Y%m%d%H%M%S.%f") + "_IT_webconnectivity_0123456789abcdef"
+    columns = dict(
+        measurement_uid=[uid, old_uid, uid, "bogus"],
+        test_name=["web_connectivity", "web_connectivity", "ndt", "ndt"],
+    )
+    core.report_lane_latency(columns)
+    # One timing of each kind per lane for the whole batch
+    timings = dict(timings)
+    assert sorted(timings) == [
+        "lane.heavy.latency",
+        "lane.heavy.latency_max",
+        "lane.other.latency",
+        "lane.other.latency_max",
+    ]
+    assert 3000 <= timings["lane.heavy.latency"] < 4000
+    assert 4000 <= timings["lane.heavy.latency_max"] < 5000
+    assert 2000 <= timings["lane.other.latency"] < 3000
+
+
+@pytest.mark.skipif(core.no_simdjson, reason="simdjson not installed")
+def test_decode_measurement_partially():
+    datadir = Path("fastpath/tests/data")
+    cnt = 0
+    for fn in sorted(datadir.glob("*.json")):
+        msm = json.loads(fn.read_text())
+        if not isinstance(msm, dict) or "test_name" not in msm:
+            continue
+        decoded = core.decode_measurement(fn.read_bytes())
+        tk_names = core.SCORER_TEST_KEYS.get(msm["test_name"])
+        if tk_names is None:
+            assert decoded == msm
+            continue
+
+        cnt += 1
+        tk = decoded.pop("test_keys", None)
+        full_tk = msm.pop("test_keys", None)
+        assert decoded == msm, fn
+        if isinstance(full_tk, dict) and tk is not full_tk:
+            assert set(tk) <= set(tk_names), fn
+        msm["test_keys"] = full_tk
+        decoded["test_keys"] = tk
+        assert core.score_measurement(decoded) == core.score_measurement(msm), fn
+
+    assert cnt > 3
+
+
+@pytest.mark.skipif(core.no_simdjson, reason="simdjson not installed")
+def test_decode_measurement_dash():
+    msm = dict(test_name="dash", report_id="r", test_keys=dict(failure=None))
+    msm["test_keys"]["receiver_data"] = [dict(rate=n) for n in range(100)]
+    decoded = core.decode_measurement(json.dumps(msm).encode())
+    assert decoded == dict(test_name="dash", report_id="r", test_keys={"failure": None})
+    # No declared key: decoded in full to keep test_keys non-empty
+    del msm["test_keys"]["failure"]
+    assert core.decode_measurement(json.dumps(msm).encode()) == msm
+    with pytest.raises(ValueError):
+        core.decode_measurement(b"{bogus")
+
+
+@pytest.mark.skipif(core.no_simdjson, reason="simdjson not installed")
+def test_decode_measurement_wrapped(monkeypatch):
+    from unittest.mock import Mock
+
+    # Probe bodies received by the API are wrapped in format/content
+    msm = loadj("torsf_1")
+    msm["test_keys"]["network_events"] = [dict(operation="read", num_bytes=n) for n in range(100)]
+    body = json.dumps(dict(format="json", content=msm)).encode()
+    incr = Mock()
+    monkeypatch.setattr(core.metrics, "incr", incr)
+    decoded = core.decode_measurement(body)
+    incr.assert_called_with("partially_decoded_measurement")
+    assert sorted(decoded) == ["content", "format"]
+    tk = decoded["content"].pop("test_keys")
+    full_tk = msm.pop("test_keys")
+    assert decoded["content"] == msm
+    assert set(tk) <= set(core.SCORER_TEST_KEYS["torsf"]) and set(tk) < set(full_tk)
+    assert tk == {k: full_tk[k] for k in tk}
+
+
+def test_uidset(monkeypatch):
+    monkeypatch.setattr("fastpath.uidset.MERGE_MIN", 100)
+    s = UIDSet(max_bytes=10**6)
+    uids = [trivial_id(str(n).encode(), {}) for n in range(1000)]
+    for uid in uids[::2]:
+        assert uid not in s
+        s.add(uid)
+    assert len(s) == 500
+    assert s._sorted  # some digests were merged
+    assert all(uid in s for uid in uids[::2])
+    assert not any(uid in s for uid in uids[1::2])
+    assert list(s._sorted) == sorted(s._sorted)
+    assert 0 < s.false_positive_rate() < 1e-15
+
+
+def test_uidset_full():
+    s = UIDSet(max_bytes=5000)
+    for n in range(200):
+        s.add(str(n))
+    assert s.is_full
+    assert 0 < len(s) < 200
+    assert s.memory_bytes() >= 5000
+    assert "0" in s
+
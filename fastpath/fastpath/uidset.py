@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compact set of measurement UIDs used to detect duplicates
+
+UIDs are stored as 64-bit digests in a sorted array: 8 bytes each instead
+of about 100 bytes for a str in a Python set. New digests are kept in a
+small set and merged into the array in batches.
+
+The digest is the str hash, a keyed 64-bit SipHash. It is cached by the str
+object and it is not stable across processes: a UIDSet cannot be saved or
+shared with other processes.
+
+Two different UIDs with the same digest are taken as duplicates. The
+probability for a new UID is len(uidset) / 2**64, e.g. 5e-13 with 10
+million UIDs, see false_positive_rate()
+"""
+
+from array import array
+from bisect import bisect_left
+from typing import Set
+import logging
+
+log = logging.getLogger("fastpath.uidset")
+
+# Minimum number of new digests merged at once
+MERGE_MIN = 65536
+# Approximate size of a digest in the set of new digests: the int object
+# and the hash table slots
+RECENT_ITEM_BYTES = 64
+MASK64 = 2**64 - 1
+# The sorted array is indexed by the top bits of the digests to reduce the
+# range to bisect
+INDEX_BITS = 12
+INDEX_SHIFT = 64 - INDEX_BITS
+
+
+class UIDSet:
+    """Set of measurement UIDs. Supports "in" and add(uid).
+    When the memory used reaches max_bytes new UIDs are not added anymore
+    and the is_full attribute is set: duplicates of later UIDs are not
+    detected.
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.is_full = False
+        self._sorted = array("Q")
+        self._recent: Set[int] = set()
+        # _index[b] is the position of the first digest with top bits >= b
+        self._index = array("Q", [0] * (2**INDEX_BITS + 1))
+
+    def __contains__(self, uid: str) -> bool:
+        d = hash(uid) & MASK64
+        if d in self._recent:
+            return True
+        a = self._sorted
+        b = d >> INDEX_SHIFT
+        hi = self._index[b + 1]
+        i = bisect_left(a, d, self._index[b], hi)
+        return i < hi and a[i] == d
+
+    def __len__(self) -> int:
+        return len(self._sorted) + len(self._recent)
+
+    def add(self, uid: str) -> None:
+        if self.is_full:
+            return
+        if self.memory_bytes() >= self.max_bytes:
+            log.error(f"Duplicate detection is full at {len(self)} UIDs")
+            self.is_full = True
+            return
+
+        self._recent.add(hash(uid) & MASK64)
+        # Merging copies the whole array: merge more at once as it grows
+        if len(self._recent) >= max(MERGE_MIN, len(self._sorted) // 8):
+            self._merge()
+
+    def _merge(self) -> None:
+        # Merge each range of the index in turn: only a small part of the
+        # digests is converted to a list at any time
+        old = self._sorted
+        new = sorted(self._recent)
+        out = array("Q")
+        index = array("Q")
+        j = 0
+        for b in range(2**INDEX_BITS):
+            index.append(len(out))
+            lo, hi = self._index[b], self._index[b + 1]
+            k = bisect_left(new, (b + 1) << INDEX_SHIFT, j)
+            if k == j:
+                out.extend(old[lo:hi])
+            else:
+                chunk = old[lo:hi].tolist() + new[j:k]
+                chunk.sort()
+                out.extend(chunk)
+                j = k
+
+        index.append(len(out))
+        self._sorted = out
+        self._index = index
+        self._recent = set()
+
+    def memory_bytes(self) -> int:
+        return len(self._sorted) * 8 + len(self._recent) * RECENT_ITEM_BYTES
+
+    def false_positive_rate(self) -> float:
+        """Probability that a new UID is wrongly found in the set"""
+        return len(self) / 2**64